@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+This module answers questions about balance from the archive of finished
+games (see cthulhu_archive): does starting with the flashlight, the seat
+you sit in, or an audience of spectators change who wins, for each number
+of players?
+
+load() maps the archive's segments and reads its fixed-size records
+straight into NumPy, keeping only the columns the analyses use: one row
+per game, and one row per seat played. Every analysis is a handful of
+vectorized group-bys, so millions of games take seconds:
+  - win_rates: each role's win rate per player count, by whether the seat
+    started with the flashlight, by seat, or by spectators watching;
+  - round_lengths: how many rounds games of each size last;
+  - honesty: how often each role's claims matched their hand;
+  - player_stats: each user's wins and losses as an Investigator and as a
+    Cultist, as in PlayerStats.
+Only games with a winner count towards win rates and round lengths.
+
+export() writes each table to a CSV. Run it as
+    python cthulhu_analytics.py ignore/archive out_dir
+
+This module needs NumPy, which the bot itself doesn't.
+"""
+import csv
+import glob
+import mmap
+import os
+import sys
+
+import numpy as np
+
+import cthulhu_archive
+import cthulhu_codec
+import cthulhu_game as cg
+
+INVESTIGATOR = cthulhu_codec.ROLES.index(cg.INVESTIGATOR)
+CULTIST = cthulhu_codec.ROLES.index(cg.CULTIST)
+ROLE_NAMES = {INVESTIGATOR: cg.INVESTIGATOR, CULTIST: cg.CULTIST}
+
+# An archive record, field for field.
+SEAT = np.dtype([("user_id", ">i8"), ("role", "u1"), ("claims", "u1"),
+                 ("honest_claims", "u1")])
+RECORD = np.dtype([
+    ("chat_id", ">i8"), ("ended", ">u4"), ("players", "u1"),
+    ("winner", "u1"), ("spectators", ">u2"), ("rounds", "u1"),
+    ("cards_revealed", "u1"), ("signs_found", "u1"),
+    ("cthulhus_found", "u1"), ("first_flashlight", "u1"),
+    ("expansions", "u1"), ("seats", SEAT, (cthulhu_archive.SEATS,))])
+assert RECORD.itemsize == cthulhu_archive.RECORD_SIZE
+
+# Spectator counts are grouped as 0, 1, 2-4 and 5+.
+SPECTATOR_BINS = np.array([1, 2, 5])
+SPECTATOR_LABELS = ["0", "1", "2-4", "5+"]
+
+
+class Outcomes:
+    """
+    Archived games as NumPy columns.
+
+    Attributes:
+      players, winner, spectators, rounds, signs_found - one entry per
+        game. winner is a role code, 0 if the game was ended early.
+      seat_players, seat, role, won, decided, flashlight, seat_spectators,
+        claims, honest_claims, user_id - one entry per seat played: the
+        game's player count, the seat (from 0), its role code, whether it
+        won, whether its game had a winner, whether it started with the
+        flashlight, the spectators at the game, the claims made and how
+        many were honest, and who sat there.
+    """
+
+    def __init__(self, records):
+        """
+        Arguments:
+          records - a list of arrays of RECORD.
+        """
+        def column(name):
+            if not records:
+                return np.zeros(0, RECORD[name].base)
+            return np.concatenate([r[name] for r in records])
+
+        self.players = column("players").astype(np.int64)
+        self.winner = column("winner")
+        self.spectators = column("spectators").astype(np.int64)
+        self.rounds = column("rounds").astype(np.int64)
+        self.signs_found = column("signs_found").astype(np.int64)
+        first = column("first_flashlight")
+        seats = column("seats").reshape(-1, cthulhu_archive.SEATS)
+        # Only the first `players` seats of a record are filled.
+        played = (np.arange(cthulhu_archive.SEATS) <
+                  self.players[:, np.newaxis])
+        game_of, self.seat = np.nonzero(played)
+        self.seat_players = self.players[game_of]
+        self.seat_spectators = self.spectators[game_of]
+        self.role = seats["role"][played]
+        winner = self.winner[game_of]
+        self.decided = winner != 0
+        self.won = self.role == winner
+        self.flashlight = first[game_of] == self.seat
+        self.claims = seats["claims"][played].astype(np.int64)
+        self.honest_claims = seats["honest_claims"][played].astype(np.int64)
+        self.user_id = seats["user_id"][played].astype(np.int64)
+
+    def __len__(self):
+        return len(self.players)
+
+
+def load(directory):
+    """
+    Returns the games archived in a directory as Outcomes.
+
+    Raises:
+      CodecError - if a segment isn't one this version can read.
+    """
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory, "games-*.seg"))):
+        with open(path, "rb") as f:
+            header = cthulhu_archive.FILE_HEADER.unpack(
+                f.read(cthulhu_archive.FILE_HEADER.size))
+            if header != (cthulhu_archive.MAGIC,
+                          cthulhu_archive.FORMAT_VERSION,
+                          cthulhu_archive.RECORD_SIZE,
+                          cthulhu_archive.SEATS):
+                raise cthulhu_codec.CodecError(
+                    "{} isn't a segment this version can read.".format(path))
+            count = ((os.path.getsize(path) -
+                      cthulhu_archive.FILE_HEADER.size) //
+                     cthulhu_archive.RECORD_SIZE)
+            if count == 0:
+                continue
+            view = mmap.mmap(f.fileno(), cthulhu_archive.FILE_HEADER.size +
+                             count * cthulhu_archive.RECORD_SIZE,
+                             access=mmap.ACCESS_READ)
+        records.append(np.frombuffer(view, RECORD, count,
+                                     cthulhu_archive.FILE_HEADER.size))
+    return Outcomes(records)
+
+
+def group_counts(keys, shape, weights=None):
+    """
+    Counts, or sums weights, by a tuple of small int keys, as an array of
+    the given shape.
+    """
+    flat = np.ravel_multi_index(keys, shape)
+    size = int(np.prod(shape))
+    return np.bincount(flat, weights, minlength=size).reshape(shape)
+
+
+def win_rates(outcomes, by="flashlight"):
+    """
+    Returns each role's win rate per player count, split by one factor.
+
+    Arguments:
+      by - "flashlight" (whether the seat started with it), "seat", or
+        "spectators".
+
+    Returns:
+      (header, rows) - a row per player count, role and group with any
+        games.
+    """
+    if by == "flashlight":
+        key, labels = outcomes.flashlight.astype(np.int64), ["no", "yes"]
+    elif by == "seat":
+        key = outcomes.seat
+        labels = [str(seat + 1) for seat in range(cthulhu_archive.SEATS)]
+    elif by == "spectators":
+        key = np.digitize(outcomes.seat_spectators, SPECTATOR_BINS)
+        labels = SPECTATOR_LABELS
+    else:
+        raise ValueError("Can't group win rates by {}.".format(by))
+    decided = outcomes.decided
+    keys = (outcomes.seat_players[decided], outcomes.role[decided],
+            key[decided])
+    shape = (cthulhu_archive.SEATS + 1, len(cthulhu_codec.ROLES),
+             len(labels))
+    games = group_counts(keys, shape)
+    wins = group_counts(keys, shape, outcomes.won[decided])
+    rows = [[int(players), ROLE_NAMES[role], labels[group],
+             int(games[players, role, group]),
+             int(wins[players, role, group]),
+             round(float(wins[players, role, group] /
+                         games[players, role, group]), 4)]
+            for players, role, group in zip(*np.nonzero(games))]
+    return ["players", "role", by, "games", "won", "win_rate"], rows
+
+
+def round_lengths(outcomes):
+    """
+    Returns how many games of each player count lasted each number of
+    rounds, and the Elder Signs found in them on average.
+    """
+    decided = outcomes.winner != 0
+    keys = (outcomes.players[decided], outcomes.rounds[decided])
+    shape = (cthulhu_archive.SEATS + 1, int(outcomes.rounds.max(initial=0)) + 1)
+    games = group_counts(keys, shape)
+    signs = group_counts(keys, shape, outcomes.signs_found[decided])
+    totals = games.sum(axis=1)
+    rows = [[int(players), int(rounds), int(games[players, rounds]),
+             round(float(games[players, rounds] / totals[players]), 4),
+             round(float(signs[players, rounds] / games[players, rounds]), 2)]
+            for players, rounds in zip(*np.nonzero(games))]
+    return ["players", "rounds", "games", "share", "elder_signs_found"], rows
+
+
+def honesty(outcomes):
+    """
+    Returns how often each role's claims matched the Elder Signs and
+    Cthulhus in their hand, per player count.
+    """
+    keys = (outcomes.seat_players, outcomes.role)
+    shape = (cthulhu_archive.SEATS + 1, len(cthulhu_codec.ROLES))
+    claims = group_counts(keys, shape, outcomes.claims)
+    honest = group_counts(keys, shape, outcomes.honest_claims)
+    rows = [[int(players), ROLE_NAMES[role], int(claims[players, role]),
+             int(honest[players, role]),
+             round(float(honest[players, role] / claims[players, role]), 4)]
+            for players, role in zip(*np.nonzero(claims))]
+    return ["players", "role", "claims", "honest_claims", "honesty_rate"], rows
+
+
+def player_stats(outcomes):
+    """
+    Returns every user's wins and losses in games with a winner, in the
+    fields of PlayerStats.
+    """
+    decided = outcomes.decided
+    users, user = np.unique(outcomes.user_id[decided], return_inverse=True)
+    # Columns: ngcw, ngcl, ngiw, ngil.
+    column = (np.where(outcomes.role[decided] == CULTIST, 0, 2) +
+              np.where(outcomes.won[decided], 0, 1))
+    counts = group_counts((user, column), (len(users), 4))
+    rows = [[int(user_id)] + [int(n) for n in row]
+            for user_id, row in zip(users, counts)]
+    return ["user_id"] + list(cg.PlayerStats.__slots__), rows
+
+
+def stats_for(outcomes, user_id):
+    """
+    Returns a user's PlayerStats from the archive.
+    """
+    mine = outcomes.decided & (outcomes.user_id == user_id)
+    cultist = outcomes.role[mine] == CULTIST
+    won = outcomes.won[mine]
+    stats = cg.PlayerStats()
+    stats.ngcw = int(np.sum(cultist & won))
+    stats.ngcl = int(np.sum(cultist & ~won))
+    stats.ngiw = int(np.sum(~cultist & won))
+    stats.ngil = int(np.sum(~cultist & ~won))
+    return stats
+
+
+TABLES = {
+    "win_rates_flashlight": lambda o: win_rates(o, "flashlight"),
+    "win_rates_seat": lambda o: win_rates(o, "seat"),
+    "win_rates_spectators": lambda o: win_rates(o, "spectators"),
+    "round_lengths": round_lengths,
+    "honesty": honesty,
+    "player_stats": player_stats,
+}
+
+
+def export(outcomes, directory):
+    """
+    Writes every table to a CSV named after it in a directory.
+
+    Returns:
+      paths - the files written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name, table in TABLES.items():
+        header, rows = table(outcomes)
+        path = os.path.join(directory, name + ".csv")
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+        paths.append(path)
+    return paths
+
+
+def main():
+    """
+    Exports the analyses of the archive in argv[1] to the directory in
+    argv[2].
+    """
+    if len(sys.argv) != 3:
+        print("Usage: python cthulhu_analytics.py archive_dir out_dir")
+        sys.exit(1)
+    outcomes = load(sys.argv[1])
+    for path in export(outcomes, sys.argv[2]):
+        print(path)
+    print("{} games analysed.".format(len(outcomes)))
+
+
+if __name__ == "__main__":
+    main()
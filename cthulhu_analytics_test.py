@@ -0,0 +1,116 @@
+import cthulhu_archive
+import cthulhu_archive_test
+import cthulhu_game as cg
+import collections
+import csv
+import os
+import tempfile
+import unittest
+
+try:
+    import cthulhu_analytics as analytics
+except ImportError:
+    analytics = None
+
+
+@unittest.skipIf(analytics is None, "NumPy isn't installed.")
+class TestAnalytics(unittest.TestCase):
+    """
+    Tests the analyses against the same numbers worked out record by
+    record.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.TemporaryDirectory()
+        archive = cthulhu_archive.Archive(cls.dir.name)
+        for i in range(40):
+            game = cthulhu_archive_test.play(n_players=4 + i % 5, seed=i,
+                                             first_id=1 + i % 7)
+            for _ in range(i % 3):
+                game.add_player(cg.Player(500 + i), is_playing=False)
+            archive.append(game, -1)
+        cls.records = list(archive.scan())
+        archive.close()
+        cls.outcomes = analytics.load(cls.dir.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dir.cleanup()
+
+    def seats(self):
+        """
+        Yields (record, seat number, seat) for every seat of a decided game.
+        """
+        for record in self.records:
+            if record.winner is not None:
+                for number, seat in enumerate(record.seats):
+                    yield record, number, seat
+
+    def test_win_rates(self):
+        """
+        Win rates by flashlight, seat and spectators match the records.
+        """
+        self.assertEqual(len(self.outcomes), 40)
+        for by, key in (
+                ("flashlight", lambda r, n: "yes" if r.first_flashlight == n
+                 else "no"),
+                ("seat", lambda r, n: str(n + 1)),
+                ("spectators", lambda r, n: ["0", "1", "2-4", "5+"][
+                    sum(r.spectators >= low for low in (1, 2, 5))])):
+            expected = collections.Counter()
+            won = collections.Counter()
+            for record, number, seat in self.seats():
+                group = (len(record.seats), seat.role, key(record, number))
+                expected[group] += 1
+                won[group] += seat.role == record.winner
+            header, rows = analytics.win_rates(self.outcomes, by)
+            self.assertEqual(header[2], by)
+            self.assertEqual({tuple(row[:3]): (row[3], row[4])
+                              for row in rows},
+                             {group: (n, won[group])
+                              for group, n in expected.items()})
+
+    def test_rounds_and_honesty(self):
+        """
+        Round lengths, claim honesty and player stats match the records.
+        """
+        rounds = collections.Counter(
+            (len(r.seats), r.rounds) for r in self.records
+            if r.winner is not None)
+        header, rows = analytics.round_lengths(self.outcomes)
+        self.assertEqual({(row[0], row[1]): row[2] for row in rows},
+                         dict(rounds))
+        header, rows = analytics.honesty(self.outcomes)
+        # Every claim in these games was honest.
+        for row in rows:
+            self.assertEqual(row[2], row[3])
+            self.assertEqual(row[4], 1.0)
+        stats = analytics.stats_for(self.outcomes, 3)
+        wins = sum(seat.user_id == 3 and seat.role == record.winner
+                   for record, _, seat in self.seats())
+        self.assertEqual(stats.ngcw + stats.ngiw, wins)
+        header, rows = analytics.player_stats(self.outcomes)
+        self.assertEqual(header, ["user_id", "ngcw", "ngcl", "ngiw", "ngil"])
+        self.assertIn([3, stats.ngcw, stats.ngcl, stats.ngiw, stats.ngil],
+                      rows)
+
+    def test_export(self):
+        """
+        Every table is written to a CSV with its header.
+        """
+        with tempfile.TemporaryDirectory() as out:
+            paths = analytics.export(self.outcomes, out)
+            self.assertEqual(len(paths), len(analytics.TABLES))
+            with open(os.path.join(out, "honesty.csv")) as f:
+                rows = list(csv.reader(f))
+            self.assertEqual(rows[0], ["players", "role", "claims",
+                                       "honest_claims", "honesty_rate"])
+            self.assertGreater(len(rows), 1)
+        empty = analytics.Outcomes([])
+        self.assertEqual(analytics.win_rates(empty)[1], [])
+        self.assertEqual(analytics.round_lengths(empty)[1], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+This module keeps finished games, so that they aren't lost once a chat
+starts its next one.
+
+Each finished game is appended to a segment file as a fixed-size record:
+the chat, when it ended, the winner, how long it lasted, and for every seat
+the player's id, role, and how many of their claims were honest. With every
+record the same size, game n is at a known offset, and segments are read
+back through mmap, so looking up or scanning records copies nothing but the
+fields asked for.
+
+Segments hold SEGMENT_RECORDS games each and are named by number. Alongside
+them, players.idx lists (user id, game number) for every seat, in the order
+games were archived, and is loaded into a dict of arrays when the archive
+opens, so a user's /history reads only their own records.
+
+A record is written before its index entries, and the records past the last
+indexed game are indexed again on opening, so a crash between the two loses
+nothing. A record cut short by a crash is dropped.
+"""
+import array
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+import cthulhu_codec
+import cthulhu_game as cg
+
+MAGIC = b"CTA"
+FORMAT_VERSION = 1
+
+# The seats in a record. Games with more players aren't archived.
+SEATS = 10
+SEGMENT_RECORDS = 1 << 18
+
+# A segment's header, then the game and seat fields of each record.
+FILE_HEADER = struct.Struct(">3sBHH")
+GAME = struct.Struct(">qIBBHBBBBBB")
+SEAT = struct.Struct(">qBBB")
+RECORD_SIZE = GAME.size + SEATS * SEAT.size
+INDEX_ENTRY = struct.Struct(">qI")
+
+# The seat that means nobody, for a game where nobody investigated.
+NO_SEAT = 0xFF
+
+SeatRecord = collections.namedtuple(
+    "SeatRecord", ["user_id", "role", "claims", "honest_claims"])
+
+
+class GameRecord(collections.namedtuple("GameRecord", [
+        "number", "chat_id", "ended", "winner", "spectators", "rounds",
+        "cards_revealed", "signs_found", "cthulhus_found", "first_flashlight",
+        "expansions", "seats"])):
+    """
+    An archived game.
+
+    Attributes:
+      number - the game's place in the archive, from 0.
+      chat_id - the chat it was played in.
+      ended - when it ended, in Unix seconds.
+      winner - cg.INVESTIGATOR, cg.CULTIST, or None if it was ended early.
+      spectators - how many were watching at the end.
+      rounds - the rounds started.
+      cards_revealed, signs_found, cthulhus_found - as in Game.
+      first_flashlight - the seat that started with the flashlight, from 0,
+        or None if nobody investigated.
+      expansions - the expansions played with.
+      seats - a SeatRecord per seat.
+    """
+    __slots__ = ()
+
+    def seat_of(self, user_id):
+        """
+        Returns a user's seat in the game, from 0.
+        """
+        return [seat.user_id for seat in self.seats].index(user_id)
+
+
+def claim_counts(game):
+    """
+    Returns how many claims each seat made, and how many of those claimed
+    exactly the Elder Signs and Cthulhus in the hand.
+    """
+    claims = [0] * len(game.get_active_players())
+    honest = list(claims)
+    for log in game.rounds or ():
+        for seat, (hand, claim) in enumerate(zip(log.hands, log.claims)):
+            if claim is None:
+                continue
+            claims[seat] += 1
+            if (claim[1] == hand.count("Elder Sign") and
+                    claim[2] == hand.count("Cthulhu")):
+                honest[seat] += 1
+    return claims, honest
+
+
+def encode_record(game, chat_id, ended):
+    """
+    Packs a finished game into a record.
+    """
+    players = game.get_active_players()
+    reveals = game.rounds[0].reveals if game.rounds else ()
+    first = reveals[0][0] if reveals else NO_SEAT
+    expansions = sum(1 << code for code, expansion in
+                     enumerate(cthulhu_codec.EXPANSIONS)
+                     if expansion in game.game_settings.expansions)
+    claims, honest = claim_counts(game)
+    record = [GAME.pack(
+        chat_id, int(ended), len(players),
+        cthulhu_codec.ROLES.index(game.winner),
+        min(len(game.get_spectators()), 0xFFFF), game.round_counter,
+        game.cards_revealed, game.signs_found, game.cthulhus_found, first,
+        expansions)]
+    for seat, player in enumerate(players):
+        record.append(SEAT.pack(
+            player.p_id, cthulhu_codec.ROLES.index(player.game_data.role),
+            min(claims[seat], 0xFF), min(honest[seat], 0xFF)))
+    record.append(bytes((SEATS - len(players)) * SEAT.size))
+    return b"".join(record)
+
+
+def decode_record(buffer, offset, number):
+    """
+    Unpacks the record at an offset of a buffer.
+    """
+    (chat_id, ended, n_players, winner, spectators, rounds, revealed, signs,
+     cthulhus, first, expansions) = GAME.unpack_from(buffer, offset)
+    seats = tuple(
+        SeatRecord(user_id, cthulhu_codec.ROLES[role], claims, honest)
+        for user_id, role, claims, honest in (
+            SEAT.unpack_from(buffer, offset + GAME.size + seat * SEAT.size)
+            for seat in range(n_players)))
+    return GameRecord(
+        number, chat_id, ended, cthulhu_codec.ROLES[winner], spectators,
+        rounds, revealed, signs, cthulhus, None if first == NO_SEAT else first,
+        [expansion for code, expansion in enumerate(cthulhu_codec.EXPANSIONS)
+         if expansions >> code & 1], seats)
+
+
+class Segment:
+    """
+    One segment file, appended to with write() and read through mmap.
+
+    Attributes:
+      path - the file.
+      count - the records in it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "w+b" if new else "r+b")
+        if new:
+            self.file.write(FILE_HEADER.pack(MAGIC, FORMAT_VERSION,
+                                             RECORD_SIZE, SEATS))
+            self.file.flush()
+        else:
+            header = FILE_HEADER.unpack(self.file.read(FILE_HEADER.size))
+            if header != (MAGIC, FORMAT_VERSION, RECORD_SIZE, SEATS):
+                raise cthulhu_codec.CodecError(
+                    "{} isn't a segment this version can read.".format(path))
+            size = os.path.getsize(path) - FILE_HEADER.size
+            if size % RECORD_SIZE:
+                # A record cut short by a crash.
+                logging.warning("Dropping a partial record from %s.", path)
+                self.file.truncate(FILE_HEADER.size +
+                                   size - size % RECORD_SIZE)
+            self.file.seek(0, os.SEEK_END)
+        self.count = (self.file.tell() - FILE_HEADER.size) // RECORD_SIZE
+        self.map = None
+
+    def append(self, record):
+        self.file.write(record)
+        self.file.flush()
+        self.count += 1
+
+    def view(self):
+        """
+        Returns an mmap of the segment covering every record, remapping
+        once records have been appended past the current one. An old map
+        isn't closed, as another thread may still be reading it; it's
+        unmapped once nothing refers to it.
+        """
+        size = FILE_HEADER.size + self.count * RECORD_SIZE
+        if self.map is None or len(self.map) < size:
+            self.map = mmap.mmap(self.file.fileno(), size,
+                                 access=mmap.ACCESS_READ)
+        return self.map
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class Archive:
+    """
+    An append-only store of finished games, indexed by player.
+
+    Attributes:
+      directory - where the segments and the index are.
+      segments - the Segments, in order.
+      players - maps a user's id to an array of their games' numbers,
+        oldest first.
+      count - the games archived.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.segments = []
+        while os.path.exists(self.segment_path(len(self.segments))):
+            self.segments.append(Segment(self.segment_path(
+                len(self.segments))))
+        self.count = sum(segment.count for segment in self.segments)
+        self.players = {}
+        indexed = self.load_index()
+        self.index = open(os.path.join(directory, "players.idx"), "ab")
+        for number in range(indexed, self.count):
+            self.add_to_index(self.record(number))
+        self.index.flush()
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, "games-{:05}.seg".format(number))
+
+    def load_index(self):
+        """
+        Loads players.idx into self.players. The last game in it may have
+        been cut short, so its entries, and any for games past the end of
+        the segments, are dropped from the file to be indexed again.
+
+        Returns:
+          indexed - the number of games the index fully covers.
+        """
+        path = os.path.join(self.directory, "players.idx")
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            data = f.read()
+        size = len(data) - len(data) % INDEX_ENTRY.size
+        if size == 0:
+            indexed = 0
+        else:
+            indexed = min(INDEX_ENTRY.unpack_from(
+                data, size - INDEX_ENTRY.size)[1], self.count)
+        keep = 0
+        players = self.players
+        for user_id, number in INDEX_ENTRY.iter_unpack(
+                memoryview(data)[:size]):
+            if number >= indexed:
+                break
+            games = players.get(user_id)
+            if games is None:
+                games = players[user_id] = array.array("I")
+            games.append(number)
+            keep += 1
+        if keep * INDEX_ENTRY.size < len(data):
+            with open(path, "r+b") as f:
+                f.truncate(keep * INDEX_ENTRY.size)
+        return indexed
+
+    def add_to_index(self, record):
+        for seat in record.seats:
+            self.index.write(INDEX_ENTRY.pack(seat.user_id, record.number))
+            games = self.players.get(seat.user_id)
+            if games is None:
+                games = self.players[seat.user_id] = array.array("I")
+            games.append(record.number)
+
+    def append(self, game, chat_id, ended=None):
+        """
+        Archives a finished game.
+
+        Returns:
+          number - the game's number, or None if it has too many players
+            to archive.
+        """
+        if len(game.get_active_players()) > SEATS:
+            logging.warning("Not archiving a game of %d players.",
+                            len(game.get_active_players()))
+            return None
+        record = encode_record(game, chat_id,
+                               time.time() if ended is None else ended)
+        with self.lock:
+            if not self.segments or \
+                    self.segments[-1].count == SEGMENT_RECORDS:
+                self.segments.append(Segment(self.segment_path(
+                    len(self.segments))))
+            number = self.count
+            self.segments[-1].append(record)
+            self.count += 1
+            self.add_to_index(decode_record(record, 0, number))
+            self.index.flush()
+        return number
+
+    def record(self, number):
+        """
+        Returns archived game number `number`.
+        """
+        segment, slot = divmod(number, SEGMENT_RECORDS)
+        if not 0 <= number < self.count:
+            raise IndexError("There's no game {} in the archive.".format(
+                number))
+        return decode_record(self.segments[segment].view(),
+                             FILE_HEADER.size + slot * RECORD_SIZE, number)
+
+    def history(self, user_id, limit=10):
+        """
+        Returns a user's last `limit` games, newest first.
+        """
+        with self.lock:
+            games = self.players.get(user_id, ())[-limit:]
+        return [self.record(number) for number in reversed(games)]
+
+    def scan(self):
+        """
+        Yields every archived game, oldest first.
+        """
+        for number in range(self.count):
+            yield self.record(number)
+
+    def views(self):
+        """
+        Returns (mmap, records) for every segment, for readers that want to
+        scan the raw records. Records start at FILE_HEADER.size.
+        """
+        with self.lock:
+            return [(segment.view(), segment.count)
+                    for segment in self.segments]
+
+    def close(self):
+        with self.lock:
+            self.index.close()
+            for segment in self.segments:
+                segment.close()
+
+
+def describe(record, user_id):
+    """
+    Returns a line about an archived game, from one player's point of view.
+    """
+    seat = record.seats[record.seat_of(user_id)]
+    if record.winner is None:
+        result = "ended early"
+    else:
+        result = "won" if seat.role == record.winner else "lost"
+    return "{}: {} as {}, {} players, {} round{}".format(
+        time.strftime("%Y-%m-%d", time.gmtime(record.ended)), result,
+        "a Cultist" if seat.role == cg.CULTIST else "an Investigator",
+        len(record.seats), record.rounds, "" if record.rounds == 1 else "s")
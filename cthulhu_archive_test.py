@@ -0,0 +1,121 @@
+from cthulhu_archive import *
+import cthulhu_archive
+import cthulhu_game as cg
+import cthulhu_testing as testing
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+
+def play(n_players=5, seed=0, first_id=1):
+    """
+    Returns a game played to the end with honest claims.
+    """
+    random.seed(seed)
+    game = cg.Game()
+    for i in range(n_players):
+        game.add_player(cg.Player(first_id + i, nickname="P{}".format(i)))
+    game.add_player(cg.Player(99), is_playing=False)
+    game.start_game()
+    while game.game_status == "Ongoing":
+        move = testing.next_move(game)
+        if move is None:
+            game.end_game()
+            break
+        player = game.get_current_player()
+        if game.phase == "Claims":
+            game.set_claim(player, *cg.parse_claim(
+                move[1].split()[1:], len(player.game_data.cards)))
+        else:
+            seat = int(move[1].split()[1])
+            game.investigate(player, game.get_active_players()[seat - 1])
+    return game
+
+
+class TestArchive(unittest.TestCase):
+    """
+    Tests archiving finished games and reading them back.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.archive = Archive(self.dir.name)
+
+    def tearDown(self):
+        self.archive.close()
+        self.dir.cleanup()
+
+    def reopen(self):
+        self.archive.close()
+        self.archive = Archive(self.dir.name)
+
+    def test_record(self):
+        """
+        A record keeps the game's outcome and every seat's role and claims.
+        """
+        game = play(seed=3)
+        self.assertEqual(self.archive.append(game, -5, ended=86400), 0)
+        record = self.archive.record(0)
+        self.assertEqual(record.chat_id, -5)
+        self.assertEqual(record.ended, 86400)
+        self.assertEqual(record.winner, game.winner)
+        self.assertEqual(record.spectators, 1)
+        self.assertEqual(record.rounds, game.round_counter)
+        self.assertEqual(record.signs_found, game.signs_found)
+        self.assertEqual(record.first_flashlight, game.rounds[0].reveals[0][0])
+        players = game.get_active_players()
+        self.assertEqual([(s.user_id, s.role) for s in record.seats],
+                         [(p.p_id, p.game_data.role) for p in players])
+        # Every claim was honest.
+        for seat in record.seats:
+            self.assertGreater(seat.claims, 0)
+            self.assertEqual(seat.honest_claims, seat.claims)
+        self.assertEqual(record.seat_of(players[2].p_id), 2)
+        self.assertIn("1970-01-02", describe(record, players[0].p_id))
+
+    @mock.patch.object(cthulhu_archive, "SEGMENT_RECORDS", 4)
+    def test_history_across_segments(self):
+        """
+        A user's history covers every segment and survives reopening.
+        """
+        for i in range(10):
+            self.archive.append(play(seed=i, first_id=1 + i % 3), -1 - i,
+                                ended=i)
+        self.assertEqual(len(self.archive.segments), 3)
+        self.reopen()
+        self.assertEqual(self.archive.count, 10)
+        # User 3 sat in every game.
+        self.assertEqual([r.chat_id for r in self.archive.history(3, 20)],
+                         [-1 - i for i in reversed(range(10))])
+        # User 1 only in those starting from seat 1.
+        self.assertEqual([r.number for r in self.archive.history(1, 2)],
+                         [9, 6])
+        self.assertEqual([r.number for r in self.archive.scan()],
+                         list(range(10)))
+        self.assertEqual(self.archive.history(1234), [])
+
+    def test_recovery(self):
+        """
+        A torn record is dropped, and games missing from the index are
+        indexed again.
+        """
+        for i in range(3):
+            self.archive.append(play(seed=i), -1)
+        self.archive.close()
+        with open(os.path.join(self.dir.name, "players.idx"), "r+b") as f:
+            f.truncate(INDEX_ENTRY.size * 7 + 3)
+        with open(self.archive.segment_path(0), "ab") as f:
+            f.write(b"\0" * (RECORD_SIZE // 2))
+        self.archive = Archive(self.dir.name)
+        self.assertEqual(self.archive.count, 3)
+        self.assertEqual(len(self.archive.history(1)), 3)
+        self.assertEqual(self.archive.append(play(seed=4), -1), 3)
+        self.reopen()
+        self.assertEqual([r.number for r in self.archive.history(5)],
+                         [3, 2, 1, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
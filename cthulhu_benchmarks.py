@@ -0,0 +1,1191 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains local benchmarks for the bot and the game engine.
+
+Nothing here talks to Telegram. Run a benchmark by name:
+    python cthulhu_benchmarks.py sharding
+or run them all with no arguments.
+"""
+import collections
+import gc
+import itertools
+import logging
+import os
+import pickle
+import random
+import selectors
+import socket
+import sys
+import threading
+import tempfile
+import time
+import tracemalloc
+
+import telegram
+from telegram.utils.request import Request
+
+import cthulhu_archive as archive
+import cthulhu_broadcast as broadcast
+import cthulhu_codec as codec
+import cthulhu_env as env
+import cthulhu_eviction as eviction
+import cthulhu_fakeapi as fakeapi
+import cthulhu_game as cg
+import cthulhu_game_bot as bot_module
+import cthulhu_lanes as lanes
+import cthulhu_matchmaking as matchmaking
+import cthulhu_outbox as outbox
+import cthulhu_ratelimit as ratelimit
+import cthulhu_shard as shard
+import cthulhu_testing as testing
+import cthulhu_timers as timers
+import cthulhu_transport as transport
+import cthulhu_webfeed as webfeed
+
+
+def scripted_updates(n_chats, players, rounds, first_chat=-1000):
+    """
+    Returns update JSON for scripted games in many chats, interleaved the way
+    busy chats' messages would be.
+    """
+    scripts = []
+    for c in range(n_chats):
+        chat_id = first_chat - c
+        user_ids = [(c * players) + i + 1 for i in range(players)]
+        scripts.append(testing.game_script(chat_id, user_ids, rounds=rounds))
+    updates = []
+    for step in itertools.zip_longest(*scripts):
+        for move in step:
+            if move:
+                updates.append(testing.make_update(len(updates) + 1, *move))
+    return updates
+
+
+def bench_sharding(n_chats=300, players=5, rounds=2, worker_counts=(1, 2, 4)):
+    """
+    Measures update throughput against the number of shard workers, then
+    adds a worker midway through a run and reports how many chats moved.
+
+    Workers are separate processes, so throughput can only scale up to the
+    number of CPU cores; the core count is printed alongside the results.
+    Updates whose handlers crashed are counted and reported, not hidden.
+    """
+    updates = scripted_updates(n_chats, players, rounds)
+    print("Sharding: {} updates over {} chats, {} CPU core(s)".format(
+        len(updates), n_chats, os.cpu_count()))
+    for n_workers in worker_counts:
+        supervisor = shard.ShardSupervisor(n_workers, testing.FakeBot)
+        start = time.perf_counter()
+        for data in updates:
+            supervisor.route(data)
+        results = supervisor.flush()
+        elapsed = time.perf_counter() - start
+        supervisor.stop()
+        errors = sum(r[1] for r in results.values())
+        print("  {} worker(s): {:8.0f} updates/s  {} failed".format(
+            n_workers, len(updates) / elapsed, errors))
+
+    # Rebalance: start with two workers and add a third halfway through.
+    supervisor = shard.ShardSupervisor(2, testing.FakeBot)
+    half = len(updates) // 2
+    for data in updates[:half]:
+        supervisor.route(data)
+    supervisor.flush()
+    start = time.perf_counter()
+    moved = supervisor.add_worker()
+    elapsed = time.perf_counter() - start
+    for data in updates[half:]:
+        supervisor.route(data)
+    results = supervisor.flush()
+    supervisor.stop()
+    owned = {name: len(chats)
+             for name, (handled, errors, chats) in results.items()}
+    print("  Added a worker: moved {} of {} chats ({:.0%}) in {:.1f} ms".format(
+        moved, n_chats, moved / n_chats, elapsed * 1000))
+    print("  Chats per worker afterwards: {}".format(owned))
+
+
+def bench_expansions(n_games=2000, n_players=6):
+    """
+    Times simulated games with and without the expansions' card effects.
+    """
+    configs = [
+        ("base game", []),
+        ("Necronomicon", [cg.NECRONOMICON]),
+        ("Objects of Power", [cg.OBJECTS_OF_POWER]),
+        ("both", [cg.NECRONOMICON, cg.OBJECTS_OF_POWER]),
+    ]
+    print("Expansions: {} games of {} players each".format(n_games, n_players))
+    for name, expansions in configs:
+        moves = 0
+        investigator_wins = 0
+        start = time.perf_counter()
+        for i in range(n_games):
+            game = testing.play_random_game(n_players, expansions, seed=i)
+            moves += game.cards_revealed
+            investigator_wins += game.winner == cg.INVESTIGATOR
+        elapsed = time.perf_counter() - start
+        print("  {:<17} {:7.0f} games/s  {:5.1f} investigations/game  "
+              "Investigators win {:.0%}".format(
+                  name, n_games / elapsed, moves / n_games,
+                  investigator_wins / n_games))
+
+
+def bench_ruleset(repeats=200):
+    """
+    Times loading the ruleset at startup, and start_game with the shared
+    ruleset against re-reading the data files for every game, as start_game
+    used to.
+    """
+    start = time.perf_counter()
+    for i in range(repeats):
+        cg.Ruleset()
+    startup = (time.perf_counter() - start) / repeats
+    print("Ruleset: loading and validating takes {:.2f} ms".format(
+        startup * 1000))
+    for n_players in range(3, 11):
+        timings = []
+        for fresh in (False, True):
+            elapsed = 0
+            for i in range(repeats):
+                game = cg.Game()
+                for p in range(n_players):
+                    game.add_player(cg.Player(p + 1, nickname="P"))
+                start = time.perf_counter()
+                if fresh:
+                    game.ruleset = cg.Ruleset()
+                game.start_game()
+                elapsed += time.perf_counter() - start
+            timings.append(elapsed / repeats * 1e6)
+        print("  {:2} players: start_game {:7.1f} us shared, {:7.1f} us "
+              "re-reading files".format(n_players, *timings))
+
+
+def bench_names(n_spectators=(0, 100, 1000), lookups=20000):
+    """
+    Times finding /investigate targets by name with 10 seated players and a
+    growing crowd of spectators.
+    """
+    print("Names: {} lookups among 10 players".format(lookups))
+    names = ["Player{}".format(i) for i in range(10)]
+    for spectators in n_spectators:
+        game = cg.Game()
+        for i, name in enumerate(names):
+            game.add_player(cg.Player(i + 1, nickname=name))
+        for i in range(spectators):
+            game.add_player(cg.Player(1000 + i, nickname="Player{}".format(
+                100 + i)), is_playing=False)
+        targets = [cg.parse_target([name.lower()]) for name in names]
+        start = time.perf_counter()
+        for i in range(lookups):
+            game.find_player(targets[i % 10])
+        elapsed = time.perf_counter() - start
+        print("  {:5} spectators: {:6.2f} us per lookup".format(
+            spectators, elapsed / lookups * 1e6))
+
+
+def bench_spectators(spectator_counts=(0, 50), delay=0.002, seed=4):
+    """
+    Times how long players wait for each command's replies with and without
+    spectators, using a fake bot that takes `delay` seconds per message.
+    """
+    print("Spectators: fake bot latency {:.0f} ms per message".format(
+        delay * 1000))
+    for n_spectators in spectator_counts:
+        random.seed(seed)
+        dispatcher = testing.make_dispatcher(testing.FakeBot(delay=delay))
+        counter = itertools.count()
+        latencies = []
+
+        def send(chat_id, user_id, text):
+            data = testing.make_update(next(counter), chat_id, user_id, text)
+            start = time.perf_counter()
+            testing.process(dispatcher, data)
+            latencies.append(time.perf_counter() - start)
+        send(-1, 1, "/newgame")
+        for i in range(n_spectators):
+            send(-1, 1000 + i, "/spectate")
+        latencies.clear()
+        testing.play_game(send, lambda c: dispatcher.chat_data[c]["game"],
+                          -1, [1, 2, 3, 4, 5])
+        start = time.perf_counter()
+        feed = dispatcher.bot_data.get("spectator_feed")
+        if feed is not None:
+            feed.flush()
+            feed.stop()
+        drain = time.perf_counter() - start
+        latencies.sort()
+        print("  {:2} spectators: median reply {:5.1f} ms, worst {:5.1f} ms; "
+              "{} spectator DMs, {} boards coalesced, {:.2f} s to drain".format(
+                  n_spectators, latencies[len(latencies) // 2] * 1000,
+                  latencies[-1] * 1000, feed.sent if feed else 0,
+                  feed.coalesced if feed else 0, drain))
+
+
+def bench_eviction(n_chats=100000, active=0.01, players=4):
+    """
+    Measures resident memory for many chats with pending games, before and
+    after idle ones are evicted to disk, and the cost of reloading one.
+    """
+    clock = [0]
+    dispatcher = testing.make_dispatcher()
+    path = os.path.join(tempfile.mkdtemp(), "evicted.sqlite")
+    evictions = eviction.EvictionManager(path, ttl=3600,
+                                         max_chats=n_chats,
+                                         clock=lambda: clock[0])
+    tracemalloc.start()
+    for c in range(n_chats):
+        chat_id = -1 - c
+        game = cg.Game()
+        for i in range(players):
+            user_id = c * players + i + 1
+            player = cg.Player(user_id, nickname="P{}".format(user_id))
+            dispatcher.user_data[user_id]["player"] = player
+            evictions.mark(evictions.users, user_id, 0)
+            game.add_player(player)
+        dispatcher.chat_data[chat_id]["game"] = game
+        evictions.mark(evictions.chats, chat_id, 0)
+    resident = tracemalloc.get_traced_memory()[0]
+    clock[0] = 7200
+    n_active = int(n_chats * active)
+    for c in range(n_active):
+        chat_id = -1 - c
+        evictions.mark(evictions.chats, chat_id, clock[0])
+        for i in range(players):
+            evictions.mark(evictions.users, c * players + i + 1, clock[0])
+    start = time.perf_counter()
+    evictions.sweep(dispatcher)
+    sweep = time.perf_counter() - start
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    evictions.touch(dispatcher, -n_chats, n_chats * players)
+    reload = time.perf_counter() - start
+    print("Eviction: {} chats of {} players, {:.0%} active".format(
+        n_chats, players, active))
+    print("  all resident:   {:7.1f} MB".format(resident / 2 ** 20))
+    print("  after eviction: {:7.1f} MB ({} chats, {} users resident)".format(
+        after / 2 ** 20, len(evictions.chats), len(evictions.users)))
+    print("  sweep took {:.1f} s under tracemalloc, on disk {:.1f} MB, reloading a chat "
+          "{:.2f} ms".format(sweep, os.path.getsize(path) / 2 ** 20,
+                             reload * 1000))
+    evictions.close()
+
+
+def bench_timers(n_timers=300000, seed=0):
+    """
+    Measures arming, re-arming and cancelling turn timers on the timing
+    wheel, and firing them, with hundreds of thousands outstanding.
+    """
+    random.seed(seed)
+    clock = [0]
+    wheel = timers.TimingWheel(clock=lambda: clock[0])
+    turn_timers = timers.TurnTimers(wheel)
+    delays = [random.randint(30, 600) for _ in range(n_timers)]
+    fired = []
+    print("Timers: {} chats".format(n_timers))
+    start = time.perf_counter()
+    for chat_id, delay in enumerate(delays):
+        turn_timers.arm(chat_id, delay, fired.append, chat_id)
+    elapsed = time.perf_counter() - start
+    print("  arm:    {:9.0f} timers/s".format(n_timers / elapsed))
+    start = time.perf_counter()
+    for chat_id, delay in enumerate(delays):
+        turn_timers.arm(chat_id, delay, fired.append, chat_id)
+    elapsed = time.perf_counter() - start
+    print("  re-arm: {:9.0f} timers/s (cancel + arm)".format(
+        n_timers / elapsed))
+    start = time.perf_counter()
+    for chat_id in range(0, n_timers, 2):
+        turn_timers.cancel(chat_id)
+    elapsed = time.perf_counter() - start
+    print("  cancel: {:9.0f} timers/s".format(n_timers / 2 / elapsed))
+    start = time.perf_counter()
+    for clock[0] in range(1, 601):
+        wheel.advance()
+    elapsed = time.perf_counter() - start
+    print("  fired {} timers over 600 ticks in {:.2f} s".format(
+        len(fired), elapsed))
+
+
+def bench_load(configs=((500, 0, 0), (100, 0.005, 0.01)), seed=5):
+    """
+    Plays full games in many chats through the local fake Bot API, with the
+    real bot polling it over HTTP, and reports command latency percentiles
+    and messages sent per second.
+
+    Each config is (chats, API latency in seconds, chance of a 429).
+    """
+    for n_chats, latency, flood_rate in configs:
+        random.seed(seed)
+        api = fakeapi.FakeBotAPI(
+            latency={"sendMessage": latency, "editMessageText": latency},
+            flood_rate=flood_rate, seed=seed).start()
+        updater = fakeapi.start_bot(api)
+        generator = fakeapi.LoadGenerator(api, updater.dispatcher, n_chats)
+        elapsed = generator.run()
+        updater.stop()
+        api.stop()
+        ended = sum(updater.dispatcher.chat_data[c]["game"].game_status ==
+                    "Ended" for c in generator.chat_ids)
+        p = generator.percentiles()
+        print("Load: {} chats, {:.0f} ms API latency, {:.0%} 429s".format(
+            n_chats, latency * 1000, flood_rate))
+        print("  {} commands in {:.1f} s, {} games finished, {} sends "
+              "refused with 429".format(generator.commands, elapsed, ended,
+                                        api.floods))
+        print("  latency p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms; "
+              "{:.0f} messages/s".format(p[50] * 1000, p[90] * 1000,
+                                         p[99] * 1000,
+                                         len(api.sent) / elapsed))
+
+
+def bench_topics(n_games=50, latency=0.005, seed=5):
+    """
+    Plays n_games at once through the fake Bot API with priority lanes,
+    first each in a chat of its own, then all in the forum topics of one
+    chat, and reports command latency. Then times finding an update's
+    game in a chat with 1 and with n_games topics.
+    """
+    for topics in (False, True):
+        random.seed(seed)
+        api = fakeapi.FakeBotAPI(
+            latency={"sendMessage": latency, "editMessageText": latency},
+            seed=seed).start()
+        updater = fakeapi.start_bot(api, lanes=True)
+        generator = fakeapi.LoadGenerator(api, updater.dispatcher, n_games,
+                                          topics=topics)
+        elapsed = generator.run()
+        updater.stop()
+        api.stop()
+        ended = sum(generator.game(t).game_status == "Ended"
+                    for t in generator.tables)
+        p = generator.percentiles()
+        print("Topics: {} games in {}".format(
+            n_games, "the topics of one chat" if topics else
+            "{} chats".format(n_games)))
+        print("  {} commands in {:.1f} s, {} games finished; latency p50 "
+              "{:.1f} ms, p99 {:.1f} ms".format(
+                  generator.commands, elapsed, ended, p[50] * 1000,
+                  p[99] * 1000))
+
+    bot = testing.FakeBot()
+    for n_topics in (1, n_games):
+        dispatcher = testing.make_dispatcher(bot)
+        for thread_id in range(1, n_topics + 1):
+            bot_module.table_data(dispatcher, -1, thread_id)["game"] = (
+                cg.Game())
+        update = telegram.Update.de_json(testing.make_update(
+            1, -1, 1, "/display", thread_id=n_topics), bot)
+        start = time.perf_counter()
+        for _ in range(100000):
+            context = bot_module.TableContext.from_update(update, dispatcher)
+            context.chat_data["game"]
+        elapsed = time.perf_counter() - start
+        print("  finding the game with {} topics: {:.2f} us per "
+              "update".format(n_topics, elapsed * 10))
+
+
+def bench_lanes(n_chats=20, latency=0.005, burst_rate=200, burst_size=1000,
+                seed=5):
+    """
+    Plays games through the fake Bot API while another group floods the bot
+    with burst_size /rules at burst_rate a second, and reports move latency
+    percentiles with and without priority lanes.
+
+    Without lanes, every update waits behind the burst on one thread. With
+    them, the info lane sheds what it can't keep up with and moves go
+    straight to their own workers.
+    """
+    runs = (("no burst", False, 0), ("burst, one thread", False, burst_rate),
+            ("burst, lanes", True, burst_rate))
+    for name, with_lanes, rate in runs:
+        random.seed(seed)
+        api = fakeapi.FakeBotAPI(
+            latency={"sendMessage": latency, "editMessageText": latency},
+            seed=seed).start()
+        updater = fakeapi.start_bot(api, lanes=with_lanes)
+        generator = fakeapi.LoadGenerator(api, updater.dispatcher, n_chats)
+        done = threading.Event()
+
+        def burst():
+            # One big group asking for the rules, from many users.
+            sent = 0
+            start = time.perf_counter()
+            while not done.is_set() and sent < burst_size:
+                due = min(burst_size,
+                          int((time.perf_counter() - start) * rate))
+                for _ in range(due - sent):
+                    api.push(testing.make_update(0, -10 ** 6, 10 ** 6 + sent,
+                                                 "/rules"))
+                    sent += 1
+                time.sleep(0.01)
+
+        thread = threading.Thread(target=burst, daemon=True)
+        thread.start()
+        elapsed = generator.run()
+        done.set()
+        thread.join()
+        updater.stop()
+        api.stop()
+        p = generator.percentiles()
+        shed = (updater.dispatcher.lanes[lanes.INFO].dropped
+                if with_lanes else 0)
+        print("Lanes: {}, {} chats, {:.0f} ms API latency, {} /rules a "
+              "second".format(name, n_chats, latency * 1000, rate))
+        print("  {} commands in {:.1f} s; move latency p50 {:.1f} ms, "
+              "p90 {:.1f} ms, p99 {:.1f} ms; {} /rules shed".format(
+                  generator.commands, elapsed, p[50] * 1000, p[90] * 1000,
+                  p[99] * 1000, shed))
+
+
+def bench_transport(sizes=(1, 4, 16, 64), n_threads=64, per_thread=20,
+                    latency=0.01):
+    """
+    Fans DMs out from many threads at once through the fake Bot API, and
+    reports throughput, connections opened and the split between waiting
+    for a connection and the request itself, for several pool sizes.
+
+    Plain Request, which opens a throwaway connection whenever its pool is
+    busy, is run first for comparison.
+    """
+    # Plain Request logs every connection it throws away.
+    logging.getLogger("telegram.vendor.ptb_urllib3").setLevel(logging.ERROR)
+    transports = [("Request(4)", lambda: Request(con_pool_size=4))]
+    transports += [("PooledRequest({})".format(size),
+                    lambda size=size: transport.PooledRequest(size))
+                   for size in sizes]
+    for name, make_request in transports:
+        api = fakeapi.FakeBotAPI(latency={"sendMessage": latency}).start()
+        request = make_request()
+        bot = telegram.Bot(api.token, base_url=api.base_url, request=request)
+
+        def send(user_id):
+            for i in range(per_thread):
+                bot.send_message(chat_id=user_id, text="Your hand: {}".format(
+                    i))
+
+        threads = [threading.Thread(target=send, args=(t + 1,))
+                   for t in range(n_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        api.stop()
+        print("Transport: {}, {} threads, {:.0f} ms API latency".format(
+            name, n_threads, latency * 1000))
+        line = "  {:.0f} messages/s, {} connections opened".format(
+            len(api.sent) / elapsed, api.connections)
+        if isinstance(request, transport.PooledRequest):
+            total = request.total()
+            line += ("; mean wait {:.1f} ms (max {:.0f}), mean request "
+                     "{:.1f} ms".format(total.wait / total.calls * 1000,
+                                        total.max_wait * 1000,
+                                        total.request / total.calls * 1000))
+        print(line)
+
+
+def bench_env(n_steps=100000, batch_sizes=(16, 256), players=5, seed=11):
+    """
+    Plays random legal actions through the environment wrapper and reports
+    steps per second for one CthulhuEnv and for VectorEnvs of several sizes.
+    """
+    rng = random.Random(seed)
+    single = env.CthulhuEnv(players, seed=seed)
+    start = time.perf_counter()
+    games = 0
+    for _ in range(n_steps):
+        _, _, done, _ = single.step(rng.choice(single.legal_actions()))
+        if done:
+            games += 1
+            single.reset()
+    elapsed = time.perf_counter() - start
+    print("Env: single, {} players".format(players))
+    print("  {:.0f} steps/s, {:.0f} games/s".format(n_steps / elapsed,
+                                                   games / elapsed))
+    for size in batch_sizes:
+        batch = env.VectorEnv(size, players, seed=seed)
+        start = time.perf_counter()
+        for _ in range(n_steps // size):
+            batch.step([rng.choice(actions)
+                        for actions in batch.legal_actions()])
+        elapsed = time.perf_counter() - start
+        print("Env: batch of {}, {} players".format(size, players))
+        print("  {:.0f} steps/s, {:.0f} games/s".format(
+            n_steps // size * size / elapsed, batch.episodes / elapsed))
+
+
+def bench_outbox(n_messages=2000, n_chats=200, ceiling=200, latency=0.02,
+                 flood_rates=(0.05, 0.2), retry_after=0.2):
+    """
+    Sends messages to many chats through the fake Bot API while it refuses
+    some with 429, and reports messages delivered and lost and throughput,
+    sending directly from four threads and through the Outbox.
+
+    The global budget is scaled up to `ceiling` messages a second so the
+    run stays short; each chat may send 5 a second.
+    """
+    messages = [(c % n_chats + 1, "message {}".format(c))
+                for c in range(n_messages)]
+    for flood_rate in flood_rates:
+        for name in ("direct", "outbox"):
+            api = fakeapi.FakeBotAPI(
+                latency={"sendMessage": latency}, flood_rate=flood_rate,
+                retry_after=retry_after, seed=12).start()
+            bot = telegram.Bot(api.token, base_url=api.base_url,
+                               request=transport.PooledRequest(16))
+            start = time.perf_counter()
+            if name == "direct":
+                lost = []
+
+                def send(part):
+                    for chat_id, text in part:
+                        try:
+                            bot.send_message(chat_id=chat_id, text=text)
+                        except telegram.error.RetryAfter:
+                            lost.append(chat_id)
+
+                threads = [threading.Thread(target=send,
+                                            args=(messages[i::4],))
+                           for i in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                n_lost = len(lost)
+            else:
+                box = outbox.Outbox(bot, rate=ceiling, burst=ceiling // 10,
+                                    chat_rate=5, chat_burst=3,
+                                    workers=int(ceiling * latency * 2))
+                for chat_id, text in messages:
+                    box.send(chat_id, text)
+                box.flush()
+                box.stop()
+                n_lost = box.failed
+            elapsed = time.perf_counter() - start
+            api.stop()
+            print("Outbox: {}, {:.0%} 429s, ceiling {}/s".format(
+                name, flood_rate, ceiling))
+            print("  {} delivered, {} lost, {} 429s, {:.0f} messages/s".format(
+                len(api.sent), n_lost, api.floods, len(api.sent) / elapsed))
+
+
+def bench_keyboards(n_games=200, players=5, mistake_rate=0.2, seed=6):
+    """
+    Counts the messages the bot sends per finished game when moves are
+    typed and when they're pressed on buttons.
+
+    Typists get a move wrong at the given rate, costing an error message.
+    Button users press a stale or someone else's button at the same rate,
+    which is answered with a notification instead of a message.
+    """
+    print("Keyboards: {} games of {} players, {:.0%} mistakes".format(
+        n_games, players, mistake_rate))
+    mistakes = {"/claim": "/claim lots", "/investigate": "/investigate nobody"}
+    for buttons in (False, True):
+        random.seed(seed)
+        dispatcher = testing.make_dispatcher()
+        counter = itertools.count()
+        messages = 0
+        for g in range(n_games):
+            chat_id = -1 - g
+            users = [g * players + i + 1 for i in range(players)]
+            send = lambda c, u, t: testing.process(
+                dispatcher, testing.make_update(next(counter), c, u, t))
+            press = lambda c, u, d: testing.process(
+                dispatcher, testing.make_callback(next(counter), c, u, d))
+            testing.play_game(send, lambda c: dispatcher.chat_data[c]["game"],
+                              chat_id, users, max_moves=0)
+            game = dispatcher.chat_data[chat_id]["game"]
+            stale = None
+            while True:
+                if buttons:
+                    move = testing.next_button(
+                        game, dispatcher.bot.keyboards[chat_id])
+                else:
+                    move = testing.next_move(game)
+                if move is None:
+                    break
+                user_id, action = move
+                if random.random() < mistake_rate:
+                    if buttons:
+                        press(chat_id, user_id, stale or action[:-1] + "A")
+                    else:
+                        send(chat_id, user_id,
+                             mistakes[action.split()[0]])
+                if buttons:
+                    press(chat_id, user_id, action)
+                    stale = action
+                else:
+                    send(chat_id, user_id, action)
+        per_game = len(dispatcher.bot.sent) / n_games
+        print("  {:7}: {:5.1f} messages per game, {} button presses "
+              "answered".format("buttons" if buttons else "typed",
+                                per_game, len(dispatcher.bot.answered)))
+
+
+def bench_ratelimit(flood=10, delay=0.001, seed=7):
+    """
+    Times replies in a normal game while another chat floods the bot.
+
+    Before each of the game's commands, a user in the flooding chat sends
+    `flood` /blame commands, which a single worker has to get through
+    first. Each game command's latency counts from when it arrived, ahead
+    of that flood, to when its handlers finished. The fake bot takes
+    `delay` seconds per message, and the rate limiter's clock moves a
+    second per game command, as if people were typing.
+    """
+    print("Rate limits: {} flood commands per game command, fake bot "
+          "latency {:.0f} ms per message".format(flood, delay * 1000))
+    for label, n_flood, limited in (("no flood", 0, False),
+                                    ("flood, no limits", flood, False),
+                                    ("flood, limits", flood, True)):
+        random.seed(seed)
+        dispatcher = testing.make_dispatcher(testing.FakeBot(delay=delay))
+        clock = [0]
+        if limited:
+            limiter = ratelimit.RateLimiter(clock=lambda: clock[0])
+            dispatcher.bot_data["rate_limiter"] = limiter
+        counter = itertools.count()
+        latencies = []
+        flooding = [False]
+
+        def send(chat_id, user_id, text):
+            clock[0] += 1
+            start = time.perf_counter()
+            if flooding[0]:
+                for _ in range(n_flood):
+                    testing.process(dispatcher, testing.make_update(
+                        next(counter), -666, 666, "/blame"))
+            testing.process(dispatcher, testing.make_update(
+                next(counter), chat_id, user_id, text))
+            latencies.append(time.perf_counter() - start)
+        testing.process(dispatcher, testing.make_update(
+            next(counter), -666, 666, "/newgame"))
+        send(-1, 1, "/newgame")
+        flooding[0] = True
+        latencies.clear()
+        testing.play_game(send, lambda c: dispatcher.chat_data[c]["game"],
+                          -1, [1, 2, 3, 4, 5])
+        latencies.sort()
+        flood_messages = len(dispatcher.bot.messages_for(-666))
+        print("  {:16}: median reply {:5.1f} ms, worst {:5.1f} ms; {} "
+              "messages to the flooder{}".format(
+                  label, latencies[len(latencies) // 2] * 1000,
+                  latencies[-1] * 1000, flood_messages,
+                  ", {} commands dropped".format(limiter.dropped)
+                  if limited else ""))
+
+
+def bench_matchmaking(rates=(0.05, 0.2, 1, 5), n_players=20000,
+                      preferring=0.5, check_every=5, seed=8):
+    """
+    Simulates the matchmaking queue with players arriving at random at each
+    rate (players a second), some wanting a particular game size. Reports
+    how long players wait and how big their games are, and the time per
+    queue operation with the whole queue waiting.
+    """
+    print("Matchmaking: {} players each, {:.0%} with a preferred size".format(
+        n_players, preferring))
+    for rate in rates:
+        rng = random.Random(seed)
+        clock = [0]
+        matchmaker = matchmaking.Matchmaker(clock=lambda: clock[0])
+        arrived = {}
+        waits = []
+        sizes = []
+        next_check = check_every
+
+        def form():
+            while True:
+                user_ids = matchmaker.match()
+                if user_ids is None:
+                    return
+                sizes.append(len(user_ids))
+                waits.extend(clock[0] - arrived.pop(u) for u in user_ids)
+        start = time.perf_counter()
+        for user_id in range(n_players):
+            clock[0] += rng.expovariate(rate)
+            while next_check <= clock[0]:
+                # The periodic check, run at its own time.
+                now, clock[0] = clock[0], next_check
+                form()
+                clock[0] = now
+                next_check += check_every
+            arrived[user_id] = clock[0]
+            size = None
+            if rng.random() < preferring:
+                size = rng.randint(matchmaker.min_players,
+                                   matchmaker.max_players)
+            matchmaker.join(user_id, size)
+            form()
+        elapsed = time.perf_counter() - start
+        waits.sort()
+        print("  {:5} a second: mean wait {:6.1f} s, p90 {:6.1f} s, mean "
+              "game {:4.1f} players; {:.1f} us per player".format(
+                  rate, sum(waits) / len(waits), waits[len(waits) * 9 // 10],
+                  sum(sizes) / len(sizes), elapsed / n_players * 1e6))
+    # While every lobby is busy the queue only grows, and has to be drained
+    # once one frees up.
+    for queued in (1000, 100000):
+        rng = random.Random(seed)
+        matchmaker = matchmaking.Matchmaker(clock=lambda: 0)
+        start = time.perf_counter()
+        for user_id in range(queued):
+            size = None
+            if rng.random() < preferring:
+                size = rng.randint(matchmaker.min_players,
+                                   matchmaker.max_players)
+            matchmaker.join(user_id, size)
+        joined = time.perf_counter()
+        for user_id in rng.sample(range(queued), queued // 10):
+            matchmaker.leave(user_id)
+        left = time.perf_counter()
+        games = 0
+        while matchmaker.match() is not None:
+            games += 1
+        drained = time.perf_counter()
+        print("  {:6} queued: {:.2f} us per join, {:.2f} us per leave, "
+              "{:.2f} us per game formed".format(
+                  queued, (joined - start) / queued * 1e6,
+                  (left - joined) / (queued // 10) * 1e6,
+                  (drained - left) / games * 1e6))
+
+
+def bench_webfeed(n_viewers=1000, players=6, seed=9):
+    """
+    Streams a game to many web viewers, as deltas and as whole states, and
+    measures the bytes written and the process's CPU time per move. The
+    viewers are raw sockets read by one thread in this process, so the CPU
+    time includes reading.
+    """
+    print("Web feed: {} viewers, {} players".format(n_viewers, players))
+    for full in (True, False):
+        random.seed(seed)
+        feed = webfeed.WebFeed(full=full).start()
+        game = cg.Game()
+        for i in range(players):
+            game.add_player(cg.Player(i + 1, nickname="P{}".format(i + 1)))
+        game.start_game()
+        feed.publish(-1, game)
+        selector = selectors.DefaultSelector()
+        received = [0]
+        for _ in range(n_viewers):
+            viewer = socket.create_connection(feed.server.server_address)
+            viewer.sendall(b"GET /games/-1 HTTP/1.1\r\nHost: x\r\n\r\n")
+            viewer.setblocking(False)
+            selector.register(viewer, selectors.EVENT_READ)
+
+        def read_until(total):
+            while received[0] < total:
+                for key, _ in selector.select(timeout=5):
+                    received[0] += len(key.fileobj.recv(1 << 16))
+
+        # Everyone connects and gets the whole state first.
+        first = len(webfeed.encode_event("state", webfeed.game_state(game)))
+        while feed.bytes_sent < first * n_viewers:
+            time.sleep(0.01)
+        read_until(feed.bytes_sent)
+        start_bytes, start_received = feed.bytes_sent, received[0]
+        start_cpu, start = time.process_time(), time.perf_counter()
+        moves = 0
+        while game.game_status == "Ongoing":
+            player = game.get_current_player()
+            if game.phase == "Claims":
+                titles = [card.title for card in player.game_data.cards]
+                game.set_claim(player, len(titles) -
+                               titles.count("Elder Sign") -
+                               titles.count("Cthulhu"),
+                               titles.count("Elder Sign"),
+                               titles.count("Cthulhu"))
+            else:
+                game.investigate(player, random.choice(
+                    [p for p in game.get_active_players() if p is not player
+                     and any(not c.is_flipped for c in p.game_data.cards)]))
+            feed.publish(-1, game)
+            moves += 1
+            read_until(start_received + feed.bytes_sent - start_bytes)
+        cpu = time.process_time() - start_cpu
+        elapsed = time.perf_counter() - start
+        print("  {:6}: {:7.0f} bytes per move, {:5.1f} ms CPU per move, "
+              "{:5.1f} ms to reach everyone".format(
+                  "states" if full else "deltas",
+                  (feed.bytes_sent - start_bytes) / moves, cpu / moves * 1000,
+                  elapsed / moves * 1000))
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+        feed.stop()
+
+
+def bench_codec(player_counts=(4, 10), repeats=2000, seed=10):
+    """
+    Compares the binary codec with pickle for a game partway through its
+    first round, in size and in microseconds to encode and decode.
+    """
+    print("Codec: games with Objects of Power, after a round of claims")
+    for n_players in player_counts:
+        random.seed(seed)
+        game = cg.Game()
+        game.game_settings.expansions = [cg.OBJECTS_OF_POWER]
+        for i in range(n_players):
+            game.add_player(cg.Player(i + 1, nickname="P{}".format(i + 1)))
+        game.start_game()
+        for _ in range(n_players + 2):
+            move = testing.next_move(game)
+            player = game.get_current_player()
+            if game.phase == "Claims":
+                game.set_claim(player, 3, 1, 0)
+            else:
+                seat = int(move[1].split()[1])
+                game.investigate(player, game.get_active_players()[seat - 1])
+        data = {"game": game}
+        for name, dumps, loads in (
+                ("pickle", lambda d: pickle.dumps(d, pickle.HIGHEST_PROTOCOL),
+                 pickle.loads),
+                ("codec", codec.dumps, codec.loads)):
+            blob = dumps(data)
+            start = time.perf_counter()
+            for _ in range(repeats):
+                dumps(data)
+            encoded = time.perf_counter()
+            for _ in range(repeats):
+                loads(blob)
+            decoded = time.perf_counter()
+            print("  {:2} players, {:6}: {:5} bytes, {:6.1f} us to encode, "
+                  "{:6.1f} us to decode".format(
+                      n_players, name, len(blob),
+                      (encoded - start) / repeats * 1e6,
+                      (decoded - encoded) / repeats * 1e6))
+
+
+def bench_report(n_games=200, players=10, seed=12):
+    """
+    Compares streaming the end-of-game report with building it whole and
+    then splitting it, for 10-player games played to the end by players
+    with long names: peak memory while rendering, and the time until the
+    first message could be sent.
+    """
+    random.seed(seed)
+    games = []
+    for g in range(n_games):
+        game = cg.Game()
+        for i in range(players):
+            game.add_player(cg.Player(g * players + i + 1,
+                                      nickname="\U0001F419 Player" * 16 +
+                                      str(i)))
+        game.start_game()
+        while game.game_status == "Ongoing":
+            move = testing.next_move(game)
+            if move is None:
+                game.end_game()
+                break
+            player = game.get_current_player()
+            if game.phase == "Claims":
+                blank, elder, cthulhu = cg.parse_claim(
+                    move[1].split()[1:], len(player.game_data.cards))
+                game.set_claim(player, blank, elder, cthulhu)
+            else:
+                seat = int(move[1].split()[1])
+                game.investigate(player, game.get_active_players()[seat - 1])
+        games.append(game)
+
+    def streamed(game):
+        return game.get_log()
+
+    def whole(game):
+        text = "\n".join(game.report_lines())
+        return cg.chunk_lines(text.split("\n"))
+
+    print("Report: {} games of {} players with {}-character names, timed "
+          "under tracemalloc".format(
+        n_games, players, len(games[0].players[0].nickname)))
+    for name, render in (("whole", whole), ("streamed", streamed)):
+        first = total = peak = 0
+        chunks = 0
+        for game in games:
+            tracemalloc.start()
+            start = time.perf_counter()
+            messages = iter(render(game))
+            next(messages)
+            first += time.perf_counter() - start
+            for _ in messages:
+                chunks += 1
+            total += time.perf_counter() - start
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        print("  {:8}: {:.1f} messages a game, peak {:6.1f} KB, first "
+              "message {:6.1f} us, whole report {:6.1f} us".format(
+                  name, chunks / n_games + 1, peak / 2 ** 10,
+                  first / n_games * 1e6, total / n_games * 1e6))
+
+
+def bench_broadcast(n_chats=100000, evicted=0.9, ceiling=2000, latency=0.005,
+                    window=32):
+    """
+    Broadcasts to every chat through the outbox and the fake Bot API, with
+    most chats evicted to disk, stopping halfway and resuming from the
+    checkpoint. Reports how fast chats are found, how fast they're
+    messaged, and how many got the message twice.
+
+    The global budget is scaled up to `ceiling` messages a second so the
+    run stays short.
+    """
+    dispatcher = testing.make_dispatcher()
+    directory = tempfile.TemporaryDirectory()
+    evictions = eviction.EvictionManager(
+        os.path.join(directory.name, "evicted.sqlite"))
+    dispatcher.bot_data["evictions"] = evictions
+    for c in range(n_chats):
+        chat_id = -1 - c
+        dispatcher.chat_data[chat_id]["game"] = cg.Game()
+        if random.random() < evicted:
+            evictions.evict(dispatcher.chat_data, "chat", chat_id)
+    evictions.db.commit()
+    tracemalloc.start()
+    start = time.perf_counter()
+    found = sum(1 for _ in broadcast.chat_ids(dispatcher))
+    listed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("Broadcast: {} chats, {:.0%} evicted, ceiling {}/s, {:.0f} ms API "
+          "latency".format(n_chats, evicted, ceiling, latency * 1000))
+    print("  found {} chats in {:.2f} s, peak {:.1f} MB while listing".format(
+        found, listed, peak / 2 ** 20))
+    api = fakeapi.FakeBotAPI(latency={"sendMessage": latency}).start()
+    dispatcher.bot = telegram.Bot(api.token, base_url=api.base_url,
+                                  request=transport.PooledRequest(window))
+    box = dispatcher.bot_data["outbox"] = outbox.Outbox(
+        dispatcher.bot, rate=ceiling, burst=ceiling // 10, workers=window)
+    path = os.path.join(directory.name, "broadcast.json")
+    start = time.perf_counter()
+    first = broadcast.Broadcast(dispatcher, "Maintenance at noon.", path,
+                                window=window).start()
+    while first.sent < n_chats // 2:
+        time.sleep(0.01)
+    first.stop()
+    box.flush()
+    second = broadcast.Broadcast.resume(dispatcher, path, window=window)
+    second.start().thread.join()
+    elapsed = time.perf_counter() - start
+    box.stop()
+    api.stop()
+    evictions.close()
+    directory.cleanup()
+    print("  {} delivered in {:.1f} s, {:.0f} messages/s; {} failed, {} sent "
+          "twice after resuming".format(len(api.sent), elapsed,
+                                        len(api.sent) / elapsed,
+                                        second.failed,
+                                        len(api.sent) - second.sent))
+
+
+def bench_archive(n_games=1000000, n_users=100000, played=200, queries=1000,
+                  seed=13):
+    """
+    Appends finished games to an archive, then answers users' /history from
+    the player index and, for comparison, by scanning every record. Reports
+    appends a second, the archive's size and opening time, and query
+    latency.
+
+    A few hundred games are really played and then archived over and over
+    with their seats given to random users.
+    """
+    random.seed(seed)
+    games = []
+    for g in range(played):
+        game = cg.Game()
+        for i in range(random.randint(4, 8)):
+            game.add_player(cg.Player(i + 1))
+        game.start_game()
+        while game.game_status == "Ongoing":
+            move = testing.next_move(game)
+            if move is None:
+                game.end_game()
+                break
+            player = game.get_current_player()
+            if game.phase == "Claims":
+                game.set_claim(player, *cg.parse_claim(
+                    move[1].split()[1:], len(player.game_data.cards)))
+            else:
+                seat = int(move[1].split()[1])
+                game.investigate(player, game.get_active_players()[seat - 1])
+        games.append(game)
+    directory = tempfile.TemporaryDirectory()
+    store = archive.Archive(directory.name)
+    start = time.perf_counter()
+    for g in range(n_games):
+        game = games[g % played]
+        for player, user_id in zip(game.players, random.sample(
+                range(1, n_users + 1), len(game.players))):
+            player.p_id = user_id
+        store.append(game, -1 - g % 1000, ended=g)
+    appended = time.perf_counter() - start
+    store.close()
+    size = sum(os.path.getsize(os.path.join(directory.name, name))
+               for name in os.listdir(directory.name))
+    start = time.perf_counter()
+    store = archive.Archive(directory.name)
+    opened = time.perf_counter() - start
+    users = random.sample(range(1, n_users + 1), queries)
+    start = time.perf_counter()
+    for user_id in users:
+        store.history(user_id)
+    indexed = (time.perf_counter() - start) / queries
+    start = time.perf_counter()
+    user_id = users[0]
+    scanned = [record for record in store.scan()
+               if any(seat.user_id == user_id for seat in record.seats)][-10:]
+    scan = time.perf_counter() - start
+    assert [r.number for r in reversed(scanned)] == [
+        r.number for r in store.history(user_id)]
+    store.close()
+    directory.cleanup()
+    print("Archive: {} games, {} users".format(n_games, n_users))
+    print("  {:.0f} appends/s, {:.1f} MB on disk ({} bytes a game), "
+          "opened in {:.2f} s".format(n_games / appended, size / 2 ** 20,
+                                      archive.RECORD_SIZE, opened))
+    print("  /history from the index {:.1f} us, by scanning every record "
+          "{:.1f} s".format(indexed * 1e6, scan))
+
+
+def bench_analytics(n_games=3000000, played=1000, n_users=200000,
+                    baseline=100000, seed=14):
+    """
+    Runs every analysis over millions of archived games and exports the
+    CSVs, and compares win rates by flashlight with working them out
+    record by record in Python, on the first `baseline` games.
+
+    A thousand games are really played and archived; their records are
+    then repeated, with random users in the seats, to fill the archive.
+    """
+    # NumPy is only needed for analytics.
+    import numpy as np
+    import cthulhu_analytics as analytics
+
+    random.seed(seed)
+    directory = tempfile.TemporaryDirectory()
+    store = archive.Archive(directory.name)
+    for g in range(played):
+        game = cg.Game()
+        for i in range(random.randint(4, 10)):
+            game.add_player(cg.Player(i + 1))
+        for i in range(random.choice((0, 0, 1, 3))):
+            game.add_player(cg.Player(100 + i), is_playing=False)
+        game.start_game()
+        while game.game_status == "Ongoing":
+            move = testing.next_move(game)
+            if move is None:
+                game.end_game()
+                break
+            player = game.get_current_player()
+            if game.phase == "Claims":
+                blank, elder, cthulhu = cg.parse_claim(
+                    move[1].split()[1:], len(player.game_data.cards))
+                if random.random() < 0.3 and blank:
+                    # Some players bluff an Elder Sign.
+                    blank, elder = blank - 1, elder + 1
+                game.set_claim(player, blank, elder, cthulhu)
+            else:
+                seat = int(move[1].split()[1])
+                game.investigate(player, game.get_active_players()[seat - 1])
+        store.append(game, -1 - g)
+    view, count = store.views()[0]
+    real = np.frombuffer(view, analytics.RECORD, count,
+                         archive.FILE_HEADER.size).copy()
+    store.close()
+    for name in os.listdir(directory.name):
+        os.remove(os.path.join(directory.name, name))
+    rng = np.random.default_rng(seed)
+    header = archive.FILE_HEADER.pack(archive.MAGIC, archive.FORMAT_VERSION,
+                                      archive.RECORD_SIZE, archive.SEATS)
+    for number, start in enumerate(range(0, n_games,
+                                         archive.SEGMENT_RECORDS)):
+        size = min(archive.SEGMENT_RECORDS, n_games - start)
+        records = real[rng.integers(0, played, size)]
+        records["seats"]["user_id"] = rng.integers(1, n_users + 1,
+                                                   (size, archive.SEATS))
+        with open(os.path.join(directory.name,
+                               "games-{:05}.seg".format(number)), "wb") as f:
+            f.write(header)
+            records.tofile(f)
+    start = time.perf_counter()
+    outcomes = analytics.load(directory.name)
+    loaded = time.perf_counter() - start
+    times = {}
+    for name, table in analytics.TABLES.items():
+        start = time.perf_counter()
+        table(outcomes)
+        times[name] = time.perf_counter() - start
+    start = time.perf_counter()
+    analytics.export(outcomes, os.path.join(directory.name, "csv"))
+    exported = time.perf_counter() - start
+    segment = archive.Segment(os.path.join(directory.name, "games-00000.seg"))
+    view = segment.view()
+    baseline = min(baseline, segment.count)
+    start = time.perf_counter()
+    games, won = collections.Counter(), collections.Counter()
+    for number in range(baseline):
+        record = archive.decode_record(
+            view, archive.FILE_HEADER.size + number * archive.RECORD_SIZE,
+            number)
+        if record.winner is None:
+            continue
+        for number, seat in enumerate(record.seats):
+            group = (len(record.seats), seat.role,
+                     record.first_flashlight == number)
+            games[group] += 1
+            won[group] += seat.role == record.winner
+    python = (time.perf_counter() - start) / baseline * n_games
+    segment.close()
+    directory.cleanup()
+    print("Analytics: {} games, {} seats".format(len(outcomes),
+                                                  len(outcomes.seat)))
+    print("  loaded in {:.2f} s, exported every CSV in {:.2f} s".format(
+        loaded, exported))
+    print("  " + ", ".join("{} {:.2f} s".format(name, t)
+                           for name, t in times.items()))
+    print("  win rates by flashlight record by record: {:.0f} s "
+          "(extrapolated from {} games)".format(python, baseline))
+
+
+BENCHMARKS = {
+    "sharding": bench_sharding,
+    "expansions": bench_expansions,
+    "ruleset": bench_ruleset,
+    "names": bench_names,
+    "spectators": bench_spectators,
+    "eviction": bench_eviction,
+    "timers": bench_timers,
+    "load": bench_load,
+    "lanes": bench_lanes,
+    "topics": bench_topics,
+    "transport": bench_transport,
+    "env": bench_env,
+    "outbox": bench_outbox,
+    "keyboards": bench_keyboards,
+    "ratelimit": bench_ratelimit,
+    "matchmaking": bench_matchmaking,
+    "webfeed": bench_webfeed,
+    "codec": bench_codec,
+    "report": bench_report,
+    "broadcast": bench_broadcast,
+    "archive": bench_archive,
+    "analytics": bench_analytics,
+}
+
+
+def main():
+    """
+    Runs the benchmarks named on the command line, or all of them.
+    """
+    logging.basicConfig(level=logging.ERROR)
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+This module sends an admin's announcement to every chat with a game.
+
+There's no registry of chats: the resident ones are dispatcher.chat_data's
+keys and the rest are on disk with the EvictionManager. chat_ids() streams
+both in order of chat id, a page at a time, so a broadcast never holds
+every chat at once and its progress is a single id.
+
+A Broadcast sends from a thread of its own through the bot's Outbox, which
+keeps it under Telegram's global limit. It only keeps `window` messages
+queued there at a time, so the bot's game messages never wait behind
+thousands of announcements.
+
+Progress is checkpointed to a JSON file: the text and the id of the last
+chat such that it and every chat before it are done. After a restart,
+resume() carries on from there. stop() lets the messages in flight finish
+first, so only a crash can make up to `window` chats get the message
+twice.
+"""
+import collections
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+
+import cthulhu_codec
+import cthulhu_outbox
+
+
+def resident_chat_ids(dispatcher, after=None, page_size=1000):
+    """
+    Yields the ids of chats in memory with a game, in order, starting after
+    a given id. Each page takes one pass over chat_data's keys.
+    """
+    while True:
+        page = heapq.nsmallest(page_size, (
+            chat_id for chat_id in list(dispatcher.chat_data)
+            if (after is None or chat_id > after) and
+            cthulhu_codec.chat_games(dispatcher.chat_data.get(chat_id, {}))))
+        yield from page
+        if len(page) < page_size:
+            return
+        after = page[-1]
+
+
+def chat_ids(dispatcher, after=None, page_size=1000):
+    """
+    Yields the id of every chat with a game once, in order, whether it's in
+    memory or evicted, starting after a given id.
+    """
+    sources = [resident_chat_ids(dispatcher, after, page_size)]
+    evictions = dispatcher.bot_data.get("evictions")
+    if evictions is not None:
+        sources.append(evictions.chat_ids(after, page_size))
+    last = after
+    for chat_id in heapq.merge(*sources):
+        # A chat evicted or reloaded mid-broadcast may turn up in both.
+        if chat_id != last:
+            last = chat_id
+            yield chat_id
+
+
+class Broadcast:
+    """
+    Sends one message to every chat with a game.
+
+    Attributes:
+      text - the message.
+      path - the checkpoint file, or None.
+      after - every chat up to and including this id is done with.
+      sent - the number of messages delivered.
+      failed - the number of chats that couldn't be messaged, such as ones
+        that removed the bot.
+      started, finished - when the broadcast started and finished, by the
+        clock.
+    """
+
+    def __init__(self, dispatcher, text, path=None, after=None, sent=0,
+                 failed=0, window=8, page_size=1000, checkpoint_every=1.0,
+                 clock=time.monotonic):
+        """
+        Arguments:
+          dispatcher - the dispatcher whose chats to message.
+          text - the message.
+          path - Optional. Where to checkpoint progress.
+          after, sent, failed - where to carry on from, if resuming.
+          window - the most messages to have queued at once.
+          page_size - the chat ids to read at a time.
+          checkpoint_every - the fewest seconds between two checkpoints.
+        """
+        self.dispatcher = dispatcher
+        self.text = text
+        self.path = path
+        self.after = after
+        self.sent = sent
+        self.failed = failed
+        # Resumed broadcasts count their rate from where they carried on.
+        self.resumed_at = sent + failed
+        self.window = window
+        self.page_size = page_size
+        self.checkpoint_every = checkpoint_every
+        self.clock = clock
+        self.started = self.finished = None
+        self.last_checkpoint = None
+        # Chat ids queued, oldest first, each with whether it's done.
+        self.pending = collections.OrderedDict()
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    @classmethod
+    def resume(cls, dispatcher, path, **kwargs):
+        """
+        Returns the unfinished broadcast checkpointed at path, or None.
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            state = json.load(f)
+        if state.get("done"):
+            return None
+        return cls(dispatcher, state["text"], path, state["after"],
+                   state["sent"], state["failed"], **kwargs)
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        self.started = self.clock()
+        self.checkpoint()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name="broadcast")
+        self.thread.start()
+        return self
+
+    def run(self):
+        """
+        Queues the message for every chat, then waits for the last ones.
+        """
+        outbox = self.dispatcher.bot_data.get("outbox")
+        own = outbox is None
+        if own:
+            outbox = cthulhu_outbox.Outbox(self.dispatcher.bot)
+        try:
+            for chat_id in chat_ids(self.dispatcher, self.after,
+                                    self.page_size):
+                with self.condition:
+                    self.condition.wait_for(
+                        lambda: len(self.pending) < self.window or
+                        self.stopped)
+                    if self.stopped:
+                        return
+                    self.pending[chat_id] = False
+                outbox.send(chat_id, self.text, on_done=self.on_done)
+                self.maybe_checkpoint()
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: not self.pending or self.stopped)
+                if self.stopped:
+                    return
+            self.finished = self.clock()
+            self.checkpoint(done=True)
+            logging.info("Broadcast to %d chats in %.0f s, %d failed.",
+                         self.sent + self.failed,
+                         self.finished - self.started, self.failed)
+        finally:
+            if own:
+                outbox.flush()
+                outbox.stop()
+
+    def on_done(self, chat_id, delivered):
+        """
+        Records a message sent or dropped, moving `after` past every chat
+        done with.
+        """
+        with self.condition:
+            if delivered:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self.pending[chat_id] = True
+            while self.pending:
+                first, done = next(iter(self.pending.items()))
+                if not done:
+                    break
+                self.after = first
+                del self.pending[first]
+            self.condition.notify_all()
+
+    def maybe_checkpoint(self):
+        if self.clock() - self.last_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self, done=False):
+        """
+        Writes the progress to the checkpoint file, replacing it whole so
+        that a crash midway never leaves half of one.
+        """
+        self.last_checkpoint = self.clock()
+        if self.path is None:
+            return
+        with self.condition:
+            state = {"text": self.text, "after": self.after,
+                     "sent": self.sent, "failed": self.failed, "done": done}
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def stop(self, timeout=10):
+        """
+        Stops queueing messages, waits up to timeout seconds for those
+        already queued, and checkpoints, so the broadcast can be resumed
+        later.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending, timeout)
+        self.checkpoint()
+
+    def status(self):
+        """
+        Returns a line on how the broadcast is going.
+        """
+        with self.condition:
+            done = self.sent + self.failed
+        end = self.clock() if self.finished is None else self.finished
+        elapsed = end - self.started if self.started is not None else 0
+        rate = (done - self.resumed_at) / elapsed if elapsed else 0
+        return "{}: {} chats in {:.0f} s, {:.0f} a second; {} couldn't be " \
+               "messaged.".format(
+                   "Broadcasting" if self.finished is None else "Broadcast "
+                   "finished", done, elapsed, rate, self.failed)
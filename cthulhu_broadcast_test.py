@@ -0,0 +1,117 @@
+from cthulhu_broadcast import *
+import cthulhu_eviction
+import cthulhu_game as cg
+import cthulhu_outbox
+import cthulhu_testing as testing
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+
+class StallingBot(testing.FakeBot):
+    """
+    A FakeBot that stalls after a number of messages until released.
+    """
+
+    def __init__(self, stall_after):
+        super().__init__()
+        self.stall_after = stall_after
+        self.release = threading.Event()
+
+    def send_message(self, chat_id, text, **kwargs):
+        if len(self.sent) >= self.stall_after:
+            self.release.wait()
+        return super().send_message(chat_id, text, **kwargs)
+
+
+class TestBroadcast(unittest.TestCase):
+    """
+    Tests finding every chat with a game and messaging each of them once.
+    """
+
+    def setUp(self):
+        self.dispatcher = testing.make_dispatcher()
+        self.evictions = cthulhu_eviction.EvictionManager(":memory:")
+        self.dispatcher.bot_data["evictions"] = self.evictions
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "broadcast.json")
+
+    def tearDown(self):
+        self.evictions.close()
+        self.dir.cleanup()
+
+    def add_chats(self, chat_ids, evicted=False):
+        for chat_id in chat_ids:
+            self.dispatcher.chat_data[chat_id]["game"] = cg.Game()
+            if evicted:
+                self.evictions.evict(self.dispatcher.chat_data, "chat",
+                                     chat_id)
+
+    def test_chat_ids(self):
+        """
+        Resident and evicted chats come in order, chats without a game are
+        skipped, and a topic's game counts for its chat.
+        """
+        self.add_chats(range(-50, 0, 3))
+        self.add_chats(range(-49, 0, 3), evicted=True)
+        self.dispatcher.chat_data[7]["player_count"] = 1
+        self.evictions.evict(self.dispatcher.chat_data, "chat", 7)
+        self.dispatcher.chat_data[8]["topics"] = {2: {"game": cg.Game()}}
+        expected = sorted(list(range(-50, 0, 3)) + list(range(-49, 0, 3)) +
+                          [8])
+        self.assertEqual(list(chat_ids(self.dispatcher, page_size=4)),
+                         expected)
+        self.assertEqual(list(chat_ids(self.dispatcher, -20, page_size=3)),
+                         [c for c in expected if c > -20])
+
+    def test_broadcast(self):
+        """
+        Every chat gets the message once, and the checkpoint says so.
+        """
+        self.add_chats(range(1, 31))
+        self.add_chats(range(31, 61), evicted=True)
+        broadcast = Broadcast(self.dispatcher, "Back soon!", self.path)
+        broadcast.start().thread.join(timeout=60)
+        self.assertEqual(sorted(self.dispatcher.bot.messages_for(c)[0]
+                                for c in range(1, 61)), ["Back soon!"] * 60)
+        self.assertEqual(len(self.dispatcher.bot.sent), 60)
+        with open(self.path) as f:
+            state = json.load(f)
+        self.assertEqual(state["after"], 60)
+        self.assertTrue(state["done"])
+        self.assertIsNone(Broadcast.resume(self.dispatcher, self.path))
+
+    def test_resume(self):
+        """
+        A broadcast cut short carries on from its checkpoint, re-sending at
+        most the messages that were in flight.
+        """
+        self.add_chats(range(1, 301))
+        bot = self.dispatcher.bot = StallingBot(120)
+        outbox = self.dispatcher.bot_data["outbox"] = cthulhu_outbox.Outbox(
+            bot, rate=1000, burst=1000, workers=2)
+        try:
+            broadcast = Broadcast(self.dispatcher, "Back soon!", self.path,
+                                  window=4).start()
+            while len(bot.sent) < 120:
+                broadcast.thread.join(timeout=0.01)
+            # As if the bot crashed with messages in flight.
+            broadcast.stop(timeout=0)
+            bot.release.set()
+            outbox.flush()
+            resumed = Broadcast.resume(self.dispatcher, self.path, window=4)
+            self.assertGreaterEqual(resumed.after, 116)
+            self.assertLessEqual(resumed.after, 120)
+            resumed.start().thread.join(timeout=60)
+        finally:
+            outbox.stop()
+        chats = [chat_id for chat_id, _ in bot.sent]
+        self.assertEqual(sorted(set(chats)), list(range(1, 301)))
+        self.assertLessEqual(len(chats), 300 + 4)
+        self.assertEqual(resumed.sent, 300)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains a compact binary format for games and players, used
+wherever their state leaves the process (eviction to disk, shard handoff).
+
+A pickled Game carries every Card's title, description and emoji, and every
+class and attribute name. Here a card is one byte: its type's code shifted
+left, with the low bit set if it's face-up. Seats, claims and counters are
+packed with struct, and players in the flashlight lock or Insanity's Grasp
+are stored as seat numbers.
+
+The format is versioned and forward-compatible. Every record is a list of
+sections, each a tag, a length and a payload:
+  - a decoder skips sections with tags it doesn't know, so newer writers
+    can add sections;
+  - a decoder keeps the defaults for sections that are missing, so older
+    blobs still load;
+  - a section may grow at its end, and decoders ignore the extra bytes.
+A new field goes at the end of a section or in a new section; existing
+fields are never moved or reused. Card, role and expansion codes are only
+ever appended to.
+
+A forum chat's topics each have a chat_data of their own, under the chat's
+TOPICS_KEY; they're encoded the same way, one blob per topic.
+
+Games use the random module rather than an RNG of their own, so there is no
+RNG state to carry.
+
+Blobs that don't start with MAGIC are taken to be pickles from before this
+format, and unpickled.
+"""
+import functools
+import pickle
+import struct
+
+import cthulhu_game as cg
+
+MAGIC = b"CTH"
+FORMAT_VERSION = 1
+
+# Card types, roles, statuses, phases and expansions by code. Append only.
+CARD_TITLES = ("Blank", "Elder Sign", "Cthulhu", "Necronomicon", "Paranoia",
+               "Prescient Vision", "Evil Presence", "Private Eye",
+               "Insanity's Grasp", "Mirage")
+NULL_CODE = 0x7F
+ROLES = (None, cg.INVESTIGATOR, cg.CULTIST)
+STATUSES = (cg.IDLE, cg.PLAYING, cg.SPECTATING)
+GAME_STATUSES = ("Unstarted", "Ongoing", "Ended")
+PHASES = (None, "Claims", "Investigation")
+EXPANSIONS = (cg.NECRONOMICON, cg.OBJECTS_OF_POWER)
+
+CARD_CODES = {title: code for code, title in enumerate(CARD_TITLES)}
+CARD_CODES[cg.NULL_CARD[0]] = NULL_CODE
+
+# Top-level entry kinds in a chat_data or user_data blob.
+GAME, PLAYER, PICKLED, TOPICS = 1, 2, 3, 4
+
+# The chat_data key of a forum chat's topics, each with a chat_data of its
+# own.
+TOPICS_KEY = "topics"
+
+# Game sections.
+G_STATE, G_SETTINGS, G_PLAYERS, G_CARDS, G_EFFECTS, G_RULESET, G_LOG = (
+    range(1, 8))
+# Player sections.
+P_IDENTITY, P_STATS, P_HAND = range(1, 4)
+
+HEADER = struct.Struct(">3sB")
+SECTION = struct.Struct(">BI")
+ENTRY = struct.Struct(">BBI")
+COUNT = struct.Struct(">H")
+STATE = struct.Struct(">BIBHHB")
+SETTINGS = struct.Struct(">BBibB")
+EFFECTS = struct.Struct(">HhBBbB")
+TOPIC = struct.Struct(">qI")
+IDENTITY = struct.Struct(">qBH")
+STATS = struct.Struct(">IIII")
+HAND = struct.Struct(">BBBBBB")
+RULESET = struct.Struct(">HHBB")
+CLAIM = struct.Struct(">BBB")
+REVEAL = struct.Struct(">BBB")
+
+# The flag bits of a hand.
+CAN_CLAIM, HAS_FLASHLIGHT, HAS_CLAIM = 1, 2, 4
+# The nickname length that means None.
+NO_NICKNAME = 0xFFFF
+# The claim count that means no claim.
+NO_CLAIM = 0xFF
+
+
+class CodecError(Exception):
+    """
+    Raised when a blob can't be decoded or a value can't be encoded.
+    """
+    pass
+
+
+def section(tag, payload):
+    return SECTION.pack(tag, len(payload)) + payload
+
+
+def sections(blob):
+    """
+    Yields (tag, payload) for each section of a record.
+    """
+    offset = 0
+    while offset < len(blob):
+        tag, length = SECTION.unpack_from(blob, offset)
+        offset += SECTION.size
+        yield tag, blob[offset:offset + length]
+        offset += length
+    if offset != len(blob):
+        raise CodecError("Truncated record.")
+
+
+def card_code(card):
+    try:
+        return CARD_CODES[card.title] << 1 | card.is_flipped
+    except KeyError:
+        raise CodecError("Unknown card: {}".format(card.title))
+
+
+@functools.lru_cache(maxsize=None)
+def card_table(ruleset):
+    """
+    Returns the card data for each card code, for a ruleset.
+    """
+    table = [None] * (NULL_CODE + 1)
+    for code, title in enumerate(CARD_TITLES):
+        table[code] = ruleset.cards.get(title, cg.NULL_CARD)
+    table[NULL_CODE] = cg.NULL_CARD
+    return table
+
+
+def encode_cards(cards):
+    return bytes(card_code(card) for card in cards)
+
+
+def decode_cards(data, table):
+    cards = []
+    new = cg.Card.__new__
+    for code in data:
+        card = new(cg.Card)
+        card.data = table[code >> 1]
+        if card.data is None:
+            raise CodecError("Unknown card code: {}".format(code >> 1))
+        card.is_flipped = bool(code & 1)
+        cards.append(card)
+    return cards
+
+
+def encode_player(player):
+    """
+    Returns the bytes for a Player, including their hand if they have one.
+    """
+    if player.nickname is None:
+        name = b""
+        name_length = NO_NICKNAME
+    else:
+        name = player.nickname.encode()
+        name_length = len(name)
+    blob = section(P_IDENTITY, IDENTITY.pack(
+        player.p_id, STATUSES.index(player.status), name_length) + name)
+    stats = player.stats
+    blob += section(P_STATS, STATS.pack(stats.ngcw, stats.ngcl, stats.ngiw,
+                                        stats.ngil))
+    data = player.game_data
+    if data is not None:
+        flags = (data.can_claim * CAN_CLAIM |
+                 data.has_flashlight * HAS_FLASHLIGHT)
+        counts = [0, 0, 0]
+        if data.claim is not None:
+            flags |= HAS_CLAIM
+            for card in data.claim:
+                counts[CARD_CODES[card.title]] += 1
+        blob += section(P_HAND, HAND.pack(
+            ROLES.index(data.role), flags, *counts, len(data.cards)) +
+            encode_cards(data.cards))
+    return blob
+
+
+def decode_player(blob, table=None):
+    """
+    Returns the Player encoded in a blob.
+    """
+    table = table or card_table(cg.get_ruleset())
+    player = cg.Player.__new__(cg.Player)
+    player.p_id = 0
+    player.nickname = None
+    player.status = cg.IDLE
+    player.game_data = None
+    player.stats = cg.PlayerStats()
+    for tag, payload in sections(blob):
+        if tag == P_IDENTITY:
+            player.p_id, status, name_length = IDENTITY.unpack_from(payload)
+            player.status = STATUSES[status]
+            if name_length != NO_NICKNAME:
+                start = IDENTITY.size
+                player.nickname = payload[start:start + name_length].decode()
+        elif tag == P_STATS:
+            stats = player.stats
+            (stats.ngcw, stats.ngcl, stats.ngiw,
+             stats.ngil) = STATS.unpack_from(payload)
+        elif tag == P_HAND:
+            role, flags, blank, elder, cthulhu, n_cards = (
+                HAND.unpack_from(payload))
+            data = cg.PlayerGameData(ROLES[role])
+            data.can_claim = bool(flags & CAN_CLAIM)
+            data.has_flashlight = bool(flags & HAS_FLASHLIGHT)
+            if flags & HAS_CLAIM:
+                data.claim = decode_cards(bytes([0] * blank + [2] * elder +
+                                                [4] * cthulhu), table)
+            data.cards = decode_cards(
+                payload[HAND.size:HAND.size + n_cards], table)
+            player.game_data = data
+    return player
+
+
+def encode_game(game):
+    """
+    Returns the bytes for a Game, including its players.
+    """
+    started = hasattr(game, "round_counter")
+    settings = game.game_settings
+    blob = section(G_STATE, STATE.pack(
+        GAME_STATUSES.index(game.game_status), game.version,
+        PHASES.index(game.phase) if started else 0,
+        game.round_counter if started else 0, game.turn if started else 0,
+        ROLES.index(game.winner) if started else 0))
+    blob += section(G_SETTINGS, SETTINGS.pack(
+        settings.min_players, settings.max_players,
+        -1 if settings.turn_timeout is None else settings.turn_timeout,
+        -1 if settings.nudges is None else settings.nudges,
+        len(settings.expansions)) + bytes(
+            EXPANSIONS.index(e) for e in settings.expansions))
+    players = [encode_player(p) for p in game.players]
+    blob += section(G_PLAYERS, COUNT.pack(len(players)) + b"".join(
+        COUNT.pack(len(p)) + p for p in players))
+    if started:
+        blob += section(G_CARDS, COUNT.pack(len(game.deck)) +
+                        encode_cards(game.deck) +
+                        COUNT.pack(len(game.discard)) +
+                        encode_cards(game.discard))
+        seats = {id(p): i for i, p in enumerate(game.players)}
+        lock = game.flashlight_lock
+        blob += section(G_EFFECTS, EFFECTS.pack(
+            game.cards_revealed, game.signs_found, game.cthulhus_found,
+            game.necronomicon_cursed, -1 if lock is None else seats[id(lock)],
+            len(game.silenced)) + bytes(seats[id(p)] for p in game.silenced))
+    if game.rounds is not None:
+        blob += section(G_LOG, encode_log(game.rounds))
+    if game.ruleset is not cg.get_ruleset():
+        role_path, card_path, min_players, max_players = game.ruleset._args
+        role_path, card_path = role_path.encode(), card_path.encode()
+        blob += section(G_RULESET, RULESET.pack(
+            len(role_path), len(card_path), min_players, max_players) +
+            role_path + card_path)
+    return blob
+
+
+def decode_game(blob):
+    """
+    Returns the Game encoded in a blob, with its own Player objects.
+    """
+    parts = dict(sections(blob))
+    ruleset = None
+    if G_RULESET in parts:
+        payload = parts[G_RULESET]
+        role_length, card_length, min_players, max_players = (
+            RULESET.unpack_from(payload))
+        start = RULESET.size
+        role_path = payload[start:start + role_length].decode()
+        start += role_length
+        card_path = payload[start:start + card_length].decode()
+        ruleset = cg.Ruleset(role_path, card_path, min_players, max_players)
+    settings = cg.GameSettings()
+    if G_SETTINGS in parts:
+        payload = parts[G_SETTINGS]
+        (settings.min_players, settings.max_players, timeout, nudges,
+         n_expansions) = SETTINGS.unpack_from(payload)
+        settings.turn_timeout = None if timeout < 0 else timeout
+        settings.nudges = None if nudges < 0 else nudges
+        settings.expansions = [EXPANSIONS[code] for code in payload[
+            SETTINGS.size:SETTINGS.size + n_expansions]]
+    game = cg.Game(settings, ruleset)
+    table = card_table(game.ruleset)
+    if G_PLAYERS in parts:
+        payload = parts[G_PLAYERS]
+        (count,) = COUNT.unpack_from(payload)
+        offset = COUNT.size
+        for _ in range(count):
+            (length,) = COUNT.unpack_from(payload, offset)
+            offset += COUNT.size
+            game.players.append(decode_player(
+                payload[offset:offset + length], table))
+            offset += length
+    if G_STATE in parts:
+        status, game.version, phase, round_counter, turn, winner = (
+            STATE.unpack_from(parts[G_STATE]))
+        game.game_status = GAME_STATUSES[status]
+        if G_CARDS in parts:
+            game.round_counter = round_counter
+            game.phase = PHASES[phase]
+            game.turn = turn
+            game.winner = ROLES[winner]
+    if G_CARDS in parts:
+        payload = parts[G_CARDS]
+        (n_deck,) = COUNT.unpack_from(payload)
+        offset = COUNT.size
+        game.deck = decode_cards(payload[offset:offset + n_deck], table)
+        offset += n_deck
+        (n_discard,) = COUNT.unpack_from(payload, offset)
+        offset += COUNT.size
+        game.discard = decode_cards(payload[offset:offset + n_discard], table)
+        in_play = game.deck + game.discard + [
+            card for p in game.get_active_players()
+            for card in p.game_data.cards]
+        game.compile_effects(in_play)
+    if G_EFFECTS in parts:
+        payload = parts[G_EFFECTS]
+        (game.cards_revealed, game.signs_found, game.cthulhus_found, cursed,
+         lock, n_silenced) = EFFECTS.unpack_from(payload)
+        game.necronomicon_cursed = bool(cursed)
+        game.flashlight_lock = None if lock < 0 else game.players[lock]
+        game.silenced = [game.players[seat] for seat in payload[
+            EFFECTS.size:EFFECTS.size + n_silenced]]
+    if G_LOG in parts:
+        game.rounds = decode_log(parts[G_LOG])
+    return game
+
+
+def encode_log(rounds):
+    """
+    Returns the bytes for a game's RoundLogs. Each round is its seats'
+    hands as card codes, their claims, and its reveals.
+    """
+    blob = [COUNT.pack(len(rounds))]
+    for log in rounds:
+        blob.append(bytes([len(log.hands)]))
+        for hand in log.hands:
+            blob.append(bytes([len(hand)]))
+            blob.append(bytes(CARD_CODES[title] for title in hand))
+        for claim in log.claims:
+            blob.append(CLAIM.pack(*claim) if claim is not None else
+                        CLAIM.pack(NO_CLAIM, NO_CLAIM, NO_CLAIM))
+        blob.append(COUNT.pack(len(log.reveals)))
+        for user, target, title in log.reveals:
+            blob.append(REVEAL.pack(user, target, CARD_CODES[title]))
+    return b"".join(blob)
+
+
+def decode_log(payload):
+    rounds = []
+    (count,) = COUNT.unpack_from(payload)
+    offset = COUNT.size
+    for _ in range(count):
+        n_seats = payload[offset]
+        offset += 1
+        hands = []
+        for _ in range(n_seats):
+            length = payload[offset]
+            hands.append(tuple(CARD_TITLES[code] for code in
+                               payload[offset + 1:offset + 1 + length]))
+            offset += 1 + length
+        claims = []
+        for _ in range(n_seats):
+            claim = CLAIM.unpack_from(payload, offset)
+            claims.append(None if claim[0] == NO_CLAIM else claim)
+            offset += CLAIM.size
+        (n_reveals,) = COUNT.unpack_from(payload, offset)
+        offset += COUNT.size
+        reveals = []
+        for _ in range(n_reveals):
+            user, target, code = REVEAL.unpack_from(payload, offset)
+            reveals.append((user, target, CARD_TITLES[code]))
+            offset += REVEAL.size
+        rounds.append(cg.RoundLog(hands, claims, reveals))
+    return rounds
+
+
+def encode_topics(topics):
+    """
+    Encodes a forum chat's topics, each as its thread id and its chat_data.
+    """
+    blob = []
+    for thread_id, data in topics.items():
+        data = dumps(data)
+        blob.append(TOPIC.pack(thread_id, len(data)) + data)
+    return b"".join(blob)
+
+
+def decode_topics(blob):
+    topics = {}
+    offset = 0
+    while offset < len(blob):
+        thread_id, length = TOPIC.unpack_from(blob, offset)
+        offset += TOPIC.size
+        if offset + length > len(blob):
+            raise CodecError("Truncated topic.")
+        topics[thread_id] = loads(blob[offset:offset + length])
+        offset += length
+    return topics
+
+
+def chat_games(data):
+    """
+    Returns the games in a chat_data: the chat's own, then its topics'.
+    """
+    games = [data["game"]] if data.get("game") is not None else []
+    for topic in data.get(TOPICS_KEY, {}).values():
+        if topic.get("game") is not None:
+            games.append(topic["game"])
+    return games
+
+
+def has_games(blob):
+    """
+    Returns whether an encoded chat_data holds a game, or forum topics that
+    may, without decoding any of it.
+    """
+    if not blob.startswith(MAGIC):
+        return bool(chat_games(pickle.loads(blob)))
+    offset = HEADER.size
+    while offset + ENTRY.size <= len(blob):
+        kind, key_length, length = ENTRY.unpack_from(blob, offset)
+        if kind in (GAME, TOPICS):
+            return True
+        offset += ENTRY.size + key_length + length
+    return False
+
+
+def dumps(data):
+    """
+    Encodes a chat_data or user_data dict. Games and players use this
+    module's format; anything else is pickled inside the blob.
+    """
+    blob = [HEADER.pack(MAGIC, FORMAT_VERSION)]
+    for key, value in data.items():
+        if isinstance(value, cg.Game):
+            kind, payload = GAME, encode_game(value)
+        elif isinstance(value, cg.Player):
+            kind, payload = PLAYER, encode_player(value)
+        elif key == TOPICS_KEY:
+            kind, payload = TOPICS, encode_topics(value)
+        else:
+            kind = PICKLED
+            payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        key = key.encode()
+        blob.append(ENTRY.pack(kind, len(key), len(payload)) + key + payload)
+    return b"".join(blob)
+
+
+def loads(blob):
+    """
+    Decodes a blob from dumps, or unpickles one from before this format.
+
+    Raises:
+      CodecError - if the blob is damaged.
+    """
+    if not blob.startswith(MAGIC):
+        return pickle.loads(blob)
+    data = {}
+    offset = HEADER.size
+    try:
+        while offset < len(blob):
+            kind, key_length, length = ENTRY.unpack_from(blob, offset)
+            offset += ENTRY.size
+            if offset + key_length + length > len(blob):
+                raise CodecError("Truncated blob.")
+            key = blob[offset:offset + key_length].decode()
+            offset += key_length
+            payload = blob[offset:offset + length]
+            offset += length
+            if kind == GAME:
+                data[key] = decode_game(payload)
+            elif kind == PLAYER:
+                data[key] = decode_player(payload)
+            elif kind == PICKLED:
+                data[key] = pickle.loads(payload)
+            elif kind == TOPICS:
+                data[key] = decode_topics(payload)
+    except (struct.error, IndexError, UnicodeDecodeError) as err:
+        raise CodecError("Damaged blob: {}".format(err))
+    return data
@@ -0,0 +1,153 @@
+from cthulhu_codec import *
+import cthulhu_game as cg
+import cthulhu_testing as testing
+import pickle
+import random
+import unittest
+
+
+def make_game(n_players=10, moves=14, seed=3):
+    """
+    Returns a game with Objects of Power, some way into its first round.
+    """
+    random.seed(seed)
+    game = cg.Game()
+    game.game_settings.expansions = [cg.OBJECTS_OF_POWER]
+    for i in range(n_players):
+        game.add_player(cg.Player(i + 1, nickname="Player {}".format(i)))
+    game.add_player(cg.Player(99), is_playing=False)
+    game.start_game()
+    for _ in range(moves):
+        move = testing.next_move(game)
+        player = game.get_current_player()
+        if game.phase == "Claims":
+            game.set_claim(player, 3, 1, 0)
+        else:
+            seat = int(move[1].split()[1])
+            game.investigate(player, game.get_active_players()[seat - 1])
+    return game
+
+
+def finish(game, seed):
+    """
+    Plays a game to the end with fixed choices, returning the winner.
+    """
+    random.seed(seed)
+    while game.game_status == "Ongoing":
+        move = testing.next_move(game)
+        if move is None:
+            break
+        player = game.get_current_player()
+        if game.phase == "Claims":
+            game.set_claim(player, 4, 0, 0)
+        else:
+            seat = int(move[1].split()[1])
+            game.investigate(player, game.get_active_players()[seat - 1])
+    return game.winner, game.cards_revealed, game.round_counter
+
+
+class TestCodec(unittest.TestCase):
+    """
+    Tests encoding and decoding games and players.
+    """
+
+    def test_game_round_trip(self):
+        """
+        A decoded game looks and plays exactly like the original.
+        """
+        game = make_game()
+        game.flashlight_lock = game.players[2]
+        game.silenced = [game.players[4]]
+        blob = dumps({"game": game})
+        self.assertLess(len(blob), len(pickle.dumps({"game": game})) / 4)
+        copy = loads(blob)["game"]
+        self.assertEqual(copy.display_board(omniscient=True),
+                         game.display_board(omniscient=True))
+        for name in ("game_status", "version", "round_counter", "phase",
+                     "turn", "winner", "cards_revealed", "signs_found",
+                     "cthulhus_found", "necronomicon_cursed"):
+            self.assertEqual(getattr(copy, name), getattr(game, name))
+        self.assertEqual([c.title for c in copy.deck],
+                         [c.title for c in game.deck])
+        self.assertEqual(sorted(copy.reveal_hooks),
+                         sorted(game.reveal_hooks))
+        self.assertEqual(len(copy.round_end_hooks),
+                         len(game.round_end_hooks))
+        self.assertIs(copy.flashlight_lock, copy.players[2])
+        self.assertIs(copy.silenced[0], copy.players[4])
+        self.assertEqual(copy.game_settings.expansions,
+                         [cg.OBJECTS_OF_POWER])
+        self.assertEqual(copy.get_spectators()[0].p_id, 99)
+        game.flashlight_lock = None
+        copy.flashlight_lock = None
+        self.assertEqual(finish(copy, 5), finish(game, 5))
+        self.assertEqual(list(copy.get_log()), list(game.get_log()))
+
+    def test_players(self):
+        """
+        Players keep their profile, and a pending game its roster.
+        """
+        player = cg.Player(-5, nickname="Ålice")
+        player.stats.ngiw = 7
+        game = cg.Game()
+        game.add_player(player)
+        game.add_player(cg.Player(2 ** 40))
+        data = loads(dumps({"game": game, "player": player}))
+        self.assertEqual(data["player"].nickname, "Ålice")
+        self.assertEqual(data["player"].stats.ngiw, 7)
+        self.assertEqual(data["player"].status, cg.PLAYING)
+        self.assertIsNone(data["player"].game_data)
+        copy = data["game"]
+        self.assertEqual(copy.game_status, "Unstarted")
+        self.assertFalse(hasattr(copy, "round_counter"))
+        self.assertEqual([p.p_id for p in copy.players], [-5, 2 ** 40])
+        self.assertIsNone(copy.players[1].nickname)
+
+    def test_forward_compatible(self):
+        """
+        Unknown sections and extra bytes at the end of a section are
+        skipped, and missing sections keep their defaults.
+        """
+        player = cg.Player(3, nickname="P3")
+        player.stats.ngcw = 2
+        blob = encode_player(player)
+        newer = (section(P_IDENTITY, IDENTITY.pack(3, 0, 2) + b"P3" +
+                         b"extra") + section(200, b"future") +
+                 section(P_STATS, STATS.pack(2, 0, 0, 0)))
+        for data in (blob, newer):
+            copy = decode_player(data)
+            self.assertEqual((copy.p_id, copy.nickname, copy.stats.ngcw),
+                             (3, "P3", 2))
+        older = section(P_IDENTITY, IDENTITY.pack(3, 0, 2) + b"P3")
+        self.assertEqual(decode_player(older).stats.ngcw, 0)
+
+    def test_pickles_and_damage(self):
+        """
+        Blobs pickled before this format still load, and damaged ones are
+        rejected.
+        """
+        game = make_game(n_players=4, moves=2)
+        self.assertEqual(
+            loads(pickle.dumps({"game": game}))["game"].display_board(),
+            game.display_board())
+        blob = dumps({"game": game, "other": [1, 2]})
+        self.assertEqual(loads(blob)["other"], [1, 2])
+        self.assertRaises(CodecError, loads, blob[:-3])
+
+    def test_topics(self):
+        """
+        The games in a forum chat's topics are encoded like the chat's own.
+        """
+        game = make_game(n_players=4, moves=2)
+        other = make_game(n_players=6, moves=5, seed=8)
+        data = {"game": game, TOPICS_KEY: {5: {"game": other}, 9: {}}}
+        copy = loads(dumps(data))
+        self.assertEqual(sorted(copy[TOPICS_KEY]), [5, 9])
+        self.assertEqual(copy[TOPICS_KEY][5]["game"].display_board(),
+                         other.display_board())
+        self.assertEqual([g.display_board() for g in chat_games(copy)],
+                         [game.display_board(), other.display_board()])
+
+
+if __name__ == "__main__":
+    unittest.main()
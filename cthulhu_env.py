@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+This module wraps the game engine as a Gym-style environment, for training
+and evaluating claim and investigation policies offline.
+
+CthulhuEnv plays one game. Every turn one seat acts, and its action is a
+single int whose meaning depends on the phase:
+  - Claims: elder * 2 + cthulhu, claiming that many Elder Signs and
+    Cthulhus with the rest of the hand Blank;
+  - Investigation: the seat, from 0, to investigate.
+step() returns the observation of the seat to act next, a reward per seat
+(+1 for the winners and -1 for the losers once the game ends, 0 before),
+whether the game is over, and an info dict.
+
+An observation is a flat list of ints showing only what that seat knows:
+  round, phase (0 claims, 1 investigation), seat to act, own seat, own role
+  (0 investigator, 1 cultist), cards revealed, Elder Signs found,
+  then how many of each card type are face-down in the seat's own hand,
+  then for every seat: flashlight (0 or 1), cards face-down, the claimed
+  Blanks, Elder Signs and Cthulhus (-1 each before claiming), and how many
+  of each card type are face-up in front of them.
+Card types are in the order of Ruleset.cards.
+
+reset() reuses the game's players, cards and lists rather than making new
+ones, and every shuffle comes from the environment's own seeded Random, so
+a seed and a list of actions always play the same game. (Prescient Vision
+still picks the card it shows with the random module, which only changes
+the text of its note.)
+
+VectorEnv steps a batch of environments at once, writing observations and
+rewards into the same lists every step and resetting finished games in
+place.
+"""
+import random
+
+import cthulhu_game as cg
+
+CLAIMS, INVESTIGATION = 0, 1
+
+# The ints before the per-card-type counts of an observation.
+HEADER = 7
+# The ints before the face-up counts of each seat's part.
+SEAT_HEADER = 5
+# Where each claimed card type is counted in a seat's part.
+CLAIM_SLOTS = {"Blank": 2, "Elder Sign": 3, "Cthulhu": 4}
+
+
+class EnvGame(cg.Game):
+    """
+    A Game that shuffles with its own Random rather than the random module.
+    """
+
+    def __init__(self, rng, game_settings=None, ruleset=None):
+        super().__init__(game_settings, ruleset)
+        self.rng = rng
+
+    def deal_cards(self):
+        self.rng.shuffle(self.deck)
+        players = self.get_active_players()
+        for i in range(len(self.deck)):
+            players[i % len(players)].give_card(self.deck.pop())
+
+
+class CthulhuEnv:
+    """
+    One game of Don't Mess with Cthulhu as an environment.
+
+    Attributes:
+      n_players - the number of seats.
+      n_actions - actions are ints below this.
+      obs_size - the length of an observation.
+      game - the EnvGame being played.
+      seats - its players, by seat.
+      cards - every card in the game.
+      titles - the card types, in observation order.
+      rng - the Random every shuffle comes from.
+    """
+
+    def __init__(self, n_players=5, expansions=(), seed=None, ruleset=None):
+        self.rng = random.Random(seed)
+        settings = cg.GameSettings()
+        settings.expansions = list(expansions)
+        self.game = EnvGame(self.rng, settings, ruleset)
+        for i in range(n_players):
+            self.game.add_player(cg.Player(i + 1,
+                                           nickname="P{}".format(i + 1)))
+        self.game.start_game()
+        self.seats = self.game.get_active_players()
+        self.cards = [card for p in self.seats for card in p.game_data.cards]
+        self.roles = self.game.ruleset.roles[n_players]
+        self.titles = list(self.game.ruleset.cards)
+        self.title_index = {title: i for i, title in enumerate(self.titles)}
+        # The cards never change, so each one's type is looked up once.
+        self.card_types = {id(card): self.title_index[card.title]
+                           for card in self.cards}
+        self.n_players = n_players
+        hand_size = len(self.cards) // n_players
+        self.n_actions = max(2 * hand_size + 2, n_players)
+        self.obs_size = (HEADER + len(self.titles) +
+                         n_players * (SEAT_HEADER + len(self.titles)))
+        self.zeros = [0] * self.obs_size
+        self.no_rewards = [0] * n_players
+        self.rewards = [0] * n_players
+        self.reset()
+
+    def seed(self, seed):
+        self.rng.seed(seed)
+
+    def reset(self, seed=None):
+        """
+        Starts a new game with the same players and cards.
+
+        Returns:
+          obs - the observation of the seat to act first.
+        """
+        if seed is not None:
+            self.rng.seed(seed)
+        game = self.game
+        for card in self.cards:
+            card.is_flipped = False
+        game.deck[:] = self.cards
+        game.discard.clear()
+        roles = list(self.roles)
+        self.rng.shuffle(roles)
+        for player, role in zip(self.seats, roles):
+            data = player.game_data
+            data.role = role
+            data.cards.clear()
+            data.can_claim = True
+            data.claim = None
+            data.has_flashlight = False
+        game.compile_effects(self.cards)
+        game.deal_cards()
+        self.rng.choice(self.seats).toggle_flashlight()
+        game.game_status = "Ongoing"
+        game.round_counter = 1
+        game.phase = "Claims"
+        game.turn = 1
+        game.winner = None
+        game.version += 1
+        self.rewards[:] = self.no_rewards
+        return self.observe(self.to_act())
+
+    def to_act(self):
+        """
+        Returns the seat to act, or None once the game is over.
+        """
+        if self.game.game_status != "Ongoing":
+            return None
+        return self.seats.index(self.game.get_current_player())
+
+    def legal_actions(self):
+        """
+        Returns the actions the seat to act can take.
+        """
+        game = self.game
+        player = game.get_current_player()
+        if game.phase == "Claims":
+            hand = len(player.game_data.cards)
+            return [elder * 2 + cthulhu for elder in range(hand + 1)
+                    for cthulhu in (0, 1) if elder + cthulhu <= hand]
+        return [seat for seat, target in enumerate(self.seats)
+                if target is not player and
+                any(not card.is_flipped for card in target.game_data.cards)]
+
+    def act(self, action):
+        """
+        Plays an action for the seat to act.
+
+        Returns:
+          notes - the notes of any card effect, as from Game.investigate.
+
+        Raises:
+          GameError - if the action isn't legal.
+        """
+        game = self.game
+        player = game.get_current_player()
+        if game.phase == "Claims":
+            elder, cthulhu = divmod(action, 2)
+            blank = len(player.game_data.cards) - elder - cthulhu
+            if blank < 0:
+                raise cg.GameError("You don't have that many cards.")
+            game.set_claim(player, blank, elder, cthulhu)
+            return []
+        if not 0 <= action < self.n_players:
+            raise cg.GameError("That doesn't seem to be a player.")
+        return game.investigate(player, self.seats[action])
+
+    def step(self, action):
+        """
+        Plays an action for the seat to act.
+
+        Returns:
+          (obs, rewards, done, info) - the observation of the seat to act
+            next (or of the last seat to act, once the game is over), the
+            reward of each seat, whether the game is over, and a dict with
+            the "seat" to act next and the "notes" of any card effect.
+        """
+        seat = self.to_act()
+        notes = self.act(action)
+        done = self.finish()
+        acting = None if done else self.to_act()
+        return (self.observe(seat if done else acting), list(self.rewards),
+                done, {"seat": acting, "notes": notes})
+
+    def finish(self):
+        """
+        Fills in self.rewards. Returns whether the game is over.
+
+        A game where the flashlight has nobody left to investigate ends with
+        no winner.
+        """
+        game = self.game
+        if game.winner is not None:
+            for i, player in enumerate(self.seats):
+                self.rewards[i] = (1 if player.game_data.role == game.winner
+                                   else -1)
+            return True
+        self.rewards[:] = self.no_rewards
+        if game.phase == "Investigation" and not self.legal_actions():
+            game.end_game()
+            return True
+        return False
+
+    def observe(self, seat, obs=None, acting=None):
+        """
+        Returns what a seat knows, as a flat list of ints.
+
+        Arguments:
+          seat - the seat observing.
+          obs - Optional. A list of obs_size ints to write into.
+          acting - Optional. The seat to act, if the caller knows it.
+        """
+        if obs is None:
+            obs = list(self.zeros)
+        else:
+            obs[:] = self.zeros
+        game = self.game
+        types = self.card_types
+        n_titles = len(self.titles)
+        if acting is None:
+            acting = self.to_act()
+        obs[0] = game.round_counter
+        obs[1] = CLAIMS if game.phase == "Claims" else INVESTIGATION
+        obs[2] = -1 if acting is None else acting
+        obs[3] = seat
+        obs[4] = int(self.seats[seat].game_data.role == cg.CULTIST)
+        obs[5] = game.cards_revealed
+        obs[6] = game.signs_found
+        for card in self.seats[seat].game_data.cards:
+            if not card.is_flipped:
+                obs[HEADER + types[id(card)]] += 1
+        at = HEADER + n_titles
+        for player in self.seats:
+            data = player.game_data
+            obs[at] = int(data.has_flashlight)
+            claim = data.claim
+            if claim is None:
+                obs[at + 2:at + 5] = (-1, -1, -1)
+            else:
+                for card in claim:
+                    obs[at + CLAIM_SLOTS[card.title]] += 1
+            for card in data.cards:
+                if card.is_flipped:
+                    obs[at + SEAT_HEADER + types[id(card)]] += 1
+                else:
+                    obs[at + 1] += 1
+            at += SEAT_HEADER + n_titles
+        return obs
+
+
+class VectorEnv:
+    """
+    A batch of CthulhuEnvs stepped together.
+
+    The lists step() returns are reused from step to step, so copy anything
+    you want to keep.
+
+    Attributes:
+      envs - the environments.
+      obs - each environment's latest observation.
+      rewards - each environment's latest rewards, one per seat.
+      dones - whether each environment's last step ended its game. A
+        finished game is reset straight away, so obs then holds the first
+        observation of the next game.
+      seats - the seat to act next in each environment.
+      episodes - the number of games finished.
+    """
+
+    def __init__(self, n_envs, n_players=5, expansions=(), seed=None,
+                 ruleset=None):
+        """
+        Arguments:
+          n_envs - the number of environments.
+          n_players, expansions, ruleset - as for CthulhuEnv.
+          seed - Optional. Environment i is seeded with seed + i.
+        """
+        self.envs = [CthulhuEnv(n_players, expansions,
+                                None if seed is None else seed + i, ruleset)
+                     for i in range(n_envs)]
+        self.obs = [[0] * env.obs_size for env in self.envs]
+        self.rewards = [[0] * n_players for _ in self.envs]
+        self.dones = [False] * n_envs
+        self.seats = [0] * n_envs
+        self.episodes = 0
+        self.reset(seed)
+
+    def reset(self, seed=None):
+        """
+        Resets every environment. Returns the observations.
+        """
+        for i, env in enumerate(self.envs):
+            env.reset(None if seed is None else seed + i)
+            self.seats[i] = env.to_act()
+            env.observe(self.seats[i], self.obs[i])
+        return self.obs
+
+    def legal_actions(self):
+        """
+        Returns the legal actions of every environment.
+        """
+        return [env.legal_actions() for env in self.envs]
+
+    def step(self, actions):
+        """
+        Plays one action in every environment.
+
+        Returns:
+          (obs, rewards, dones, seats) - see the class docstring.
+        """
+        obs, rewards, dones, seats = (self.obs, self.rewards, self.dones,
+                                      self.seats)
+        for i, env in enumerate(self.envs):
+            env.act(actions[i])
+            done = dones[i] = env.finish()
+            rewards[i][:] = env.rewards
+            if done:
+                self.episodes += 1
+                env.reset()
+            seats[i] = seat = env.to_act()
+            env.observe(seat, obs[i], seat)
+        return obs, rewards, dones, seats
@@ -0,0 +1,113 @@
+from cthulhu_env import *
+import cthulhu_game as cg
+import random
+import unittest
+
+
+def play(env, rng):
+    """
+    Plays random legal actions to the end of a game. Returns every step's
+    result.
+    """
+    steps = []
+    done = False
+    while not done:
+        obs, rewards, done, info = env.step(rng.choice(env.legal_actions()))
+        steps.append((obs, rewards, done, info["seat"]))
+    return steps
+
+
+class TestCthulhuEnv(unittest.TestCase):
+    """
+    Tests the single-game environment.
+    """
+
+    def test_game(self):
+        """
+        Games end with one team winning, and observations hide other seats'
+        face-down cards.
+        """
+        env = CthulhuEnv(5, seed=0)
+        obs = env.reset()
+        self.assertEqual(len(obs), env.obs_size)
+        self.assertEqual(sum(obs[HEADER:HEADER + len(env.titles)]), 5)
+        steps = play(env, random.Random(1))
+        obs, rewards, done, seat = steps[-1]
+        self.assertTrue(done)
+        self.assertIsNone(seat)
+        self.assertEqual(env.game.game_status, "Ended")
+        if env.game.winner:
+            self.assertEqual(sorted(set(rewards)), [-1, 1])
+            for player, reward in zip(env.seats, rewards):
+                self.assertEqual(reward == 1,
+                                 player.game_data.role == env.game.winner)
+        for obs, rewards, done, seat in steps[:-1]:
+            self.assertEqual(rewards, [0] * 5)
+            self.assertEqual(obs[3], seat)
+
+    def test_seeding(self):
+        """
+        The same seed and actions play the same game, and reset reuses the
+        players and cards.
+        """
+        env = CthulhuEnv(6, expansions=[cg.OBJECTS_OF_POWER], seed=3)
+        players = list(env.seats)
+        cards = set(map(id, env.cards))
+        first = env.reset(7), play(env, random.Random(2))
+        second = env.reset(7), play(env, random.Random(2))
+        self.assertEqual(first, second)
+        self.assertEqual(env.seats, players)
+        self.assertEqual(set(id(card) for p in env.seats
+                             for card in p.game_data.cards) | set(
+                             map(id, env.game.deck + env.game.discard)),
+                         cards)
+
+    def test_illegal(self):
+        """
+        Impossible claims and investigations raise GameError.
+        """
+        env = CthulhuEnv(4, seed=0)
+        with self.assertRaises(cg.GameError):
+            env.step(2 * 5 + 1)
+        while env.game.phase == "Claims":
+            env.step(0)
+        with self.assertRaises(cg.GameError):
+            env.step(env.to_act())
+        with self.assertRaises(cg.GameError):
+            env.step(9)
+
+
+class TestVectorEnv(unittest.TestCase):
+    """
+    Tests stepping many environments together.
+    """
+
+    def test_matches_single(self):
+        """
+        A batch plays the same games as the same environments one by one,
+        and resets finished games.
+        """
+        batch = VectorEnv(3, seed=10)
+        singles = [CthulhuEnv(5, seed=10 + i) for i in range(3)]
+        for i, env in enumerate(singles):
+            self.assertEqual(env.reset(10 + i), batch.obs[i])
+        rng = random.Random(0)
+        finished = 0
+        while finished < 3:
+            actions = [rng.choice(env.legal_actions()) for env in singles]
+            obs, rewards, dones, seats = batch.step(actions)
+            for i, env in enumerate(singles):
+                single = env.step(actions[i])
+                self.assertEqual(single[1], rewards[i])
+                self.assertEqual(single[2], dones[i])
+                if dones[i]:
+                    finished += 1
+                    env.reset()
+                    self.assertEqual(env.game.game_status, "Ongoing")
+                self.assertEqual(env.to_act(), seats[i])
+                self.assertEqual(env.observe(env.to_act()), obs[i])
+        self.assertEqual(batch.episodes, finished)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+This module keeps idle chats and players out of memory.
+
+python-telegram-bot keeps every chat's chat_data and every user's user_data
+in memory forever, including abandoned games that never started. The
+EvictionManager remembers when each chat and user was last active. Once one
+has been idle for longer than the TTL, or there are more resident chats than
+the cap allows, it is encoded (see cthulhu_codec) into an sqlite file and
+dropped from the dispatcher, along with any forum topics it has. The next
+command for that chat or user loads it back before the handler runs, so
+handlers never notice.
+
+A game and its players' user_data hold the same Player objects. Two rules
+keep that true across eviction:
+  - A user is only evicted once none of their games are resident.
+  - When a game is reloaded, each seat is rebound to that user's own Player,
+    which wins over the game's copy.
+"""
+import collections
+import sqlite3
+import threading
+import time
+
+import cthulhu_codec
+
+
+class EvictionManager:
+    """
+    Spills idle chat_data and user_data to disk and reloads it on demand.
+
+    Attributes:
+      db - the sqlite connection holding evicted data.
+      ttl - seconds of inactivity before a chat or user is evicted.
+      max_chats - the most chats to keep in memory; the least recently
+        active are evicted first.
+      sweep_every - the fewest seconds between two sweeps.
+      chats - maps resident chat ids to their last activity, oldest first.
+      users - maps resident user ids to their last activity, oldest first.
+      evicted - the number of chats and users written to disk.
+      reloaded - the number of chats and users read back.
+    """
+
+    def __init__(self, path, ttl=6 * 3600, max_chats=10000, sweep_every=60,
+                 clock=time.monotonic):
+        """
+        Arguments:
+          path - the sqlite file to evict to, or ":memory:".
+          ttl - seconds of inactivity before eviction.
+          max_chats - the most chats to keep in memory.
+          sweep_every - the fewest seconds between two sweeps.
+          clock - returns the current time in seconds.
+        """
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS evicted (kind TEXT, "
+                        "key INTEGER, data BLOB, PRIMARY KEY (kind, key))")
+        self.ttl = ttl
+        self.max_chats = max_chats
+        self.sweep_every = sweep_every
+        self.clock = clock
+        self.chats = collections.OrderedDict()
+        self.users = collections.OrderedDict()
+        self.last_sweep = clock()
+        self.evicted = 0
+        self.reloaded = 0
+        self.lock = threading.Lock()
+
+    def touch(self, dispatcher, chat_id, user_id):
+        """
+        Records activity in a chat, reloading it and the user if they were
+        evicted, and sweeps if it's time to.
+
+        Called before a handler runs, so the handler sees the reloaded data.
+        """
+        with self.lock:
+            now = self.clock()
+            self.reload_user(dispatcher, user_id, now)
+            self.reload_chat(dispatcher, chat_id, now)
+            self.mark(self.chats, chat_id, now)
+            self.mark(self.users, user_id, now)
+            if (now - self.last_sweep >= self.sweep_every or
+                    len(self.chats) > self.max_chats):
+                self.sweep(dispatcher, now)
+
+    @staticmethod
+    def mark(activity, key, now):
+        """
+        Records that a chat or user was active now.
+        """
+        activity[key] = now
+        activity.move_to_end(key)
+
+    def sweep(self, dispatcher, now=None):
+        """
+        Evicts chats idle past the TTL or beyond the cap, then users idle
+        past the TTL who aren't seated in a resident game.
+
+        Returns:
+          (chats, users) - how many of each were evicted.
+        """
+        if now is None:
+            now = self.clock()
+        self.last_sweep = now
+        chats = []
+        for chat_id, last in self.chats.items():
+            if (now - last < self.ttl and
+                    len(self.chats) - len(chats) <= self.max_chats):
+                break
+            chats.append(chat_id)
+        seats = dispatcher.bot_data.get("seats")
+        for chat_id in chats:
+            if seats is not None:
+                for game in cthulhu_codec.chat_games(
+                        dispatcher.chat_data.get(chat_id, {})):
+                    seats.release(game)
+            self.evict(dispatcher.chat_data, "chat", chat_id)
+            del self.chats[chat_id]
+        seated = set()
+        for chat_id in self.chats:
+            for game in cthulhu_codec.chat_games(
+                    dispatcher.chat_data.get(chat_id, {})):
+                seated.update(p.p_id for p in game.players)
+        users = [user_id for user_id, last in self.users.items()
+                 if now - last >= self.ttl and user_id not in seated]
+        for user_id in users:
+            self.evict(dispatcher.user_data, "user", user_id)
+            del self.users[user_id]
+        self.db.commit()
+        # Dicts never shrink on their own, so after a big sweep rebuild them
+        # at the size of what's left.
+        if len(chats) > len(self.chats):
+            self.compact(dispatcher.chat_data)
+            self.chats = collections.OrderedDict(self.chats)
+        if len(users) > len(self.users):
+            self.compact(dispatcher.user_data)
+            self.users = collections.OrderedDict(self.users)
+        return len(chats), len(users)
+
+    @staticmethod
+    def compact(table):
+        """
+        Shrinks a dict in place to fit its current entries.
+        """
+        entries = dict(table)
+        table.clear()
+        table.update(entries)
+
+    def evict(self, table, kind, key):
+        """
+        Writes a chat_data or user_data entry to disk and drops it.
+        """
+        data = table.pop(key, None)
+        if data:
+            self.db.execute("REPLACE INTO evicted VALUES (?, ?, ?)",
+                            (kind, key, cthulhu_codec.dumps(data)))
+            self.evicted += 1
+
+    def load(self, kind, key):
+        """
+        Removes and returns an evicted entry, or None if there isn't one.
+        """
+        row = self.db.execute("SELECT data FROM evicted WHERE kind = ? AND "
+                              "key = ?", (kind, key)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("DELETE FROM evicted WHERE kind = ? AND key = ?",
+                        (kind, key))
+        self.db.commit()
+        self.reloaded += 1
+        return cthulhu_codec.loads(row[0])
+
+    def reload_user(self, dispatcher, user_id, now):
+        """
+        Loads a user's evicted user_data, if it isn't resident.
+        """
+        if user_id in self.users or dispatcher.user_data.get(user_id):
+            return
+        data = self.load("user", user_id)
+        if data is not None:
+            dispatcher.user_data[user_id].update(data)
+            self.mark(self.users, user_id, now)
+
+    def reload_chat(self, dispatcher, chat_id, now):
+        """
+        Loads a chat's evicted chat_data, if it isn't resident, and rebinds
+        the seats of its games, and its forum topics' games, to the players'
+        own Player objects.
+        """
+        if chat_id in self.chats or dispatcher.chat_data.get(chat_id):
+            return
+        data = self.load("chat", chat_id)
+        if data is None:
+            return
+        for game in cthulhu_codec.chat_games(data):
+            for player in list(game.players):
+                self.reload_user(dispatcher, player.p_id, now)
+                user_data = dispatcher.user_data[player.p_id]
+                if "player" in user_data:
+                    game.replace_player(player, user_data["player"])
+                else:
+                    user_data["player"] = player
+                self.mark(self.users, player.p_id, now)
+        dispatcher.chat_data[chat_id].update(data)
+
+    def chat_ids(self, after=None, page_size=1000):
+        """
+        Yields the ids of evicted chats with a game, in order, starting
+        after a given id. Reads a page of rows at a time, so a caller that
+        stops early never reads the rest.
+        """
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT key, data FROM evicted WHERE kind = 'chat' AND "
+                    "key > ? ORDER BY key LIMIT ?",
+                    (-2 ** 63 if after is None else after,
+                     page_size)).fetchall()
+            for chat_id, data in rows:
+                if cthulhu_codec.has_games(data):
+                    yield chat_id
+            if len(rows) < page_size:
+                return
+            after = rows[-1][0]
+
+    def stored(self):
+        """
+        Returns the number of chats and users on disk, as (chats, users).
+        """
+        counts = dict(self.db.execute(
+            "SELECT kind, COUNT(*) FROM evicted GROUP BY kind"))
+        return counts.get("chat", 0), counts.get("user", 0)
+
+    def close(self):
+        """
+        Commits and closes the on-disk store.
+        """
+        self.db.commit()
+        self.db.close()
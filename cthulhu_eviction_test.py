@@ -0,0 +1,121 @@
+from cthulhu_eviction import *
+import cthulhu_testing as testing
+import random
+import unittest
+
+
+class TestEvictionManager(unittest.TestCase):
+    """
+    Tests evicting idle chats and players and reloading them.
+    """
+
+    def setUp(self):
+        self.now = 0
+        self.dispatcher = testing.make_dispatcher()
+        self.evictions = EvictionManager(":memory:", ttl=100, max_chats=10,
+                                         sweep_every=0,
+                                         clock=lambda: self.now)
+        self.dispatcher.bot_data["evictions"] = self.evictions
+        self.update_id = 0
+
+    def tearDown(self):
+        self.evictions.close()
+
+    def send(self, chat_id, user_id, text):
+        self.update_id += 1
+        testing.process(self.dispatcher, testing.make_update(
+            self.update_id, chat_id, user_id, text))
+
+    def game(self, chat_id):
+        return self.dispatcher.chat_data[chat_id]["game"]
+
+    def test_reload_mid_game(self):
+        """
+        A game evicted mid-round reloads and plays to the same winner.
+        """
+        random.seed(7)
+        expected = testing.make_dispatcher()
+        counter = iter(range(10 ** 6))
+        testing.play_game(
+            lambda c, u, t: testing.process(expected, testing.make_update(
+                next(counter), c, u, t)),
+            lambda c: expected.chat_data[c]["game"], -1, [1, 2, 3, 4])
+        expected_game = expected.chat_data[-1]["game"]
+
+        random.seed(7)
+        testing.play_game(self.send, self.game, -1, [1, 2, 3, 4],
+                          max_moves=5)
+        self.now += 200
+        self.send(-2, 9, "/display")
+        self.assertFalse(self.dispatcher.chat_data.get(-1))
+        for user_id in [1, 2, 3, 4]:
+            self.assertFalse(self.dispatcher.user_data.get(user_id))
+        self.assertEqual(self.evictions.stored(), (1, 4))
+
+        self.send(-1, 1, "/display")
+        self.assertEqual(self.evictions.stored(), (0, 0))
+        game = self.game(-1)
+        for player in game.players:
+            self.assertIs(self.dispatcher.user_data[player.p_id]["player"],
+                          player)
+        while True:
+            move = testing.next_move(self.game(-1))
+            if move is None:
+                break
+            self.send(-1, *move)
+        self.assertEqual(self.game(-1).winner, expected_game.winner)
+
+    def test_lru_cap(self):
+        """
+        Beyond the cap the least recently active chats are evicted.
+        """
+        self.evictions.max_chats = 2
+        for chat_id in [-1, -2, -3]:
+            self.now += 1
+            self.send(chat_id, 1, "/newgame")
+        self.assertEqual(list(self.evictions.chats), [-2, -3])
+        self.assertEqual(self.evictions.stored(), (1, 0))
+        self.send(-1, 2, "/join")
+        self.assertEqual(list(self.evictions.chats), [-3, -1])
+
+    def test_topics_evicted_with_chat(self):
+        """
+        A forum chat's topic games are evicted and reloaded with it, still
+        sharing their players with user_data.
+        """
+        random.seed(8)
+        for thread_id, users in [(5, [1, 2, 3]), (6, [4, 5, 6])]:
+            testing.play_game(
+                lambda c, u, t: testing.process(
+                    self.dispatcher, testing.make_update(
+                        0, c, u, t, thread_id=thread_id)),
+                lambda c: None, -1, users, max_moves=0)
+        self.now += 200
+        self.send(-2, 9, "/display")
+        self.assertFalse(self.dispatcher.chat_data.get(-1))
+        self.assertEqual(self.evictions.stored(), (1, 6))
+
+        self.send(-1, 1, "/display")
+        topics = self.dispatcher.chat_data[-1]["topics"]
+        self.assertEqual(sorted(topics), [5, 6])
+        for topic in topics.values():
+            for player in topic["game"].players:
+                self.assertIs(
+                    self.dispatcher.user_data[player.p_id]["player"], player)
+        self.assertEqual(self.evictions.stored(), (0, 0))
+
+    def test_seated_players_stay(self):
+        """
+        Idle players stay in memory while a game they're in is resident.
+        """
+        self.send(-1, 1, "/join")
+        self.now += 50
+        self.send(-1, 2, "/join")
+        self.now += 60
+        self.send(-1, 2, "/display")
+        self.assertIn(1, self.evictions.users)
+        self.assertEqual(self.evictions.stored(), (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
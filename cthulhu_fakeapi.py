@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains a local stand-in for the Telegram Bot API, and a load
+generator that plays games against the real bot through it.
+
+FakeBotAPI is an HTTP server that answers getMe, getUpdates, sendMessage and
+editMessageText the way api.telegram.org does. It can add latency and
+answer some sends with 429 Too Many Requests. Point a telegram.Bot at it
+with base_url=api.base_url, and the bot polls it like the real thing.
+
+LoadGenerator plays full games in many chats at once. Each chat sends its
+next command as soon as the bot has replied to the last one, and the
+generator records how long each reply took.
+"""
+import http.server
+import itertools
+import json
+import queue
+import random
+import threading
+import time
+import urllib.parse
+
+import telegram
+from telegram.ext import TypeHandler
+from telegram.ext import Updater
+
+import cthulhu_game_bot as bot_module
+import cthulhu_lanes
+import cthulhu_testing as testing
+import cthulhu_transport
+
+
+class FakeBotAPI:
+    """
+    A local HTTP server that imitates the Bot API.
+
+    Attributes:
+      token - the bot token the server answers to.
+      latency - seconds to wait before answering each method, by name.
+      flood_rate - the chance that a send is answered with 429.
+      retry_after - the retry_after to send with a 429.
+      updates - updates waiting for getUpdates, oldest first.
+      sent - (time, chat_id, text) for every message the bot sent.
+      calls - the number of calls to each method.
+      floods - the number of sends answered with 429.
+      connections - the number of connections opened to the server.
+      listeners - called as listener(chat_id, text, thread_id) after each
+        send, with the forum topic sent to, or None.
+    """
+    SENDS = ("sendMessage", "editMessageText")
+
+    def __init__(self, token="123456:FAKE", latency=None, flood_rate=0,
+                 retry_after=1, seed=None):
+        self.token = token
+        self.latency = dict(latency or {})
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.updates = []
+        self.sent = []
+        self.calls = {}
+        self.floods = 0
+        self.connections = 0
+        self.listeners = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.condition = threading.Condition()
+        self.server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        """
+        The base_url to give telegram.Bot.
+        """
+        return "http://127.0.0.1:{}/bot".format(self.server.server_port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True, name="fake-bot-api")
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push(self, data):
+        """
+        Queues an update for getUpdates, giving it the next update id.
+        """
+        with self.condition:
+            data = dict(data, update_id=next(self.update_ids))
+            self.updates.append(data)
+            self.condition.notify_all()
+
+    def make_handler(self):
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Replies are written in two parts, which Nagle's algorithm
+            # would hold back for a delayed ACK.
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with api.condition:
+                    api.connections += 1
+
+            def do_GET(self):
+                self.answer(urllib.parse.parse_qsl(
+                    urllib.parse.urlsplit(self.path).query))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                if self.headers.get("Content-Type", "").startswith(
+                        "application/json"):
+                    self.answer(json.loads(body or b"{}").items())
+                else:
+                    self.answer(urllib.parse.parse_qsl(body.decode()))
+
+            def answer(self, params):
+                path = urllib.parse.urlsplit(self.path).path
+                prefix = "/bot{}/".format(api.token)
+                if not path.startswith(prefix):
+                    status, reply = 404, {"ok": False, "error_code": 404,
+                                          "description": "Not Found"}
+                else:
+                    status, reply = api.call(path[len(prefix):],
+                                             dict(params))
+                data = json.dumps(reply).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def call(self, method, params):
+        """
+        Answers one API call.
+
+        Returns:
+          (status, reply) - the HTTP status and the JSON reply.
+        """
+        with self.condition:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency.get(method):
+            time.sleep(self.latency[method])
+        if method == "getMe":
+            return 200, {"ok": True, "result": {
+                "id": int(self.token.split(":")[0]), "is_bot": True,
+                "first_name": "Cthulhu", "username": "cthulhu_test_bot"}}
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self.get_updates(params)}
+        if method in self.SENDS:
+            if self.flood_rate and self.random.random() < self.flood_rate:
+                with self.condition:
+                    self.floods += 1
+                return 429, {
+                    "ok": False, "error_code": 429,
+                    "description": "Too Many Requests: retry after {}".format(
+                        self.retry_after),
+                    "parameters": {"retry_after": self.retry_after}}
+            return 200, {"ok": True, "result": self.send(method, params)}
+        # Anything else (deleteWebhook and the like) just succeeds.
+        return 200, {"ok": True, "result": True}
+
+    def get_updates(self, params):
+        """
+        Returns updates from the offset on, waiting up to the timeout.
+        """
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self.condition:
+            # Updates below the offset are confirmed and can be dropped.
+            while self.updates and self.updates[0]["update_id"] < offset:
+                self.updates.pop(0)
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.updates[:limit]
+
+    def send(self, method, params):
+        """
+        Records a sent or edited message and returns it as a Message.
+        """
+        chat_id = int(params["chat_id"])
+        text = params.get("text", "")
+        thread_id = params.get("message_thread_id")
+        thread_id = None if thread_id is None else int(thread_id)
+        if method == "editMessageText":
+            message_id = int(params["message_id"])
+        else:
+            message_id = next(self.message_ids)
+        with self.condition:
+            self.sent.append((time.perf_counter(), chat_id, text))
+        for listener in self.listeners:
+            listener(chat_id, text, thread_id)
+        message = {"message_id": message_id, "date": int(time.time()),
+                   "chat": {"id": chat_id,
+                            "type": "private" if chat_id > 0 else "group"},
+                   "text": text}
+        if thread_id is not None:
+            message.update(message_thread_id=thread_id, is_topic_message=True)
+        return message
+
+
+def start_bot(api, workers=4, lanes=False):
+    """
+    Starts the real bot polling a FakeBotAPI.
+
+    Arguments:
+      api - the FakeBotAPI to poll.
+      workers - the Dispatcher's workers, for handlers run asynchronously.
+      lanes - if True, handle updates in priority lanes, as main() does.
+
+    Returns:
+      updater - the bot's Updater. Call updater.stop() when done.
+    """
+    if lanes:
+        bot = telegram.Bot(api.token, base_url=api.base_url,
+                           request=cthulhu_transport.PooledRequest(
+                               cthulhu_lanes.POOL_SIZE))
+        dispatcher = cthulhu_lanes.LaneDispatcher(
+            bot, queue.Queue(), bot_module.command_lanes,
+            context_types=bot_module.CONTEXT_TYPES)
+        updater = Updater(dispatcher=dispatcher, workers=None)
+    else:
+        bot = telegram.Bot(api.token, base_url=api.base_url,
+                           request=cthulhu_transport.PooledRequest(
+                               workers + 4))
+        updater = Updater(bot=bot, use_context=True, workers=workers,
+                          context_types=bot_module.CONTEXT_TYPES)
+    bot_module.add_handlers(updater.dispatcher)
+    updater.start_polling(poll_interval=0, timeout=1)
+    return updater
+
+
+class LoadGenerator:
+    """
+    Plays full games in many chats at once against a bot polling a
+    FakeBotAPI, one command per chat in flight at a time.
+
+    Moves are chosen by peeking at the bot's games (see
+    cthulhu_testing.next_move), so the games are played honestly to the end.
+    A chat's next command is sent once the bot's dispatcher has finished
+    with the last one.
+
+    Attributes:
+      chat_ids - the chats played in.
+      tables - the games played: chat ids, or (chat id, topic) pairs when
+        the games share a forum chat.
+      latencies - seconds from each command to the bot's first reply in
+        that chat.
+      commands - the number of commands sent.
+    """
+    # The handler group that hears about each update after the bot's own.
+    GROUP = 1000
+
+    def __init__(self, api, dispatcher, n_chats, players=5, first_chat=-1,
+                 topics=False):
+        """
+        Arguments:
+          api - the FakeBotAPI the bot polls.
+          dispatcher - the bot's dispatcher.
+          n_chats - the number of games to play.
+          players - the number of players in each game.
+          first_chat - the id of the first chat played in.
+          topics - if True, play every game in its own forum topic of one
+            chat, rather than each in a chat of its own.
+        """
+        self.api = api
+        self.dispatcher = dispatcher
+        self.scripts = {}
+        self.chat_ids = [first_chat] if topics else []
+        self.tables = []
+        self.sent_at = {}
+        self.latencies = []
+        self.commands = 0
+        self.ready = []
+        self.condition = threading.Condition()
+        for c in range(n_chats):
+            table = (first_chat, c + 1) if topics else first_chat - c
+            users = [c * players + i + 1 for i in range(players)]
+            self.scripts[table] = self.script(table, users)
+            self.tables.append(table)
+            if not topics:
+                self.chat_ids.append(table)
+        api.listeners.append(self.on_send)
+        self.handler = TypeHandler(telegram.Update, self.on_processed)
+        dispatcher.add_handler(self.handler, group=self.GROUP)
+
+    def game(self, table):
+        """
+        Returns the bot's game at a table, or None.
+        """
+        if isinstance(table, tuple):
+            data = bot_module.table_data(self.dispatcher, *table)
+        else:
+            data = self.dispatcher.chat_data[table]
+        return data.get("game")
+
+    def script(self, table, users):
+        """
+        Yields a table's commands as (user_id, text), choosing each move
+        after the last one has been handled.
+        """
+        yield users[0], "/newgame"
+        for user_id in users:
+            yield user_id, "/join"
+        yield users[0], "/startgame"
+        while True:
+            move = testing.next_move(self.game(table))
+            if move is None:
+                return
+            yield move
+
+    def on_send(self, chat_id, text, thread_id=None):
+        """
+        Notes the bot's first reply to a table's command.
+        """
+        table = chat_id if thread_id is None else (chat_id, thread_id)
+        with self.condition:
+            sent_at = self.sent_at.pop(table, None)
+            if sent_at is not None:
+                self.latencies.append(time.perf_counter() - sent_at)
+
+    def on_processed(self, update, context):
+        """
+        Marks a table ready for its next command.
+        """
+        table = cthulhu_lanes.table_key(update)
+        if table not in self.scripts:
+            # Someone else's traffic, such as a burst of /rules.
+            return
+        with self.condition:
+            self.ready.append(table)
+            self.condition.notify()
+
+    def next_command(self, table):
+        """
+        Sends a table's next command. Returns False once its game is over.
+        """
+        move = next(self.scripts[table], None)
+        if move is None:
+            del self.scripts[table]
+            return False
+        with self.condition:
+            self.sent_at[table] = time.perf_counter()
+            self.commands += 1
+        if isinstance(table, tuple):
+            chat_id, thread_id = table
+        else:
+            chat_id, thread_id = table, None
+        self.api.push(testing.make_update(0, chat_id, *move,
+                                          thread_id=thread_id))
+        return True
+
+    def run(self, timeout=600):
+        """
+        Plays every table's game to the end.
+
+        Returns:
+          elapsed - the seconds it took.
+        """
+        start = time.perf_counter()
+        for table in list(self.scripts):
+            self.next_command(table)
+        deadline = time.monotonic() + timeout
+        while self.scripts:
+            with self.condition:
+                while not self.ready:
+                    if not self.condition.wait(deadline - time.monotonic()):
+                        raise TimeoutError("The bot stopped replying.")
+                ready, self.ready = self.ready, []
+            for table in ready:
+                self.next_command(table)
+        self.dispatcher.remove_handler(self.handler, group=self.GROUP)
+        return time.perf_counter() - start
+
+    def percentiles(self, points=(50, 90, 99)):
+        """
+        Returns reply latency percentiles in seconds, keyed by percentile.
+        """
+        ordered = sorted(self.latencies)
+        return {p: ordered[min(len(ordered) - 1, len(ordered) * p // 100)]
+                for p in points}
@@ -0,0 +1,91 @@
+from cthulhu_fakeapi import *
+import cthulhu_testing as testing
+import random
+import telegram
+import unittest
+
+
+class TestFakeBotAPI(unittest.TestCase):
+    """
+    Tests the fake Bot API with a real telegram.Bot.
+    """
+
+    def setUp(self):
+        self.api = FakeBotAPI(seed=0).start()
+        self.bot = telegram.Bot(self.api.token, base_url=self.api.base_url)
+
+    def tearDown(self):
+        self.api.stop()
+
+    def test_methods(self):
+        """
+        getMe, getUpdates, sendMessage and editMessageText behave like the
+        real API.
+        """
+        self.assertEqual(self.bot.username, "cthulhu_test_bot")
+        self.api.push(testing.make_update(0, -1, 1, "/newgame"))
+        self.api.push(testing.make_update(0, -1, 2, "/join"))
+        updates = self.bot.get_updates(timeout=0)
+        self.assertEqual([u.message.text for u in updates],
+                         ["/newgame", "/join"])
+        updates = self.bot.get_updates(offset=updates[1].update_id + 1,
+                                       timeout=0)
+        self.assertEqual(updates, [])
+        message = self.bot.send_message(chat_id=-1, text="board")
+        self.assertEqual(message.chat.id, -1)
+        self.bot.edit_message_text(chat_id=-1, message_id=message.message_id,
+                                   text="new board")
+        self.assertEqual([(c, t) for _, c, t in self.api.sent],
+                         [(-1, "board"), (-1, "new board")])
+
+    def test_flood_control(self):
+        """
+        Injected 429s surface as RetryAfter.
+        """
+        self.api.flood_rate = 1
+        self.api.retry_after = 3
+        with self.assertRaises(telegram.error.RetryAfter) as caught:
+            self.bot.send_message(chat_id=-1, text="board")
+        self.assertEqual(caught.exception.retry_after, 3)
+        self.assertEqual(self.api.floods, 1)
+        self.assertEqual(self.api.sent, [])
+
+    def test_load_generator(self):
+        """
+        The load generator plays every chat's game to the end through the
+        real bot.
+        """
+        random.seed(4)
+        updater = start_bot(self.api)
+        try:
+            generator = LoadGenerator(self.api, updater.dispatcher, 3)
+            generator.run(timeout=60)
+        finally:
+            updater.stop()
+        for chat_id in generator.chat_ids:
+            game = updater.dispatcher.chat_data[chat_id]["game"]
+            self.assertEqual(game.game_status, "Ended")
+        self.assertEqual(len(generator.latencies), generator.commands)
+
+    def test_load_generator_topics(self):
+        """
+        Games in the forum topics of one chat play to the end side by side,
+        each answered in its own topic.
+        """
+        random.seed(5)
+        updater = start_bot(self.api, lanes=True)
+        try:
+            generator = LoadGenerator(self.api, updater.dispatcher, 3,
+                                      topics=True)
+            generator.run(timeout=60)
+        finally:
+            updater.stop()
+        self.assertEqual(generator.tables, [(-1, 1), (-1, 2), (-1, 3)])
+        for table in generator.tables:
+            self.assertEqual(generator.game(table).game_status, "Ended")
+        self.assertNotIn("game", updater.dispatcher.chat_data[-1])
+        self.assertEqual(len(generator.latencies), generator.commands)
+
+
+if __name__ == "__main__":
+    unittest.main()
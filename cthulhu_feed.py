@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the spectator feed, which DMs spectators an omniscient
+board after every move.
+
+Handlers only hand the feed a board that has already been rendered; a
+background thread fans it out. The players' own replies therefore never
+wait on spectators. If a chat makes another move before its last board has
+gone out, the newer board replaces the queued one, since spectators only
+need the latest state.
+
+If the bot has an Outbox, the feed hands its DMs to it rather than sending
+them itself, so they share the bot's budget and survive 429s.
+"""
+import collections
+import logging
+import threading
+import time
+
+from telegram.error import TelegramError
+
+
+class SpectatorFeed:
+    """
+    Sends shared payloads to groups of spectators from a background thread.
+
+    Attributes:
+      bot - the bot to send with.
+      outbox - Optional. The Outbox to queue DMs in instead.
+      interval - the minimum number of seconds between two messages.
+      pending - maps a chat's id to (recipients, text) still to be sent.
+      sent - the number of messages sent.
+      coalesced - the number of boards replaced before they were sent.
+    """
+
+    def __init__(self, bot, rate=30, outbox=None):
+        """
+        Arguments:
+          bot - the bot to send with.
+          rate - the most messages to send per second. Telegram allows
+            about 30 per second across all chats.
+          outbox - Optional. The Outbox to queue DMs in instead, which
+            paces them itself.
+        """
+        self.bot = bot
+        self.outbox = outbox
+        self.interval = 1 / rate
+        self.pending = collections.OrderedDict()
+        self.sent = 0
+        self.coalesced = 0
+        self.busy = False
+        self.stopped = False
+        self.next_send = 0
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name="spectator-feed")
+        self.thread.start()
+
+    def publish(self, chat_id, recipients, text):
+        """
+        Queues a board for a chat's spectators, replacing any queued board.
+
+        Arguments:
+          chat_id - the chat the board belongs to, or (chat id, topic) for
+            a game in a forum topic.
+          recipients - the user ids to DM.
+          text - the rendered board, shared by every recipient.
+        """
+        with self.condition:
+            if chat_id in self.pending:
+                self.coalesced += 1
+            self.pending[chat_id] = (tuple(recipients), text)
+            self.condition.notify_all()
+
+    def run(self):
+        """
+        Sends queued boards until the feed is stopped.
+        """
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                chat_id, (recipients, text) = self.pending.popitem(last=False)
+                self.busy = True
+            for user_id in recipients:
+                if self.outbox is not None:
+                    self.outbox.send(user_id, text)
+                    self.sent += 1
+                    continue
+                self.throttle()
+                try:
+                    self.bot.send_message(chat_id=user_id, text=text)
+                    self.sent += 1
+                except TelegramError as err:
+                    # Spectators who never started the bot can't be DMed.
+                    logging.warning("Spectator %s in chat %s: %s", user_id,
+                                    chat_id, err)
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def throttle(self):
+        """
+        Sleeps until the next message may be sent.
+        """
+        now = time.monotonic()
+        if now < self.next_send:
+            time.sleep(self.next_send - now)
+            now = self.next_send
+        self.next_send = now + self.interval
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued board has been sent.
+
+        Returns:
+          done - False if the timeout ran out first.
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not self.pending and not self.busy, timeout)
+
+    def stop(self):
+        """
+        Stops the background thread, dropping anything still queued.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
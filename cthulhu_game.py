@@ -7,11 +7,15 @@ Created on Thu Mar 22 11:18:11 2018
 This module implements classes needed for a game of Cthulhu.
 
 TODO: Implement better errors.
-TODO: Implement game settings.
 """
+import collections
+import functools
+import itertools
 import random
+import re
+import threading
+import types
 import emojis
-import itertools
 
 class GameError(Exception):
     """
@@ -24,42 +28,96 @@ class GameError(Exception):
 
 class InvalidSettingsError(GameError):
     """
+    Raised when game settings, or the rules data they rely on, are invalid.
     """
     pass
 
 
-class Card:
+# Player statuses and roles. Comparing against these shared strings is as
+# cheap as comparing enums, and they pickle as plain strings.
+IDLE = "Idle"
+PLAYING = "Playing"
+SPECTATING = "Spectating"
+INVESTIGATOR = "Investigator"
+CULTIST = "Cultist"
+
+
+class Slotted:
+    """
+    A base for classes that keep their attributes in __slots__ rather than
+    a __dict__, since there is one per user or card.
+
+    Pickles hold the attributes as a plain dict, so state pickled before a
+    class had __slots__ (on disk, or mid-handoff) still loads.
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for cls in type(self).__mro__
+                for name in getattr(cls, "__slots__", ())
+                if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = dict(state[0] or {}, **state[1])
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+# The data of a card type that isn't in the card table.
+NULL_CARD = ("Null", "A blank card. Should not be in the game.", "null")
+
+
+class Card(Slotted):
     """
     A card for games of Don't Mess with Cthulhu.
 
+    A card only holds whether it's face-up and a reference to its type's
+    row in the card table, which every card of that type shares.
+
     Attributes:
       title - the title of the card.
       description - a description of what the card does.
       symbol - the symbolic representation of the card.
       is_flipped - whether the card has been revealed.
     """
+    __slots__ = ("data", "is_flipped")
 
-    def __init__(self, ctype=None):
+    def __init__(self, ctype=None, cards=None):
         """
         Initializes a card with default information.
 
         Arguments:
           type - Optional. If a type of card is specified, will load info.
+          cards - Optional. The card table to look the type up in (see
+            Ruleset.cards). Defaults to the shared ruleset's.
         """
-        self.title = "Null"
-        self.description = "A blank card. Should not be in the game."
-        self.symbol = "null"
-        word_len = len(ctype)
-        # Scan for extant data.
-        with open("card_information/card_data.txt") as f:
-            for line in f:
-                if ctype==line[0:word_len]:
-                    card_data = line.rstrip().split(",")
-                    self.title = card_data[0]
-                    self.description = card_data[1]
-                    self.symbol = emojis.encode(":{}:".format(card_data[2]))
+        # Look up the card's data.
+        if cards is None:
+            cards = get_ruleset().cards
+        self.data = cards.get(ctype) or NULL_CARD
         self.is_flipped = False
 
+    def __setstate__(self, state):
+        # Cards pickled before they had __slots__ kept their data inline.
+        if isinstance(state, dict) and "title" in state:
+            state = {"data": (state["title"], state["description"],
+                              state["symbol"]),
+                     "is_flipped": state["is_flipped"]}
+        Slotted.__setstate__(self, state)
+
+    @property
+    def title(self):
+        return self.data[0]
+
+    @property
+    def description(self):
+        return self.data[1]
+
+    @property
+    def symbol(self):
+        return self.data[2]
+
     def __str__(self):
         """
         Returns the symbolic representation of the card.
@@ -90,7 +148,7 @@ class Card:
         self.is_flipped = False
 
 
-class PlayerGameData:
+class PlayerGameData(Slotted):
     """
     A class containing relevant data for a player in a game of Cthulhu.
 
@@ -101,6 +159,8 @@ class PlayerGameData:
       claim - what the player claims to have.
       has_flashlight - whether the player has the flashlight.
     """
+    __slots__ = ("role", "cards", "can_claim", "claim", "has_flashlight")
+
     def __init__(self, role):
         """
         Initialize a player as though they're starting a game.
@@ -112,7 +172,7 @@ class PlayerGameData:
         self.has_flashlight = False
 
 
-class PlayerStats:
+class PlayerStats(Slotted):
     """
     A class containing statistics about a player's win record.
 
@@ -122,6 +182,8 @@ class PlayerStats:
         ngiw - Number of games player has won as an investigator.
         ngil - Number of games player has lost as an investigator.
     """
+    __slots__ = ("ngcw", "ngcl", "ngiw", "ngil")
+
     def __init__(self):
         """
         Initialize all stats to 0.
@@ -132,7 +194,7 @@ class PlayerStats:
         self.ngil = 0
 
 
-class Player:
+class Player(Slotted):
     """
     A player for games of Don't Mess with Cthulhu.
 
@@ -143,6 +205,7 @@ class Player:
         game_data - if the player is in a game, the data associated with it.
         stats - a dictionary containing a lot of player stats.
     """
+    __slots__ = ("p_id", "nickname", "status", "game_data", "stats")
 
     def __init__(self, player_id, nickname=None):
         """
@@ -153,9 +216,8 @@ class Player:
           nickname - Optional. The player's name.
         """
         self.p_id = player_id
-        if nickname:
-            self.nickname = nickname
-        self.status = "Idle"
+        self.nickname = nickname
+        self.status = IDLE
         self.game_data = None
         self.stats = PlayerStats()
 
@@ -167,18 +229,18 @@ class Player:
           Game Error - If the player wasn't in pending game.
         """
         self.game_data = PlayerGameData(role)
-        self.status = "Playing"
+        self.status = PLAYING
         self.game_data.can_claim = True
 
     def start_spectating(self):
         # Todo
-        self.status = "Spectating"
+        self.status = SPECTATING
 
     def __str__(self):
         """
         Returns the players name.
         """
-        return self.nickname
+        return self.nickname or str(self.p_id)
 
     def set_hand(self, hand):
         """
@@ -237,7 +299,7 @@ class Player:
           GameError - if the player is not in a game.
         """
         contents = ""
-        if self.status != "Playing":
+        if self.status != PLAYING:
             raise GameError("Not currently playing a game.")
         return self.game_data.role
 
@@ -261,23 +323,34 @@ class Player:
         Displays the player's claim in symbolic form.
         """
         display = ""
+        if not self.game_data.claim:
+            return display
         for card in self.game_data.claim:
             display += card.symbol
         return display
 
     def reveal_card(self, pos=None):
+        """
+        Flips one of this player's face-down cards.
+
+        Arguments:
+          pos - Optional. The position of the card to flip.
+
+        Returns:
+          card - the card that was revealed.
+        """
         # Flip a specific card.
-        if pos:
-            if not self.game_data.cards[pos].is_flipped:
+        if pos is not None:
+            card = self.game_data.cards[pos]
+            if card.is_flipped:
                 raise GameError("No card to flip!")
-            else:
-                self.game_data.cards[pos].flip_up()
-                return
+            card.flip_up()
+            return card
         # Otherwise, just flip the first card.
         for card in self.game_data.cards:
             if not card.is_flipped:
                 card.flip_up()
-                return
+                return card
         raise GameError("All cards are faceup!")
 
     def toggle_flashlight(self):
@@ -295,6 +368,10 @@ class GameSettings:
       expansions - a list of expansions being used.
       min_players - the minimum number of players.
       max_players - the maximum number of players.
+      turn_timeout - seconds to wait for a move before nudging the player,
+        or None to wait forever.
+      nudges - how many nudges a player gets before the bot moves for them,
+        or None to never move for them.
     """
 
     def __init__(self):
@@ -304,6 +381,707 @@ class GameSettings:
         self.expansions = []
         self.min_players = 3
         self.max_players = 10
+        self.turn_timeout = 120
+        self.nudges = 2
+
+    def copy(self):
+        """
+        Returns an independent copy of these settings.
+        """
+        settings = GameSettings()
+        settings.expansions = list(self.expansions)
+        settings.min_players = self.min_players
+        settings.max_players = self.max_players
+        settings.turn_timeout = self.turn_timeout
+        settings.nudges = self.nudges
+        return settings
+
+    def validate(self, ruleset):
+        """
+        Checks these settings against a ruleset.
+
+        Raises:
+          InvalidSettingsError - if the settings can't be played.
+        """
+        if self.min_players > self.max_players:
+            raise InvalidSettingsError("The minimum number of players is "
+                                       "above the maximum.")
+        if (self.min_players < ruleset.min_players or
+                self.max_players > ruleset.max_players):
+            raise InvalidSettingsError(
+                "Games need between {} and {} players.".format(
+                    ruleset.min_players, ruleset.max_players))
+        if self.turn_timeout is not None and self.turn_timeout <= 0:
+            raise InvalidSettingsError("The turn timeout must be positive.")
+        if self.nudges is not None and self.nudges < 0:
+            raise InvalidSettingsError("The number of nudges can't be "
+                                       "negative.")
+        for expansion in self.expansions:
+            if expansion not in ruleset.expansions:
+                raise InvalidSettingsError(
+                    "Unknown expansion: {}".format(expansion))
+
+
+# Names of the expansions a game can use.
+NECRONOMICON = "Necronomicon"
+OBJECTS_OF_POWER = "Objects of Power"
+
+
+class CardEffect:
+    """
+    The rules attached to one type of card.
+
+    A game only wires in the hooks of card types that are actually in its
+    deck (see Game.compile_effects), so cards from unused expansions cost
+    nothing during play. Hooks that aren't overridden are never called.
+
+    Attributes:
+      title - the title of the card this effect belongs to.
+      expansion - the expansion the card comes from, or None for the base game.
+      copies - how many copies an expansion adds to the deck.
+    """
+    title = None
+    expansion = None
+    copies = 0
+
+    def on_reveal(self, game, user, target, card):
+        """
+        Called when the card is revealed by an investigation.
+
+        Arguments:
+          game - the game being played.
+          user - the player who investigated.
+          target - the player whose card was revealed.
+          card - the revealed card.
+
+        Returns:
+          notes - a list of (recipient, text) pairs. A recipient of None means
+            the whole chat; otherwise the note is for that player only.
+        """
+        return []
+
+    def on_round_end(self, game):
+        """
+        Called when a round ends, before cards are collected.
+        """
+        pass
+
+    def check_winner(self, game):
+        """
+        Modifies the win conditions. Returns the winning team or None.
+        """
+        return None
+
+
+class BlankEffect(CardEffect):
+    title = "Blank"
+
+
+class ElderSignEffect(CardEffect):
+    title = "Elder Sign"
+
+    def on_reveal(self, game, user, target, card):
+        game.signs_found += 1
+        return []
+
+
+class CthulhuEffect(CardEffect):
+    title = "Cthulhu"
+
+    def on_reveal(self, game, user, target, card):
+        game.cthulhus_found += 1
+        return []
+
+
+class NecronomiconEffect(CardEffect):
+    title = "Necronomicon"
+    expansion = NECRONOMICON
+    copies = 1
+
+    def on_reveal(self, game, user, target, card):
+        if game.signs_found == 0:
+            game.necronomicon_cursed = True
+            return [(None, "The Necronomicon was found before any Elder Sign!")]
+        game.signs_found += 1
+        return [(None, "The Necronomicon counts as an Elder Sign.")]
+
+    def check_winner(self, game):
+        if game.necronomicon_cursed:
+            return CULTIST
+        return None
+
+
+class ParanoiaEffect(CardEffect):
+    title = "Paranoia"
+    expansion = OBJECTS_OF_POWER
+    copies = 1
+
+    def on_reveal(self, game, user, target, card):
+        game.flashlight_lock = target
+        return [(None, "{} is paranoid and keeps the flashlight for the rest "
+                       "of the round.".format(target))]
+
+    def on_round_end(self, game):
+        game.flashlight_lock = None
+
+
+class PrescientVisionEffect(CardEffect):
+    title = "Prescient Vision"
+    expansion = OBJECTS_OF_POWER
+    copies = 1
+
+    def on_reveal(self, game, user, target, card):
+        hidden = [c for c in target.game_data.cards if not c.is_flipped]
+        if not hidden:
+            return []
+        seen = random.choice(hidden)
+        return [(user, "Prescient Vision: {} has a {} face-down.".format(
+                     target, seen.title))]
+
+
+class EvilPresenceEffect(CardEffect):
+    title = "Evil Presence"
+    expansion = OBJECTS_OF_POWER
+    copies = 1
+
+    def on_reveal(self, game, user, target, card):
+        kept = []
+        for c in target.game_data.cards:
+            if c.is_flipped:
+                kept.append(c)
+            else:
+                game.deck.append(c)
+        target.game_data.cards = kept
+        return [(None, "An Evil Presence returns {}'s face-down cards to the "
+                       "reshuffle pile.".format(target))]
+
+
+class PrivateEyeEffect(CardEffect):
+    title = "Private Eye"
+    expansion = OBJECTS_OF_POWER
+    copies = 1
+
+    def on_reveal(self, game, user, target, card):
+        return [(user, "Private Eye: {} is a {}.".format(
+                     target, target.game_data.role))]
+
+
+class InsanitysGraspEffect(CardEffect):
+    title = "Insanity's Grasp"
+    expansion = OBJECTS_OF_POWER
+    copies = 1
+
+    def on_reveal(self, game, user, target, card):
+        game.silenced.append(target)
+        return [(None, "{} is in Insanity's Grasp and can't claim this "
+                       "round.".format(target))]
+
+    def on_round_end(self, game):
+        game.silenced = []
+
+
+class MirageEffect(CardEffect):
+    title = "Mirage"
+    expansion = OBJECTS_OF_POWER
+    copies = 1
+
+    def on_reveal(self, game, user, target, card):
+        # A Necronomicon only stays in play once it has counted as an Elder
+        # Sign (otherwise the Cultists have already won), so it can be
+        # returned too. Prefer signs from earlier rounds, then this round's.
+        signs = ("Elder Sign", "Necronomicon")
+        for c in game.discard:
+            if c.title in signs:
+                game.discard.remove(c)
+                break
+        else:
+            for p in game.get_active_players():
+                found = [c for c in p.game_data.cards
+                         if c.is_flipped and c.title in signs]
+                if found:
+                    c = found[0]
+                    p.game_data.cards.remove(c)
+                    break
+            else:
+                return []
+        c.flip_down()
+        game.deck.append(c)
+        game.signs_found -= 1
+        return [(None, "A Mirage! An Elder Sign returns to the reshuffle "
+                       "pile.")]
+
+
+# Every card's effect, keyed by card title.
+CARD_EFFECTS = {effect.title: effect for effect in [
+    BlankEffect(), ElderSignEffect(), CthulhuEffect(), NecronomiconEffect(),
+    ParanoiaEffect(), PrescientVisionEffect(), EvilPresenceEffect(),
+    PrivateEyeEffect(), InsanitysGraspEffect(), MirageEffect()]}
+
+
+class Ruleset:
+    """
+    The rules of the game, read once from the data files and then shared,
+    read-only, by every game.
+
+    Attributes:
+      min_players - the fewest players a game can have.
+      max_players - the most players a game can have.
+      cards - card title -> (title, description, symbol).
+      roles - player count -> a tuple of role cards. These are shuffled and
+        dealt one per player; any left over are set aside unseen.
+      expansions - the expansions that add cards.
+      recipes - (player count, frozenset of expansions) -> a tuple of the
+        card titles in the deck.
+    """
+
+    def __init__(self, role_path="roles/role_info.txt",
+                 card_path="card_information/card_data.txt",
+                 min_players=3, max_players=10):
+        """
+        Reads and validates the rules.
+
+        Raises:
+          InvalidSettingsError - if the data files don't describe a game.
+        """
+        self._args = (role_path, card_path, min_players, max_players)
+        self.min_players = min_players
+        self.max_players = max_players
+        self.cards = types.MappingProxyType(self.read_cards(card_path))
+        self.roles = types.MappingProxyType(self.read_roles(role_path))
+        self.expansions = frozenset(effect.expansion
+                                    for effect in CARD_EFFECTS.values()
+                                    if effect.expansion)
+        recipes = {}
+        for n_players in range(min_players, max_players + 1):
+            for size in range(len(self.expansions) + 1):
+                for used in itertools.combinations(sorted(self.expansions),
+                                                   size):
+                    used = frozenset(used)
+                    recipes[(n_players, used)] = self.make_recipe(n_players,
+                                                                  used)
+        self.recipes = types.MappingProxyType(recipes)
+        self.validate()
+
+    def __reduce__(self):
+        """
+        Pickles a ruleset as the files it was read from, so games holding it
+        can be pickled. The shared ruleset unpickles as the shared ruleset.
+        """
+        if self is get_ruleset():
+            return (get_ruleset, ())
+        return (Ruleset, self._args)
+
+    @staticmethod
+    def read_cards(path):
+        """
+        Reads card titles, descriptions and symbols.
+        """
+        cards = {}
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                title, description, symbol = line.rstrip().split(",")
+                cards[title] = (title, description,
+                                emojis.encode(":{}:".format(symbol)))
+        return cards
+
+    def read_roles(self, path):
+        """
+        Reads how many investigators and cultists each player count has.
+        """
+        roles = {}
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                n_players, n_investigators, n_cultists = (
+                    int(x) for x in line.rstrip().split(","))
+                if self.min_players <= n_players <= self.max_players:
+                    roles[n_players] = ((INVESTIGATOR,) * n_investigators +
+                                        (CULTIST,) * n_cultists)
+        return roles
+
+    @staticmethod
+    def make_recipe(n_players, expansions):
+        """
+        Lists the cards in the deck for a number of players.
+
+        Cards from expansions replace Blanks, so the deck always holds five
+        cards per player.
+        """
+        deck = ["Cthulhu"]
+        # Big games get a second Cthulhu.
+        if n_players > 8:
+            deck.append("Cthulhu")
+        deck += ["Elder Sign"] * n_players
+        for effect in CARD_EFFECTS.values():
+            if effect.expansion in expansions:
+                deck += [effect.title] * effect.copies
+        deck += ["Blank"] * ((n_players * 5) - len(deck))
+        return tuple(deck)
+
+    def validate(self):
+        """
+        Checks that every supported player count can be played.
+
+        Raises:
+          InvalidSettingsError - if the rules are inconsistent.
+        """
+        for title in CARD_EFFECTS:
+            if title not in self.cards:
+                raise InvalidSettingsError(
+                    "No card data for {}.".format(title))
+        for n_players in range(self.min_players, self.max_players + 1):
+            roles = self.roles.get(n_players)
+            if not roles or len(roles) < n_players:
+                raise InvalidSettingsError(
+                    "No valid role setup for {} players.".format(n_players))
+            if CULTIST not in roles or INVESTIGATOR not in roles:
+                raise InvalidSettingsError(
+                    "{} players need both teams.".format(n_players))
+        for (n_players, used), recipe in self.recipes.items():
+            if (len(recipe) != n_players * 5 or
+                    recipe.count("Elder Sign") != n_players or
+                    "Cthulhu" not in recipe):
+                raise InvalidSettingsError(
+                    "Invalid deck for {} players.".format(n_players))
+
+    def deck_recipe(self, n_players, expansions=()):
+        """
+        Returns the card titles in the deck for a game.
+
+        Raises:
+          InvalidSettingsError - if there's no such deck.
+        """
+        try:
+            return self.recipes[(n_players, frozenset(expansions))]
+        except KeyError:
+            raise InvalidSettingsError("There's no deck for that game.")
+
+
+@functools.lru_cache(maxsize=None)
+def get_ruleset():
+    """
+    Returns the ruleset shared by all games, loading it the first time.
+    """
+    return Ruleset()
+
+
+# What a player claims to hold.
+Claim = collections.namedtuple("Claim", ["blank", "elder", "cthulhu"])
+
+# Who a command targets: a seat number (from 1) or a name, never both.
+Target = collections.namedtuple("Target", ["seat", "name"])
+
+# "/claim 2", "/claim C", "/claim 1 1", "/claim 2 C" and "/claim rock".
+CLAIM_PATTERN = re.compile(
+    r"^(?:(?P<rock>rock)|(?P<elder>\d+)?\s*(?P<cthulhu>c(?:thulhu)?|\d+)?)$",
+    re.IGNORECASE)
+
+# "/investigate 3", "/investigate #3" or "/investigate name".
+TARGET_PATTERN = re.compile(r"^(?:#?(?P<seat>\d+)|(?P<name>.+))$")
+
+
+def parse_claim(args, hand_size):
+    """
+    Parses the arguments of /claim.
+
+    Arguments:
+      args - the command's arguments.
+      hand_size - the number of cards in the claimant's hand.
+
+    Returns:
+      claim - a Claim, with Blanks making up the rest of the hand.
+
+    Raises:
+      GameError - if the claim is invalid.
+    """
+    match = CLAIM_PATTERN.match(" ".join(args).strip())
+    if not match:
+        raise GameError("Invalid claim!")
+    elder = int(match.group("elder") or 0)
+    cthulhu = match.group("cthulhu") or "0"
+    cthulhu = int(cthulhu) if cthulhu.isdigit() else 1
+    if elder + cthulhu > hand_size:
+        raise GameError("Invalid claim!")
+    return Claim(hand_size - elder - cthulhu, elder, cthulhu)
+
+
+def parse_target(args):
+    """
+    Parses the arguments of /investigate.
+
+    Returns:
+      target - a Target.
+
+    Raises:
+      GameError - if no target was given.
+    """
+    match = TARGET_PATTERN.match(" ".join(args).strip())
+    if not match:
+        raise GameError("Who do you want to investigate? Try "
+                        "/investigate [name or seat].")
+    if match.group("seat"):
+        return Target(int(match.group("seat")), None)
+    return Target(None, match.group("name"))
+
+
+class NameIndex:
+    """
+    Finds the seated players of a game by seat number or name.
+
+    Names are case-folded into a prefix trie, so a lookup costs one step per
+    character no matter how many players or spectators there are. A name may
+    be abbreviated to any prefix only one player has; an exact name always
+    wins over a longer name it is a prefix of.
+
+    Attributes:
+      seats - the seated players, in seat order (seat 1 first).
+    """
+    # Trie node keys for the player whose name ends here, and for the player
+    # (or AMBIGUOUS) whose names pass through here.
+    END = "\0end"
+    ONLY = "\0only"
+    AMBIGUOUS = object()
+
+    def __init__(self, players):
+        self.seats = tuple(players)
+        self.root = {}
+        for player in self.seats:
+            node = self.root
+            for char in str(player).casefold():
+                node = node.setdefault(char, {})
+                if node.get(self.ONLY, player) is not player:
+                    node[self.ONLY] = self.AMBIGUOUS
+                else:
+                    node[self.ONLY] = player
+            node[self.END] = player
+
+    def by_seat(self, seat):
+        """
+        Returns the player in a seat (counting from 1), or None.
+        """
+        if 1 <= seat <= len(self.seats):
+            return self.seats[seat - 1]
+        return None
+
+    def by_name(self, name):
+        """
+        Returns the player a name or unique prefix belongs to, or None.
+
+        Raises:
+          GameError - if the prefix matches more than one player.
+        """
+        node = self.root
+        for char in name.strip().casefold():
+            node = node.get(char)
+            if node is None:
+                return None
+        if self.END in node:
+            return node[self.END]
+        player = node.get(self.ONLY)
+        if player is self.AMBIGUOUS:
+            raise GameError("\"{}\" matches more than one player.".format(
+                name))
+        return player
+
+    def find(self, target):
+        """
+        Returns the player a Target refers to.
+
+        Raises:
+          GameError - if there's no such player.
+        """
+        if target.seat is not None:
+            player = self.by_seat(target.seat)
+        else:
+            player = self.by_name(target.name)
+        if player is None:
+            raise GameError("That doesn't seem to be a player.")
+        return player
+
+
+# Telegram's limit on a message's length, in UTF-16 code units.
+MESSAGE_LIMIT = 4096
+
+
+def message_length(text):
+    """
+    Returns a text's length as Telegram counts it, in UTF-16 code units.
+    Most emoji count twice.
+    """
+    return len(text.encode("utf-16-le")) // 2
+
+
+def chunk_lines(lines, limit=MESSAGE_LIMIT):
+    """
+    Joins lines into messages no longer than limit, yielding each one as
+    soon as the next line wouldn't fit, so only one message is ever held.
+    A line too long for a message of its own is split.
+    """
+    chunk = []
+    size = -1
+    for line in lines:
+        if not chunk and not line:
+            # A message can't start with a blank line, or be one, and
+            # trailing ones are stripped.
+            continue
+        length = message_length(line)
+        while length > limit:
+            if chunk:
+                yield "\n".join(chunk).rstrip("\n")
+                chunk, size = [], -1
+            # Every code point is at most two code units.
+            yield line[:limit // 2]
+            line = line[limit // 2:]
+            length = message_length(line)
+        if size + 1 + length > limit:
+            yield "\n".join(chunk).rstrip("\n")
+            chunk, size = [], -1
+        chunk.append(line)
+        size += 1 + length
+    if chunk:
+        yield "\n".join(chunk).rstrip("\n")
+
+
+class RoundLog(Slotted):
+    """
+    What happened in one round of a game, for its end-of-game report.
+
+    Attributes:
+      hands - the titles of the cards dealt to each seat, by seat.
+      claims - each seat's claim as (blank, elder, cthulhu), or None.
+      reveals - (investigator's seat, target's seat, card title) for every
+        card revealed, in order.
+    """
+    __slots__ = ("hands", "claims", "reveals")
+
+    def __init__(self, hands, claims=None, reveals=None):
+        self.hands = hands
+        self.claims = [None] * len(hands) if claims is None else claims
+        self.reveals = [] if reveals is None else reveals
+
+
+class Seat(collections.namedtuple("Seat", ["table", "game", "player"])):
+    """
+    Where a user is playing: the table (a chat's id, or (chat id, topic)),
+    the Game and their Player. game and player are None while the game is
+    evicted.
+    """
+    __slots__ = ()
+
+    def number(self):
+        """
+        Returns the player's seat, counting from 1.
+        """
+        return self.game.get_active_players().index(self.player) + 1
+
+
+class SeatIndex:
+    """
+    Finds the game a user is playing in, whichever chat it's in, so that
+    they can move from a DM.
+
+    A Game bound to the index (see bind) keeps it up to date as players
+    join, leave and the game ends. A user can be seated at one game at a
+    time that hasn't started or is ongoing; joining another unstarted game
+    moves their seat there, but a game in progress keeps it.
+
+    Attributes:
+      seats - maps a user's id to their Seat.
+    """
+
+    def __init__(self):
+        self.seats = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.seats)
+
+    def get(self, user_id):
+        """
+        Returns a user's Seat, or None.
+        """
+        return self.seats.get(user_id)
+
+    def bind(self, game, table):
+        """
+        Makes a game keep the index up to date, and seats its players.
+
+        Arguments:
+          game - the Game.
+          table - the chat's id, or (chat id, topic), the game is at.
+        """
+        game.seat_index = self
+        game.table = table
+        if game.game_status == "Ended":
+            return
+        with self.lock:
+            for player in game.get_active_players():
+                if not self.busy(self.seats.get(player.p_id), game):
+                    self.seats[player.p_id] = Seat(table, game, player)
+
+    @staticmethod
+    def busy(seat, game):
+        """
+        Returns whether a seat keeps its user from playing in a game: it's
+        at another game in progress, or at an evicted one.
+        """
+        if seat is None or seat.game is game:
+            return False
+        if seat.game is None:
+            return seat.table != game.table
+        return seat.game.game_status == "Ongoing"
+
+    def seat(self, game, player):
+        """
+        Seats a player at a game.
+
+        Raises:
+          GameError - if they're playing a game in progress elsewhere.
+        """
+        with self.lock:
+            if self.busy(self.seats.get(player.p_id), game):
+                raise GameError("{} is already playing a game somewhere "
+                                "else.".format(player))
+            self.seats[player.p_id] = Seat(game.table, game, player)
+
+    def unseat(self, game, player):
+        """
+        Removes a player's seat, if it's at this game.
+        """
+        with self.lock:
+            seat = self.seats.get(player.p_id)
+            if seat is not None and seat.game is game:
+                del self.seats[player.p_id]
+
+    def clear(self, game):
+        """
+        Removes every seat at a game, once it's over.
+        """
+        with self.lock:
+            for player in game.players:
+                seat = self.seats.get(player.p_id)
+                if seat is not None and seat.game is game:
+                    del self.seats[player.p_id]
+
+    def release(self, game):
+        """
+        Forgets a game that is leaving memory. If it's in progress, its
+        players keep a seat holding only the table, so they can still find
+        it and can't join another; bind the game again once it's back.
+        """
+        with self.lock:
+            for player in game.players:
+                seat = self.seats.get(player.p_id)
+                if seat is None or seat.game is not game:
+                    continue
+                if game.game_status == "Ongoing":
+                    self.seats[player.p_id] = Seat(seat.table, None, None)
+                else:
+                    del self.seats[player.p_id]
+        game.seat_index = None
 
 
 class Game:
@@ -324,18 +1102,40 @@ class Game:
         game_settings - The game's settings.
         game_logs - A representation of the game.
         winner - The winning team.
+
+        seat_index - The SeatIndex the game keeps up to date, if any.
+        table - Where the game is, as given to SeatIndex.bind.
+        rounds - A RoundLog per round played, for the end-of-game report.
     """
+    # Games from before the seat index, or decoded, aren't bound to one.
+    seat_index = None
+    table = None
+    # Games started before rounds were logged have no log.
+    rounds = None
 
-    def __init__(self, game_settings=None):
+    def __init__(self, game_settings=None, ruleset=None):
         """
         Start a new, empty game of Don't Mess with Cthulhu.
 
         Arguments:
           game_settings - The game's settings.
+          ruleset - Optional. The rules to play by. Defaults to the shared
+            ruleset.
         """
         self.players = []
         self.game_status = "Unstarted"
-        self.game_settings = GameSettings()
+        self.name_index = None
+        # Bumped on every turn, so buttons from an older turn can be told
+        # apart from current ones.
+        self.version = 0
+        self.game_settings = game_settings or GameSettings()
+        self.ruleset = ruleset or get_ruleset()
+
+    def __getstate__(self):
+        # The index belongs to the process, not the game.
+        state = dict(self.__dict__)
+        state.pop("seat_index", None)
+        return state
 
     def add_player(self, player, is_playing=True):
         """
@@ -350,17 +1150,20 @@ class Game:
             raise GameError("The game has already started.")
         # Check that the player hasn't already joined.
         if player in self.players:
-            if player.status == "Playing":
+            if player.status == PLAYING:
                 raise GameError("You're already in this game.")
-            elif player.status == "Spectating":
+            elif player.status == SPECTATING:
                 raise GameError("You're already spectating this game.")
 
         # Add the player as a participant or spectator.
         if is_playing:
-            player.status = "Playing"
+            if self.seat_index is not None:
+                self.seat_index.seat(self, player)
+            player.status = PLAYING
         else:
-            player.status = "Spectating"
+            player.status = SPECTATING
         self.players.append(player)
+        self.name_index = None
 
     def remove_player(self, player):
         """
@@ -368,26 +1171,57 @@ class Game:
         """
         if player in self.players:
             self.players.remove(player)
+            self.name_index = None
+            if self.seat_index is not None:
+                self.seat_index.unseat(self, player)
         else:
             raise GameError("You weren't in the game.")
 
+    def replace_player(self, old, new):
+        """
+        Swaps every reference to one Player for another, for example when a
+        game has been unpickled next to existing Player objects.
+        """
+        self.players = [new if p is old else p for p in self.players]
+        self.name_index = None
+        if self.seat_index is not None and old.status == PLAYING:
+            self.seat_index.unseat(self, old)
+            self.seat_index.seat(self, new)
+        if getattr(self, "flashlight_lock", None) is old:
+            self.flashlight_lock = new
+        if hasattr(self, "silenced"):
+            self.silenced = [new if p is old else p for p in self.silenced]
+
     def count_active_players(self):
         """
         A helper function that counts the number of non-spectating players.
         """
-        return sum([p.status=="Playing" for p in self.players])
+        return sum([p.status == PLAYING for p in self.players])
 
     def get_active_players(self):
         """
         A helper function that returns the non-spectating players.
         """
-        return [p for p in self.players if p.status=="Playing"]
+        return [p for p in self.players if p.status == PLAYING]
 
     def get_spectators(self):
         """
         A helper function that returns the spectating players.
         """
-        return [p for p in self.players if p.status=="Spectating"]
+        return [p for p in self.players if p.status == SPECTATING]
+
+    def find_player(self, target):
+        """
+        Returns the seated player a Target refers to.
+
+        The name index is only rebuilt when the roster has changed.
+
+        Raises:
+          GameError - if there's no such player.
+        """
+        if self.name_index is None:
+            self.name_index = NameIndex(self.get_active_players())
+        return self.name_index.find(target)
 
     def get_current_player(self):
         """Get the current player."""
@@ -400,6 +1234,13 @@ class Game:
                 if p.game_data.has_flashlight:
                     return p
 
+    def get_turn_key(self):
+        """
+        Returns a value that changes whenever the game moves on to another
+        turn, so a stale turn timer can tell it's out of date.
+        """
+        return (self.round_counter, self.phase, self.turn)
+
     def get_next_player(self, player):
         """Get the next active player."""
         ind = self.players.index(player)
@@ -407,7 +1248,7 @@ class Game:
             ind += 1
             if ind == len(self.players):
                 ind = 0
-            if self.players[ind].status == "Playing":
+            if self.players[ind].status == PLAYING:
                 return self.players[ind]
 
     def start_game(self):
@@ -419,61 +1260,88 @@ class Game:
         """
         if self.game_status != "Unstarted":
             raise GameError("This game has already been started.")
-        else:
-            # Assign roles to players.
-            roles = self.make_roles()
-            for i, p in enumerate(self.get_active_players()):
-                p.start_playing(roles[i])
-            # Deal cards.
-            self.create_deck()
-            self.deal_cards()
-            # Give someone the flashlight.
-            random.choice(self.get_active_players()).toggle_flashlight()
-            # Note that the game is ongoing.
-            self.game_status = "Ongoing"
-            self.round_counter = 1
-            self.phase = "Claims"
-            self.turn = 1
+        n_players = self.count_active_players()
+        if n_players < self.game_settings.min_players:
+            raise GameError("There aren't enough players to start this "
+                            "game! People can join with /joingame.")
+        if n_players > self.game_settings.max_players:
+            raise GameError("There are too many players for this game.")
+        self.game_settings.validate(self.ruleset)
+        # Take back the seats of anyone who has joined another game since.
+        if self.seat_index is not None:
+            for p in self.get_active_players():
+                self.seat_index.seat(self, p)
+        # Assign roles to players.
+        roles = self.make_roles()
+        for i, p in enumerate(self.get_active_players()):
+            p.start_playing(roles[i])
+        # Deal cards.
+        self.rounds = []
+        self.create_deck()
+        self.compile_effects()
+        self.deal_cards()
+        # Give someone the flashlight.
+        random.choice(self.get_active_players()).toggle_flashlight()
+        # Note that the game is ongoing.
+        self.game_status = "Ongoing"
+        self.round_counter = 1
+        self.phase = "Claims"
+        self.turn = 1
+        self.winner = None
 
     def create_deck(self):
         """
-        Create the deck.
-
-        TODO: Implement Necronomicon and Objects of Power.
+        Create the deck from the ruleset's recipe for this game.
         """
-        self.deck = []
-        self.discard = []
         n_players = self.count_active_players()
-        # Add Cthulhu card(s).
-        if n_players > 8:
-            self.deck.append(Card(ctype="Cthulhu"))
-        self.deck.append(Card(ctype="Cthulhu"))
-        # Add Elder Signs.
-        for i in range(n_players):
-            self.deck.append(Card(ctype="Elder Sign"))
-        # Add blanks.
-        for i in range((n_players * 5) - len(self.deck)):
-            self.deck.append(Card(ctype="Blank"))
+        recipe = self.ruleset.deck_recipe(n_players,
+                                          self.game_settings.expansions)
+        cards = self.ruleset.cards
+        self.deck = [Card(ctype=title, cards=cards) for title in recipe]
+        self.discard = []
+
+    def compile_effects(self, cards=None):
+        """
+        Resolves the effects of the card types in the deck into hook tables.
+
+        This is done once per game, so investigate and check_winner never
+        look at cards that aren't in play.
+
+        Arguments:
+          cards - Optional. Every card in the game. Defaults to the deck,
+            which holds them all before the deal.
+        """
+        self.reveal_hooks = {}
+        self.round_end_hooks = []
+        self.win_checks = []
+        cards = self.deck if cards is None else cards
+        for title in sorted(set(card.title for card in cards)):
+            effect = CARD_EFFECTS[title]
+            hooks = type(effect)
+            if hooks.on_reveal is not CardEffect.on_reveal:
+                self.reveal_hooks[title] = effect.on_reveal
+            if hooks.on_round_end is not CardEffect.on_round_end:
+                self.round_end_hooks.append(effect.on_round_end)
+            if hooks.check_winner is not CardEffect.check_winner:
+                self.win_checks.append(effect.check_winner)
+        # State the effects work with.
+        self.cards_revealed = 0
+        self.signs_found = 0
+        self.cthulhus_found = 0
+        self.necronomicon_cursed = False
+        self.flashlight_lock = None
+        self.silenced = []
 
     def make_roles(self):
         """
         Assign roles to players.
         """
-        # Determine the number of investigators and cultists.
-        n_players = self.count_active_players()
-        print(n_players)
-        got_info = False
-        with open("roles/role_info.txt") as f:
-            for line in f:
-                if str(n_players)==line.rstrip().split(",")[0]:
-                    role_data = line.rstrip().split(",")
-                    n_investigators = int(role_data[1])
-                    n_cultists = int(role_data[2])
-                    got_info = True
-        if not got_info:
+        # The ruleset knows the number of investigators and cultists.
+        roles = self.ruleset.roles.get(self.count_active_players())
+        if not roles:
             raise GameError("Failed to find a role setup.")
         # Make a deck of roles and distribute them.
-        roles = ["Investigator"] * n_investigators + ["Cultist"] * n_cultists
+        roles = list(roles)
         random.shuffle(roles)
         return roles
 
@@ -482,28 +1350,86 @@ class Game:
         Deal cards equally between all active players.
         """
         random.shuffle(self.deck)
-        while len(self.deck) > 0:
-            for p in self.get_active_players():
-                p.give_card(self.deck.pop())
+        players = self.get_active_players()
+        for i in range(len(self.deck)):
+            players[i % len(players)].give_card(self.deck.pop())
+        self.log_round()
 
-    def get_log(self, setting=None):
+    def log_round(self):
         """
-        Gets a display of the game state, according to settings.
+        Starts the log of a round with the hands just dealt.
         """
-        pass
+        if self.rounds is not None:
+            self.rounds.append(RoundLog(
+                [tuple(card.title for card in p.game_data.cards)
+                 for p in self.get_active_players()]))
+
+    def get_log(self, limit=MESSAGE_LIMIT):
+        """
+        Yields the end-of-game report as messages no longer than limit: the
+        winner, everyone's role, and for every round the hands dealt, the
+        claims made and the cards revealed. Each message is rendered only
+        when it's asked for.
+        """
+        yield from chunk_lines(self.report_lines(), limit)
+
+    def report_lines(self):
+        """
+        Yields the lines of the end-of-game report.
+        """
+        if not hasattr(self, "round_counter"):
+            yield "This game never started."
+            return
+        if self.winner == INVESTIGATOR:
+            yield "The Investigators won!"
+        elif self.winner == CULTIST:
+            yield "The Cultists won!"
+        else:
+            yield "The game ended without a winner."
+        players = self.get_active_players()
+        yield ""
+        yield "Roles:"
+        for seat, player in enumerate(players):
+            yield "{}. {}: {}".format(seat + 1, player,
+                                      player.game_data.role)
+        if not self.rounds:
+            return
+        symbols = {title: data[2] for title, data in self.ruleset.cards.items()}
+        claimed = (symbols.get("Blank", "?"), symbols.get("Elder Sign", "?"),
+                   symbols.get("Cthulhu", "?"))
+        for number, log in enumerate(self.rounds, 1):
+            yield ""
+            yield "Round {}:".format(number)
+            for seat, hand in enumerate(log.hands):
+                claim = log.claims[seat]
+                yield "{} had {}, claimed {}".format(
+                    players[seat],
+                    "".join(symbols.get(title, "?") for title in hand),
+                    "nothing" if claim is None else "".join(
+                        symbol * n for symbol, n in zip(claimed, claim)))
+            for user, target, title in log.reveals:
+                yield "{} investigated {}: {}".format(
+                    players[user], players[target], symbols.get(title, "?"))
 
     def set_claim(self, player, blank, elder, cthulhu):
         """
         Sets the claim for a player and updates the game log accordingly.
         """
+        if player in self.silenced:
+            raise GameError("You can't communicate while Insanity's Grasp is "
+                            "in front of you.")
+        cards = self.ruleset.cards
         claim = []
         for i in range(blank):
-            claim.append(Card(ctype="Blank"))
+            claim.append(Card(ctype="Blank", cards=cards))
         for i in range(elder):
-            claim.append(Card(ctype="Elder Sign"))
+            claim.append(Card(ctype="Elder Sign", cards=cards))
         for i in range(cthulhu):
-            claim.append(Card(ctype="Cthulhu"))
+            claim.append(Card(ctype="Cthulhu", cards=cards))
         player.set_claim(claim)
+        if self.rounds:
+            seat = self.get_active_players().index(player)
+            self.rounds[-1].claims[seat] = (blank, elder, cthulhu)
         if self.phase == "Claims":
             self.get_next_player(player).game_data.can_claim = True
             self.new_turn()
@@ -511,17 +1437,42 @@ class Game:
     def investigate(self, user, target, pos=None):
         """
         Has one player investigate another.
+
+        Returns:
+          notes - (recipient, text) pairs produced by the revealed card's
+            effect. A recipient of None means everyone.
         """
+        if self.game_status != "Ongoing":
+            raise GameError("There's no game going!")
+        if self.phase != "Investigation":
+            raise GameError("Claims must first finish!")
         if not user.game_data.has_flashlight:
             raise GameError("Must have the flashlight to investigate!")
+        if user is target:
+            raise GameError("You can't investigate yourself!")
+        card = target.reveal_card(pos=pos)
+        self.cards_revealed += 1
+        if self.rounds:
+            seats = self.get_active_players()
+            self.rounds[-1].reveals.append(
+                (seats.index(user), seats.index(target), card.title))
         user.game_data.has_flashlight = False
-        target.reveal_card(pos=pos)
-        target.game_data.has_flashlight = True
+        notes = []
+        hook = self.reveal_hooks.get(card.title)
+        if hook:
+            notes = hook(self, user, target, card)
+        holder = self.flashlight_lock or target
+        holder.game_data.has_flashlight = True
         self.new_turn()
+        return notes
 
     def new_turn(self):
         """Check for winners, etc."""
+        self.version += 1
         self.check_winner()
+        if self.winner:
+            self.end_game()
+            return
         self.turn += 1
         if self.turn > self.count_active_players():
             if self.phase == "Claims":
@@ -540,6 +1491,9 @@ class Game:
         """
         Collect and redeal cards.
         """
+        for hook in self.round_end_hooks:
+            hook(self)
+        self.round_counter += 1
         self.phase = "Claims"
         self.turn = 1
         # Reset player data as needed.
@@ -562,36 +1516,39 @@ class Game:
     def check_winner(self):
         """
         Checks whether a team has won.
+
+        Reveals are counted as they happen, so this never scans the cards.
         """
-        cards_revealed = 0
-        signs_found = 0
-        # Search through all revealed cards.
-        revealed = [p.game_data.cards for p in self.get_active_players()]
-        revealed.append(self.discard)
-        for card in itertools.chain(*revealed):
-            if card.is_flipped:
-                cards_revealed += 1
-                if card.title == "Cthulhu":
-                    self.winner = "Cultist"
-                elif card.title == "Elder Sign":
-                    signs_found += 1
-        if signs_found >= self.count_active_players():
-            self.winner = "Investigator"
-        elif cards_revealed >= self.count_active_players() * 4:
-            self.winner = "Cultist"
+        n_players = self.count_active_players()
+        if self.cthulhus_found:
+            self.winner = CULTIST
+        elif self.signs_found >= n_players:
+            self.winner = INVESTIGATOR
+        elif self.cards_revealed >= n_players * 4:
+            self.winner = CULTIST
+        for check in self.win_checks:
+            winner = check(self)
+            if winner:
+                self.winner = winner
 
     def end_game(self):
         """
         Updates player statistics and finishes a game.
         """
         self.game_status = "Ended"
+        self.version += 1
+        if self.seat_index is not None:
+            self.seat_index.clear(self)
         # print game log
         # update player stats
         pass
 
-    def display_board(self):
+    def display_board(self, omniscient=False):
         """
         Returns a nicely formatted version of the board as it is.
+
+        Arguments:
+          omniscient - If True, shows every hand and role, for spectators.
         """
         display = ""
         display += "Round: {}   ".format(self.round_counter)
@@ -601,10 +1558,12 @@ class Game:
             display += str(i + 1)
             display += " : "
             display += str(player)
+            if omniscient:
+                display += " ({})".format(player.game_data.role)
             if player.game_data.has_flashlight:
                 display += "(" + emojis.encode(":flashlight:") + ")"
             display += " : "
-            display += player.display_hand()
+            display += player.display_hand(omniscient)
             display += "\n"
             if player.display_claim():
                 display += ("Claimed: %s" % player.display_claim())
@@ -621,18 +1580,16 @@ class Game:
 
     def is_valid_name(self, name):
         """
-        Returns whether the name is a valid player.
+        Returns the position in self.players of the player a name or seat
+        number refers to, or -1.
 
         @name - the player's name.
         """
-        for i, player in enumerate(self.players):
-            if str(player).lower() in name.lower():
-                return i
-            elif i > 0 and str(i + 1) in name:
-                return i
-            elif i == 0 and "1" in name and "10" not in name:
-                return i
-        return -1
+        try:
+            player = self.find_player(parse_target([name]))
+        except GameError:
+            return -1
+        return self.players.index(player)
 
     def get_position(self, player_id=None, name=None):
         """
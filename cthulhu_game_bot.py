@@ -12,9 +12,31 @@ TODO:
 
 import telegram
 from telegram.ext import Updater
+from telegram.ext import CallbackContext
+from telegram.ext import CallbackQueryHandler
 from telegram.ext import CommandHandler
+from telegram.ext import ContextTypes
+from telegram.ext import TypeHandler
+from telegram.utils.helpers import escape_markdown
 import logging
 import cthulhu_game as cg
+import cthulhu_archive
+import cthulhu_broadcast
+import cthulhu_codec
+import cthulhu_eviction
+import cthulhu_feed
+import cthulhu_lanes
+import cthulhu_matchmaking
+import cthulhu_outbox
+import cthulhu_ratelimit
+import cthulhu_replay
+import cthulhu_timers
+import cthulhu_transport
+import cthulhu_webfeed
+import base64
+import os
+import struct
+from queue import Queue
 from telegram.error import Unauthorized
 import random
 
@@ -30,27 +52,112 @@ def read_message(filepath):
     return message
 
 
+def send_message(context, chat_id, text, **kwargs):
+    """
+    Sends a message through the outbox, if the bot has one, so that it's
+    retried rather than lost when Telegram says to slow down. Otherwise
+    sends it straight away.
+    """
+    outbox = context.bot_data.get("outbox")
+    if outbox is None:
+        context.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+    else:
+        outbox.send(chat_id, text, **kwargs)
+
+
+def send_to_chat(update, context, text, **kwargs):
+    """
+    Sends a message to the game's chat, in its forum topic if it has one.
+    That's the update's chat, unless a player is moving from a DM.
+    """
+    thread_id = getattr(context, "thread_id", None)
+    if thread_id is not None:
+        kwargs["message_thread_id"] = thread_id
+    chat_id = getattr(context, "chat_id", None)
+    send_message(context, update.effective_chat.id if chat_id is None
+                 else chat_id, text, **kwargs)
+
+
 def reply_all(update, context, name):
     """
     Send a message from a filepath to the chat.
     """
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=read_message("messages/{}.txt".format(name)))
+    send_to_chat(update, context, read_message("messages/{}.txt".format(name)))
 
 
 def send_to_all(update, context, message):
     """
     Send a message directly to chat.
     """
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=message)
+    send_to_chat(update, context, message)
 
 def send_dm(user_id, context, message):
     """
     Sends a test message directly to a specified user.
     """
-    context.bot.send_message(chat_id=user_id,
-                             text=message)
+    send_message(context, user_id, message)
+
+
+def table_data(dispatcher, chat_id, thread_id=None):
+    """
+    Returns the chat_data of a chat, or of one of its forum topics.
+    """
+    chat_data = dispatcher.chat_data[chat_id]
+    if thread_id is None:
+        return chat_data
+    return chat_data.setdefault(cthulhu_codec.TOPICS_KEY, {}).setdefault(
+        thread_id, {})
+
+
+class TableContext(CallbackContext):
+    """
+    A CallbackContext whose chat_data, for an update sent in a forum topic,
+    is that topic's own. Each topic of a forum chat then holds a game of its
+    own, which handlers find as context.chat_data["game"] as usual.
+
+    Attributes:
+      chat_id - the chat of the game the update is for: the update's own,
+        or the player's table for a move from a DM (see move_to).
+      thread_id - the game's topic, or None.
+    """
+    __slots__ = ("chat_id", "thread_id")
+
+    def __init__(self, dispatcher):
+        super().__init__(dispatcher)
+        self.chat_id = None
+        self.thread_id = None
+
+    @classmethod
+    def from_update(cls, update, dispatcher):
+        self = super().from_update(update, dispatcher)
+        if isinstance(update, telegram.Update) and update.effective_chat:
+            self.chat_id = update.effective_chat.id
+            thread_id = cthulhu_lanes.topic_of(update)
+            if thread_id is not None:
+                self.move_to(self.chat_id, thread_id)
+        return self
+
+    @property
+    def table(self):
+        """
+        The game's chat id, or (chat id, topic).
+        """
+        if self.thread_id is None:
+            return self.chat_id
+        return (self.chat_id, self.thread_id)
+
+    def move_to(self, chat_id, thread_id=None):
+        """
+        Points chat_data, and the bot's replies, at another chat or topic.
+        """
+        self.chat_id = chat_id
+        self.thread_id = thread_id
+        self._chat_id_and_data = (
+            chat_id, table_data(self.dispatcher, chat_id, thread_id))
+
+
+# Give dispatchers this, so that games are kept per forum topic.
+CONTEXT_TYPES = ContextTypes(context=TableContext)
 
 
 def initialize_chat_data(update, context):
@@ -62,8 +169,6 @@ def initialize_chat_data(update, context):
     if "game" not in context.chat_data:
         context.chat_data["game"] = cg.Game()
         reply_all(update, context, "new_game")
-    if "game_settings" not in context.chat_data:
-        context.chat_data["game_settings"] = cg.GameSettings()
 
 
 def initialize_player(update, context):
@@ -71,34 +176,136 @@ def initialize_player(update, context):
     If a user doesn't have a player profile associated, make one.
     """
     if "player" not in context.user_data:
-        context.user_data["player"] = cg.Player(update.message.from_user.id)
-        context.user_data["player"].nickname = update.message.from_user.first_name
+        context.user_data["player"] = cg.Player(update.effective_user.id)
+        context.user_data["player"].nickname = update.effective_user.first_name
         reply_all(update, context, "new_player")
 
 
+def reload_evicted(update, context):
+    """
+    Reloads this chat's and user's data if they were evicted for being idle,
+    and records the activity.
+    """
+    evictions = context.bot_data.get("evictions")
+    if evictions is not None:
+        evictions.touch(context.dispatcher, update.effective_chat.id,
+                        update.effective_user.id)
+
+
+def rate_limited(update, context):
+    """
+    Returns whether to drop an update because its user or chat is flooding
+    the bot. The first dropped command of a flood gets a warning; the rest
+    are dropped silently.
+
+    Each update is only checked once, however many handlers it goes
+    through, and the bot's own turn timers are never limited.
+    """
+    limiter = context.bot_data.get("rate_limiter")
+    if (limiter is None or getattr(context, "rate_checked", False) or
+            isinstance(update, TurnTimeout)):
+        return False
+    context.rate_checked = True
+    allowed, warning = limiter.check(update.effective_chat.id,
+                                     update.effective_user.id)
+    if warning == "user":
+        send_to_all(update, context, "{}, slow down! I'll ignore your "
+                                     "commands for a few seconds.".format(
+                                         update.effective_user.first_name))
+    elif warning == "chat":
+        send_to_all(update, context, "This chat is sending commands faster "
+                                     "than I can keep up, so I'll ignore "
+                                     "some for a few seconds.")
+    return not allowed
+
+
+def bind_seats(context):
+    """
+    Has the game keep the bot's seat index up to date, so that its players
+    can move from their DMs.
+    """
+    index = context.bot_data.get("seats")
+    if index is None:
+        index = context.bot_data.setdefault("seats", cg.SeatIndex())
+    game = context.chat_data["game"]
+    if game.seat_index is None:
+        index.bind(game, context.table)
+
+
+def find_seat(update, context):
+    """
+    Points the context at the game the user is playing in, reloading its
+    chat if it was evicted.
+
+    Returns:
+      found - False if they aren't playing in a game.
+    """
+    index = context.bot_data.get("seats")
+    user_id = update.effective_user.id
+    seat = index.get(user_id) if index is not None else None
+    if seat is None:
+        return False
+    if isinstance(seat.table, tuple):
+        chat_id, thread_id = seat.table
+    else:
+        chat_id, thread_id = seat.table, None
+    evictions = context.bot_data.get("evictions")
+    if evictions is not None:
+        evictions.touch(context.dispatcher, chat_id, user_id)
+    game = table_data(context.dispatcher, chat_id, thread_id).get("game")
+    if (game is None or game.game_status == "Ended" or
+            context.user_data.get("player") not in game.get_active_players()):
+        return False
+    context.move_to(chat_id, thread_id)
+    return True
+
+
 def catch_game_errors(func):
     """
     This is a wrapper function meant to catch all Game Errors.
     """
     def wrapper_game_errors(update, context):
+        if rate_limited(update, context):
+            return
         try:
+            reload_evicted(update, context)
             initialize_chat_data(update, context)
             initialize_player(update, context)
+            bind_seats(context)
             func(update, context)
         except cg.GameError as err:
-            context.bot.send_message(chat_id=update.effective_chat.id,
-                                     text=err.message)
+            if update.effective_chat.type == telegram.Chat.PRIVATE:
+                # Moves from a DM are told what went wrong in the DM.
+                send_message(context, update.effective_chat.id, err.message)
+            else:
+                send_to_chat(update, context, err.message)
     return wrapper_game_errors
 
 
+def playable_from_dm(func):
+    """
+    Lets a player send a command in a DM, running it in the game they're
+    playing in, wherever that is.
+    """
+    def wrapper_from_dm(update, context):
+        if update.effective_chat.type == telegram.Chat.PRIVATE:
+            if rate_limited(update, context):
+                return
+            if not find_seat(update, context):
+                send_to_all(update, context, "You aren't playing in a game "
+                                             "right now.")
+                return
+        func(update, context)
+    return wrapper_from_dm
+
+
 @catch_game_errors
 def display_board(update, context):
     """
     Displays the board back to the chat.
     """
     board = context.chat_data["game"].display_board()
-    context.bot.send_message(chat_id=update.effective_chat.id,
-                             text=board)
+    send_to_chat(update, context, board)
 
 ### Non-game related commands.
 def start(update, context):
@@ -128,14 +335,21 @@ def new_game(update, context):
     """
     Starts a new game of Don't Mess with Cthulhu in the given chat.
     """
+    if rate_limited(update, context):
+        return
+    reload_evicted(update, context)
     # Check if a game is already ongoing or pending.
-    if "game" in context.chat_data:
-        if context.chat_data["game"].game_status == "Unstarted":
+    game = context.chat_data.get("game")
+    if game is not None and game.game_status != "Ended":
+        if game.game_status == "Unstarted":
             reply_all(update, context, "new_game_pending")
         else:
             reply_all(update, context, "new_game_ongoing")
-    # Initialize a game, if there isn't one already.
-    initialize_chat_data(update, context)
+    else:
+        # Keep the chat's settings, such as expansions, for the next game.
+        settings = game.game_settings.copy() if game is not None else None
+        context.chat_data["game"] = cg.Game(settings)
+        reply_all(update, context, "new_game")
 
 @catch_game_errors
 def join_game(update, context):
@@ -178,28 +392,190 @@ def start_game(update, context):
     reply_all(update, context, "start_game")
     send_role_info(update, context)
     send_hand_info(update, context)
+    send_board(update, context)
+    update_spectators(update, context)
+    arm_turn_timer(update, context)
 
 
+@playable_from_dm
 @catch_game_errors
 def claim(update, context):
     blank, elder, cthulhu = interpret_claim(context.chat_data["game"],
                                             context.args)
     context.chat_data["game"].set_claim(context.user_data["player"],
                                         blank, elder, cthulhu)
-    send_to_all(update, context, context.chat_data["game"].display_board())
+    send_board(update, context)
+    update_spectators(update, context)
+    arm_turn_timer(update, context)
 
 
 @catch_game_errors
 def investigate(update, context):
-    target = find_player(context.chat_data["game"], context.args)
-    context.chat_data["game"].investigate(context.user_data["player"], target)
-    send_to_all(update, context, context.chat_data["game"].display_board())
+    game = context.chat_data["game"]
+    target = find_player(game, context.args)
+    round_counter = game.round_counter
+    notes = game.investigate(context.user_data["player"], target)
+    send_notes(update, context, notes)
+    send_board(update, context)
+    update_spectators(update, context)
+    arm_turn_timer(update, context)
+    if game.game_status == "Ended":
+        announce_winner(update, context, game)
+    elif game.round_counter != round_counter:
+        # Cards were redealt, so everyone needs their new hand.
+        send_hand_info(update, context)
+
+
+def expansions(update, context):
+    """
+    Toggles an expansion for the pending game, or lists them.
+
+    Unlike most commands this doesn't create a game: expansions only make
+    sense for a game that is already pending.
+    """
+    if rate_limited(update, context):
+        return
+    reload_evicted(update, context)
+    game = context.chat_data.get("game")
+    if game is None or game.game_status != "Unstarted":
+        reply_all(update, context, "expansions_no_game")
+        return
+    names = {"necronomicon": cg.NECRONOMICON, "power": cg.OBJECTS_OF_POWER,
+             "objects": cg.OBJECTS_OF_POWER}
+    if len(context.args) == 0 or context.args[0].lower() not in names:
+        reply_all(update, context, "expansions_usage")
+    else:
+        expansion = names[context.args[0].lower()]
+        if expansion in game.game_settings.expansions:
+            game.game_settings.expansions.remove(expansion)
+        else:
+            game.game_settings.expansions.append(expansion)
+    in_use = ", ".join(game.game_settings.expansions) or "none"
+    send_to_all(update, context, "Expansions in use: {}".format(in_use))
 
 
 def end_game(update, context):
-    context.chat_data["game"] = None
+    """
+    Ends any pending or ongoing game.
+    """
+    if rate_limited(update, context):
+        return
+    reload_evicted(update, context)
+    game = context.chat_data.get("game")
+    ongoing = game is not None and game.game_status == "Ongoing"
+    if game is not None:
+        game.end_game()
+        arm_turn_timer(update, context)
     reply_all(update, context, "end_game")
+    if ongoing:
+        send_report(update, context, game)
+        archive_game(context, game)
+
+
 
+### Move buttons.
+# Button actions. A claim's argument packs the Elder Signs claimed into the
+# low four bits and the Cthulhus into the high four; an investigation's is
+# the target's seat.
+CLAIM_BUTTON = 1
+INVESTIGATE_BUTTON = 2
+
+# callback_data is "m" and then (game version, action, argument) packed
+# into four bytes, in URL-safe base64: seven characters in all.
+BUTTON_FORMAT = struct.Struct(">HBB")
+
+
+def encode_button(version, action, arg):
+    """
+    Returns the callback_data for a move button.
+    """
+    packed = BUTTON_FORMAT.pack(version & 0xFFFF, action, arg)
+    return "m" + base64.urlsafe_b64encode(packed).decode().rstrip("=")
+
+
+def decode_button(data):
+    """
+    Returns (version, action, argument) from a move button's callback_data.
+
+    Raises:
+      ValueError - if the data isn't a move button's.
+    """
+    if len(data) != 7 or data[0] != "m":
+        raise ValueError("Not a move button.")
+    packed = base64.b64decode(data[1:] + "==", altchars="-_", validate=True)
+    return BUTTON_FORMAT.unpack(packed)
+
+
+def move_keyboard(game):
+    """
+    Returns buttons for the current player's possible moves, or None if the
+    game isn't waiting on a move.
+    """
+    if game.game_status != "Ongoing":
+        return None
+    player = game.get_current_player()
+    if player is None:
+        return None
+    if game.phase == "Claims":
+        hand = len(player.game_data.cards)
+        rows = [[telegram.InlineKeyboardButton(
+                    "{}{}".format(elder, " + C" * cthulhu),
+                    callback_data=encode_button(
+                        game.version, CLAIM_BUTTON, elder | cthulhu << 4))
+                 for elder in range(hand + 1 - cthulhu)]
+                for cthulhu in (0, 1)]
+    else:
+        rows = [[telegram.InlineKeyboardButton(
+                    "{}: {}".format(seat + 1, p),
+                    callback_data=encode_button(
+                        game.version, INVESTIGATE_BUTTON, seat + 1))]
+                for seat, p in enumerate(game.get_active_players())
+                if p is not player and
+                any(not c.is_flipped for c in p.game_data.cards)]
+    return telegram.InlineKeyboardMarkup(rows)
+
+
+def send_board(update, context):
+    """
+    Sends the board, with buttons for whoever moves next.
+    """
+    game = context.chat_data["game"]
+    send_to_chat(update, context, game.display_board(),
+                 reply_markup=move_keyboard(game))
+
+
+def press_button(update, context):
+    """
+    Makes the move on a pressed button.
+
+    Buttons carry the game version they were made for, so presses on an
+    older board, or by anyone but the player to move, are turned away with
+    a notification rather than a chat message.
+    """
+    if rate_limited(update, context):
+        return
+    reload_evicted(update, context)
+    query = update.callback_query
+    game = context.chat_data.get("game")
+    try:
+        version, action, arg = decode_button(query.data)
+    except ValueError:
+        query.answer("That button doesn't do anything.")
+        return
+    if (game is None or game.game_status != "Ongoing" or
+            version != game.version & 0xFFFF):
+        query.answer("That button is out of date.")
+        return
+    if query.from_user.id != game.get_current_player().p_id:
+        query.answer("It's not your turn.")
+        return
+    query.answer()
+    if action == CLAIM_BUTTON:
+        context.args = [str(arg & 0xF), str(arg >> 4)]
+        claim(update, context)
+    elif action == INVESTIGATE_BUTTON:
+        context.args = [str(arg)]
+        investigate(update, context)
 
 
 ### Helper functions for above.
@@ -215,6 +591,22 @@ def send_hand_info(update, context):
         send_dm(p.p_id, context, p.hand_summary())
 
 
+@playable_from_dm
+@catch_game_errors
+def hand(update, context):
+    """
+    DMs the player their role and hand. Works in the game's chat or in a
+    DM, but the answer only ever goes to the DM.
+    """
+    player = context.user_data["player"]
+    game = context.chat_data["game"]
+    if (game.game_status != "Ongoing" or
+            player not in game.get_active_players()):
+        raise cg.GameError("You aren't playing in a game right now.")
+    send_dm(player.p_id, context, "{}\n{}".format(player.role_summary(),
+                                                  player.hand_summary()))
+
+
 @catch_game_errors
 def send_role_info(update, context):
     players = context.chat_data["game"].get_active_players()
@@ -222,6 +614,75 @@ def send_role_info(update, context):
         send_dm(p.p_id, context, p.role_summary())
 
 
+def update_spectators(update, context):
+    """
+    Queues the omniscient board for the game's spectators.
+
+    The board is rendered once and the same text goes to every spectator.
+    Sending happens on the spectator feed's thread, so players' replies
+    never wait on it. Viewers of the web feed, if it's running, get the
+    move's changes.
+    """
+    game = context.chat_data["game"]
+    key = cthulhu_lanes.table_key(update)
+    web_feed = context.bot_data.get("web_feed")
+    if web_feed is not None:
+        web_feed.publish(key, game)
+    spectators = game.get_spectators()
+    if not spectators:
+        return
+    if "spectator_feed" not in context.bot_data:
+        context.bot_data["spectator_feed"] = cthulhu_feed.SpectatorFeed(
+            context.bot, outbox=context.bot_data.get("outbox"))
+    context.bot_data["spectator_feed"].publish(
+        key, [p.p_id for p in spectators],
+        game.display_board(omniscient=True))
+
+
+def send_notes(update, context, notes):
+    """
+    Sends the notes produced by a card's effect, privately where needed.
+    """
+    for recipient, text in notes:
+        if recipient is None:
+            send_to_all(update, context, text)
+        else:
+            send_dm(recipient.p_id, context, text)
+
+
+def announce_winner(update, context, game):
+    """
+    Tells the chat which team won.
+    """
+    if game.winner == cg.INVESTIGATOR:
+        send_to_all(update, context, "The Investigators win!")
+    else:
+        send_to_all(update, context, "The Cultists win!")
+    flavortext = read_message("messages/flavortext/{}_win_flavortext.txt"
+                              .format(game.winner.lower()))
+    if flavortext.strip():
+        send_to_all(update, context, flavortext)
+    send_report(update, context, game)
+    archive_game(context, game)
+
+
+def archive_game(context, game):
+    """
+    Keeps a finished game in the archive, if the bot has one.
+    """
+    archive = context.bot_data.get("archive")
+    if archive is not None:
+        archive.append(game, context.chat_id)
+
+
+def send_report(update, context, game):
+    """
+    Sends the end-of-game report, a message at a time as it's rendered.
+    """
+    for chunk in game.get_log():
+        send_to_all(update, context, chunk)
+
+
 def interpret_claim(game, args):
     """
     Interprets a claim and returns it as (blank, signs, cthulhus).
@@ -229,61 +690,331 @@ def interpret_claim(game, args):
     Raises:
       GameError if the claim is invalid.
     """
-    hand_size = 6 - game.round_counter
-    signs = 0
-    cthulhus = 0
-    # Parse single-argument claims.
-    if len(args) == 1:
-        if "rock" in args[0]:
-            pass
-        elif "c" in args[0]:
-            cthulhus = 1
-        else:
-            signs = args[0]
-    # Parse 2-argument claims.
-    if len(args) == 2:
-        signs = args[0]
-        # The second can be either C or a number.
-        if "c" in args[1].lower():
-            cthulhus = 1
-    # Ensure the claim is valid.
-    try:
-        signs = int(signs)
-        cthulhus = int(cthulhus)
-        assert signs + cthulhus <= hand_size
-    except (ValueError, AssertionError) as e:
-        raise cg.GameError("Invalid claim!")
-    return (hand_size - signs - cthulhus, signs, cthulhus)
+    return cg.parse_claim(args, 6 - game.round_counter)
 
 
 def find_player(game, args):
-    # Look for a player's seat.
-    try:
-        seat = int(args[0])
-        return game.get_active_players()[seat - 1]
-    except (IndexError, ValueError) as e:
-        pass
-    # Look for a player by name.
-    for player in game.players.get_active_players:
-        if arg[0] in str(player):
-            return player
-    raise cg.GameError("That doesn't seem to be a player.")
+    """
+    Returns the seated player named or seated at the command's arguments.
+
+    Raises:
+      GameError if there's no such player.
+    """
+    return game.find_player(cg.parse_target(args))
 
 
 ### Useful in-game commands.
+@catch_game_errors
 def blame(update, context):
-    pass
+    """
+    Tags whoever the game is waiting on.
+    """
+    game = context.chat_data["game"]
+    if game.game_status != "Ongoing":
+        raise cg.GameError("There's no game in progress.")
+    player = game.get_current_player()
+    action = "claim" if game.phase == "Claims" else "investigate"
+    send_to_chat(update, context,
+                 "[{}](tg://user?id={}) needs to {}.".format(
+                     escape_markdown(str(player)), player.p_id, action),
+                 parse_mode=telegram.ParseMode.MARKDOWN)
+
+
+class TurnTimeout(telegram.Update):
+    """
+    A turn timer going off.
+
+    The timing wheel's thread puts these on the dispatcher's update queue,
+    so they're handled in turn with everyone's moves. They look like an
+    update from the player being waited on, so the usual handlers can move
+    for them.
+
+    Attributes:
+      key - the game's turn key when the timer was armed.
+      nudges - how many times the player has been nudged this turn.
+      thread_id - the forum topic of the game, or None.
+    """
+    __slots__ = ("key", "nudges", "thread_id", "chat", "user")
+
+    def __init__(self, chat_id, player, key, nudges, thread_id=None):
+        super().__init__(0)
+        self.key = key
+        self.nudges = nudges
+        self.thread_id = thread_id
+        self.chat = telegram.Chat(chat_id, telegram.Chat.GROUP)
+        self.user = telegram.User(player.p_id, str(player), False)
+
+    @property
+    def effective_chat(self):
+        return self.chat
+
+    @property
+    def effective_user(self):
+        return self.user
+
+
+def arm_turn_timer(update, context, nudges=0):
+    """
+    Restarts the game's turn timer for whoever has to move next, or cancels
+    it if the game is over. Each forum topic's game has its own timer.
+    """
+    timers = context.bot_data.get("turn_timers")
+    if timers is None:
+        return
+    key = cthulhu_lanes.table_key(update)
+    game = context.chat_data["game"]
+    if game.game_status != "Ongoing" or game.game_settings.turn_timeout is None:
+        timers.cancel(key)
+        return
+    timeout = TurnTimeout(update.effective_chat.id, game.get_current_player(),
+                          game.get_turn_key(), nudges,
+                          getattr(context, "thread_id", None))
+    timers.arm(key, game.game_settings.turn_timeout,
+               context.dispatcher.update_queue.put, timeout)
+
+
+@catch_game_errors
+def turn_timeout(update, context):
+    """
+    Nudges the player a game is waiting on, or moves for them once they've
+    used up their nudges: claiming all Blanks, or investigating a random
+    face-down card.
+    """
+    game = context.chat_data["game"]
+    if (game.game_status != "Ongoing" or
+            game.get_turn_key() != update.key):
+        # Someone has moved since the timer was armed.
+        return
+    nudges = game.game_settings.nudges
+    if nudges is None or update.nudges < nudges:
+        blame(update, context)
+        arm_turn_timer(update, context, update.nudges + 1)
+        return
+    player = game.get_current_player()
+    send_to_all(update, context, "{} took too long, so I'm moving for "
+                                 "them.".format(player))
+    if game.phase == "Claims":
+        context.args = ["rock"]
+        claim(update, context)
+    else:
+        seats = game.get_active_players()
+        targets = [str(seat + 1) for seat, p in enumerate(seats)
+                   if p is not player and
+                   any(not c.is_flipped for c in p.game_data.cards)]
+        context.args = [random.choice(targets)]
+        investigate(update, context)
+
+
+### Matchmaking.
+class QueueCheck(telegram.Update):
+    """
+    A reminder to form games from the matchmaking queue, put on the update
+    queue by the timing wheel while anyone is waiting.
+    """
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__(0)
+
+
+class MatchFound(telegram.Update):
+    """
+    A game formed by matchmaking, waiting to start in its lobby chat. It
+    looks like an update from the lobby, so the usual handlers can start the
+    game there.
+
+    Attributes:
+      user_ids - the players, longest waiting first.
+    """
+    __slots__ = ("user_ids", "chat", "user")
+
+    def __init__(self, chat_id, user_ids):
+        super().__init__(0)
+        self.user_ids = user_ids
+        self.chat = telegram.Chat(chat_id, telegram.Chat.GROUP)
+        self.user = telegram.User(user_ids[0], str(user_ids[0]), False)
+
+    @property
+    def effective_chat(self):
+        return self.chat
+
+    @property
+    def effective_user(self):
+        return self.user
+
+
+# Seconds between checks of the matchmaking queue while anyone is waiting.
+QUEUE_CHECK_EVERY = 5
+
+
+def queue(update, context):
+    """
+    Puts the user in the matchmaking queue, optionally for a given number of
+    players. Only works in a DM.
+    """
+    if rate_limited(update, context):
+        return
+    reload_evicted(update, context)
+    matchmaker = context.bot_data.get("matchmaker")
+    if matchmaker is None:
+        send_to_all(update, context, "Matchmaking isn't running right now.")
+        return
+    if update.effective_chat.type != telegram.Chat.PRIVATE:
+        send_to_all(update, context, "Message me directly to join the queue.")
+        return
+    initialize_player(update, context)
+    try:
+        if context.args and not context.args[0].isdigit():
+            raise cg.GameError("Usage: /queue [number of players]")
+        size = int(context.args[0]) if context.args else None
+        matchmaker.join(update.effective_user.id, size)
+    except cg.GameError as err:
+        send_to_all(update, context, err.message)
+        return
+    send_to_all(update, context, "You're in the queue for a game{}. "
+                                 "/unqueue to leave it.".format(
+                                     " of {}".format(size) if size else ""))
+    form_games(context)
 
 
-def display(bot, update, chat_data):
+def unqueue(update, context):
     """
-    Displays the board.
+    Takes the user out of the matchmaking queue.
     """
-    send_to_all(update, context, context.chat_data["game"].display_board())
+    if rate_limited(update, context):
+        return
+    matchmaker = context.bot_data.get("matchmaker")
+    if matchmaker is None:
+        return
+    try:
+        matchmaker.leave(update.effective_user.id)
+    except cg.GameError as err:
+        send_to_all(update, context, err.message)
+        return
+    send_to_all(update, context, "You've left the queue.")
+
 
+def free_lobby(context):
+    """
+    Returns a lobby chat with no pending or ongoing game, or None.
+    """
+    for chat_id in context.bot_data.get("lobbies", {}):
+        game = context.dispatcher.chat_data[chat_id].get("game")
+        if game is None or game.game_status == "Ended":
+            return chat_id
+    return None
+
+
+def form_games(context):
+    """
+    Forms as many games from the matchmaking queue as there are free
+    lobbies for, then makes sure the queue gets checked again while anyone
+    is still waiting.
+
+    Each game is set up in its lobby straight away, so the lobby is taken,
+    and started when its MatchFound comes off the update queue.
+    """
+    matchmaker = context.bot_data["matchmaker"]
+    evictions = context.bot_data.get("evictions")
+    while True:
+        lobby = free_lobby(context)
+        if lobby is None:
+            break
+        user_ids = matchmaker.match()
+        if user_ids is None:
+            break
+        game = cg.Game()
+        for user_id in user_ids:
+            if evictions is not None:
+                evictions.touch(context.dispatcher, lobby, user_id)
+            game.add_player(context.dispatcher.user_data[user_id]["player"])
+        context.dispatcher.chat_data[lobby]["game"] = game
+        context.dispatcher.update_queue.put(MatchFound(lobby, user_ids))
+    timers = context.bot_data.get("turn_timers")
+    if (len(matchmaker) and timers is not None and
+            context.bot_data.get("queue_check") is None):
+        context.bot_data["queue_check"] = timers.wheel.schedule(
+            QUEUE_CHECK_EVERY, context.dispatcher.update_queue.put,
+            QueueCheck())
+
+
+def check_queue(update, context):
+    """
+    Forms games from players who have been waiting.
+    """
+    context.bot_data["queue_check"] = None
+    form_games(context)
 
+
+def start_match(update, context):
+    """
+    Starts a game formed by matchmaking in its lobby, telling the players
+    where to find it.
+    """
+    # Matches are the bot's own doing, and aren't rate limited.
+    context.rate_checked = True
+    game = context.chat_data["game"]
+    send_to_all(update, context, "Matchmaking has found a game for {}!".format(
+        ", ".join(str(p) for p in game.players)))
+    link = context.bot_data["lobbies"][update.effective_chat.id]
+    for user_id in update.user_ids:
+        try:
+            send_dm(user_id, context, "Your game is starting! Join it at "
+                                      "{}".format(link))
+        except Unauthorized:
+            pass
+    start_game(update, context)
+
+
+@catch_game_errors
 def display_log(update, context):
-    pass
+    """
+    Sends the report of the chat's last game, once it's over.
+    """
+    game = context.chat_data["game"]
+    if game.game_status != "Ended" or game.rounds is None:
+        raise cg.GameError("The log is shown once a game is over.")
+    send_report(update, context, game)
+
+
+def history(update, context):
+    """
+    Lists the games the user has finished, newest first.
+    """
+    if rate_limited(update, context):
+        return
+    archive = context.bot_data.get("archive")
+    user_id = update.effective_user.id
+    records = archive.history(user_id) if archive is not None else []
+    if not records:
+        send_to_all(update, context, "You haven't finished any games yet.")
+        return
+    send_to_all(update, context, "Your last games:\n" + "\n".join(
+        cthulhu_archive.describe(record, user_id) for record in records))
+
+
+def broadcast(update, context):
+    """
+    Sends a message to every chat with a game, for the bot's admins only.
+    With no message, says how the current broadcast is going.
+    """
+    if update.effective_user.id not in context.bot_data.get("admins", ()):
+        return
+    current = context.bot_data.get("broadcast")
+    text = update.effective_message.text.split(None, 1)[1:]
+    if not text:
+        send_to_all(update, context, "Usage: /broadcast message" if
+                    current is None else current.status())
+        return
+    if current is not None and current.running:
+        send_to_all(update, context, "A broadcast is already running. " +
+                    current.status())
+        return
+    context.bot_data["broadcast"] = cthulhu_broadcast.Broadcast(
+        context.dispatcher, text[0],
+        context.bot_data.get("broadcast_checkpoint")).start()
+    send_to_all(update, context, "Broadcasting to every chat with a game. "
+                                 "Send /broadcast to see how it's going.")
 
 ##########################################################
 
@@ -302,18 +1033,6 @@ def pending_players(bot, update, chat_data=None):
     bot.send_message(chat_id=update.message.chat_id, text=message)
 
 
-def end_game(bot, update, chat_data=None):
-    """
-    Ends any pending or ongoing game.
-    """
-    if is_game_ongoing(chat_data):
-        bot.send_message(chat_id=update.message.chat_id,
-                         text=chat_data["game"].get_log())
-    reset_chat_data(chat_data)
-    bot.send_message(chat_id=update.message.chat_id,
-                     text="Any game has been ended. /newgame?")
-
-
 ### Required to set up games.
 
 
@@ -428,7 +1147,7 @@ def blaim(bot, update, chat_data):
                          text="%s needs to claim." % name)
 
 
-def blame(bot, update, chat_data):
+def blame_old(bot, update, chat_data):
     """
     Posts name of player who has next move.
     """
@@ -522,21 +1241,6 @@ def investigate_old(bot, update, chat_data=None, args=None):
 
 
 ### Bot handling.
-# Set up the bot.
-# If you want to use this bot yourself, please message me directly.
-token = open('ignore/token.txt', 'r').read()
-bot = telegram.Bot(token=token)
-
-# Create an updater to fetch updates.
-updater = Updater(token=token, use_context=True)
-dispatcher = updater.dispatcher
-
-# Log errors for future reference.
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s -'
-                    '%(message)s', level=logging.INFO,
-                    filename='ignore/logging.txt', filemode='a')
-
-
 # Command synonyms, where they apply.
 start_synonyms = ["start", "help", "rules"]
 joingame_synonyms = ["joingame", "join", "addme", "hibitch"]
@@ -546,36 +1250,149 @@ investigate_synonyms = ["investigate", "invest", "inv", "dig", "dog", "canine",
 claim_synonyms = ["claim", "c"]
 blame_synonyms = ["blaim", "blame", "blam"]
 
-# Logistical command handlers.
-start_handler = CommandHandler(start_synonyms, start)
-feedback_handler = CommandHandler('feedback', feedback)
-dispatcher.add_handler(start_handler)
-dispatcher.add_handler(feedback_handler)
-
-# Handlers related to organizing a game.
-newgame_handler = CommandHandler('newgame', new_game)
-joingame_handler = CommandHandler(joingame_synonyms, join_game)
-unjoin_handler = CommandHandler(unjoin_synonyms, unjoin_game)
-spectate_handler = CommandHandler('spectate', spectate)
-startgame_handler = CommandHandler('startgame', start_game)
-endgame_handler = CommandHandler('endgame', end_game)
-dispatcher.add_handler(newgame_handler)
-dispatcher.add_handler(joingame_handler)
-dispatcher.add_handler(unjoin_handler)
-dispatcher.add_handler(spectate_handler)
-dispatcher.add_handler(startgame_handler)
-
-# Handlers for in-game commands.
-investigate_handler = CommandHandler(investigate_synonyms, investigate)
-claim_handler = CommandHandler(claim_synonyms, claim)
-blaim_handler = CommandHandler(blame_synonyms, blame)
-display_handler = CommandHandler("display", display)
-dispatcher.add_handler(investigate_handler)
-dispatcher.add_handler(claim_handler)
-dispatcher.add_handler(blaim_handler)
-dispatcher.add_handler(display_handler)
-
-
-
-updater.start_polling()
-updater.idle()
+# The priority lane of each command. Anything else, such as /rules, goes in
+# the info lane; buttons and timers go in the moves lane.
+command_lanes = dict.fromkeys(investigate_synonyms + claim_synonyms,
+                              cthulhu_lanes.MOVES)
+command_lanes.update(dict.fromkeys(
+    ["newgame", "spectate", "startgame", "endgame", "expansions", "queue",
+     "unqueue", "broadcast"] + joingame_synonyms + unjoin_synonyms, cthulhu_lanes.SETUP))
+
+
+def add_handlers(dispatcher):
+    """
+    Registers every command handler with a dispatcher.
+
+    Kept separate from main() so that shard workers and offline tools can
+    drive the same handlers without connecting to Telegram.
+    """
+    # Logistical command handlers.
+    start_handler = CommandHandler(start_synonyms, start)
+    feedback_handler = CommandHandler('feedback', feedback)
+    dispatcher.add_handler(start_handler)
+    dispatcher.add_handler(feedback_handler)
+
+    # Handlers related to organizing a game.
+    newgame_handler = CommandHandler('newgame', new_game)
+    joingame_handler = CommandHandler(joingame_synonyms, join_game)
+    unjoin_handler = CommandHandler(unjoin_synonyms, unjoin_game)
+    spectate_handler = CommandHandler('spectate', spectate)
+    startgame_handler = CommandHandler('startgame', start_game)
+    endgame_handler = CommandHandler('endgame', end_game)
+    expansions_handler = CommandHandler('expansions', expansions)
+    dispatcher.add_handler(newgame_handler)
+    dispatcher.add_handler(joingame_handler)
+    dispatcher.add_handler(unjoin_handler)
+    dispatcher.add_handler(spectate_handler)
+    dispatcher.add_handler(startgame_handler)
+    dispatcher.add_handler(endgame_handler)
+    dispatcher.add_handler(expansions_handler)
+
+    # Handlers for in-game commands.
+    investigate_handler = CommandHandler(investigate_synonyms, investigate)
+    claim_handler = CommandHandler(claim_synonyms, claim)
+    blaim_handler = CommandHandler(blame_synonyms, blame)
+    display_handler = CommandHandler("display", display_board)
+    hand_handler = CommandHandler("hand", hand)
+    log_handler = CommandHandler("log", display_log)
+    history_handler = CommandHandler("history", history)
+    dispatcher.add_handler(investigate_handler)
+    dispatcher.add_handler(claim_handler)
+    dispatcher.add_handler(blaim_handler)
+    dispatcher.add_handler(display_handler)
+    dispatcher.add_handler(hand_handler)
+    dispatcher.add_handler(log_handler)
+    dispatcher.add_handler(history_handler)
+
+    # Move buttons.
+    button_handler = CallbackQueryHandler(press_button, pattern="^m")
+    dispatcher.add_handler(button_handler)
+
+    # Matchmaking.
+    queue_handler = CommandHandler("queue", queue)
+    unqueue_handler = CommandHandler("unqueue", unqueue)
+    dispatcher.add_handler(queue_handler)
+    dispatcher.add_handler(unqueue_handler)
+    dispatcher.add_handler(TypeHandler(QueueCheck, check_queue))
+    dispatcher.add_handler(TypeHandler(MatchFound, start_match))
+
+    # Announcements to every chat.
+    broadcast_handler = CommandHandler("broadcast", broadcast)
+    dispatcher.add_handler(broadcast_handler)
+
+    # Turn timers, delivered through the update queue.
+    timeout_handler = TypeHandler(TurnTimeout, turn_timeout)
+    dispatcher.add_handler(timeout_handler)
+
+
+def main():
+    """
+    Runs the bot.
+    """
+    # If you want to use this bot yourself, please message me directly.
+    token = open('ignore/token.txt', 'r').read()
+
+    # Log errors for future reference.
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s -'
+                        '%(message)s', level=logging.INFO,
+                        filename='ignore/logging.txt', filemode='a')
+
+    # Create an updater to fetch updates. Moves are handled in their own
+    # lane, so a burst of /rules can't hold them up.
+    bot = telegram.Bot(token, request=cthulhu_transport.PooledRequest(
+        cthulhu_lanes.POOL_SIZE))
+    dispatcher = cthulhu_lanes.LaneDispatcher(bot, Queue(), command_lanes,
+                                              context_types=CONTEXT_TYPES)
+    updater = Updater(dispatcher=dispatcher, workers=None)
+    add_handlers(updater.dispatcher)
+    # Idle chats and players are kept on disk rather than in memory.
+    updater.dispatcher.bot_data["evictions"] = cthulhu_eviction.EvictionManager(
+        "ignore/evicted.sqlite")
+    updater.dispatcher.bot_data["rate_limiter"] = (
+        cthulhu_ratelimit.RateLimiter())
+    # Messages are paced to Telegram's limits and retried after a 429.
+    updater.dispatcher.bot_data["outbox"] = cthulhu_outbox.Outbox(bot)
+    # One thread ticks every chat's turn timer.
+    wheel = cthulhu_timers.TimingWheel()
+    wheel.start()
+    updater.dispatcher.bot_data["turn_timers"] = cthulhu_timers.TurnTimers(
+        wheel)
+    # Matched games are played in the lobby chats listed in
+    # ignore/lobbies.txt, one "chat_id invite_link" per line.
+    if os.path.exists("ignore/lobbies.txt"):
+        with open("ignore/lobbies.txt") as f:
+            lobbies = dict(line.split() for line in f if line.strip())
+        updater.dispatcher.bot_data["lobbies"] = {
+            int(chat_id): link for chat_id, link in lobbies.items()}
+        updater.dispatcher.bot_data["matchmaker"] = (
+            cthulhu_matchmaking.Matchmaker())
+    # Finished games are kept for /history.
+    updater.dispatcher.bot_data["archive"] = cthulhu_archive.Archive(
+        "ignore/archive")
+    # The users in ignore/admins.txt, one id per line, may /broadcast. A
+    # broadcast cut short by a restart carries on where it stopped.
+    if os.path.exists("ignore/admins.txt"):
+        with open("ignore/admins.txt") as f:
+            updater.dispatcher.bot_data["admins"] = {
+                int(line) for line in f if line.strip()}
+    updater.dispatcher.bot_data["broadcast_checkpoint"] = (
+        "ignore/broadcast.json")
+    unfinished = cthulhu_broadcast.Broadcast.resume(updater.dispatcher,
+                                                    "ignore/broadcast.json")
+    if unfinished is not None:
+        updater.dispatcher.bot_data["broadcast"] = unfinished.start()
+    # Set CTHULHU_WEB_PORT to stream games to local web viewers.
+    if os.environ.get("CTHULHU_WEB_PORT"):
+        updater.dispatcher.bot_data["web_feed"] = cthulhu_webfeed.WebFeed(
+            port=int(os.environ["CTHULHU_WEB_PORT"])).start()
+    # Set CTHULHU_RECORD to a path to record anonymized traffic for replay.
+    if os.environ.get("CTHULHU_RECORD"):
+        cthulhu_replay.UpdateRecorder(os.environ["CTHULHU_RECORD"]).attach(
+            updater.dispatcher)
+    updater.start_polling()
+    updater.idle()
+    logging.info("API calls: %s", bot.request.stats)
+
+
+if __name__ == "__main__":
+    main()
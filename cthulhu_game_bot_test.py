@@ -0,0 +1,402 @@
+import cthulhu_archive
+import cthulhu_game as cg
+import cthulhu_game_bot as bot_module
+import cthulhu_matchmaking
+import cthulhu_ratelimit
+import cthulhu_testing as testing
+import cthulhu_timers
+import random
+import tempfile
+import unittest
+
+
+class BotTestCase(unittest.TestCase):
+    """
+    Runs commands through the real handlers with a FakeBot.
+    """
+
+    def setUp(self):
+        self.dispatcher = testing.make_dispatcher()
+        self.update_id = 0
+
+    def tearDown(self):
+        feed = self.dispatcher.bot_data.get("spectator_feed")
+        if feed is not None:
+            feed.stop()
+
+    def send(self, chat_id, user_id, text, thread_id=None):
+        self.update_id += 1
+        testing.process(self.dispatcher, testing.make_update(
+            self.update_id, chat_id, user_id, text, thread_id=thread_id))
+
+    def game(self, chat_id, thread_id=None):
+        return bot_module.table_data(self.dispatcher, chat_id,
+                                     thread_id).get("game")
+
+    def press(self, chat_id, user_id, data):
+        self.update_id += 1
+        testing.process(self.dispatcher, testing.make_callback(
+            self.update_id, chat_id, user_id, data))
+
+
+class TestGameCommands(BotTestCase):
+    """
+    Tests game commands.
+    """
+
+    def test_hands_sent_each_round(self):
+        """
+        Every player gets their new hand when a round ends.
+        """
+        random.seed(1)
+        users = [1, 2, 3, 4]
+        testing.play_game(self.send, self.game, -1, users)
+        game = self.game(-1)
+        self.assertEqual(game.game_status, "Ended")
+        for user_id in users:
+            hands = [t for t in self.dispatcher.bot.messages_for(user_id)
+                     if "(s)" in t]
+            self.assertEqual(len(hands), game.round_counter)
+
+    def test_report_sent_at_end(self):
+        """
+        The report is sent when a game ends, and again with /log.
+        """
+        random.seed(1)
+        users = [1, 2, 3, 4]
+        self.send(-1, 1, "/newgame")
+        self.send(-1, 1, "/log")
+        sent = self.dispatcher.bot.messages_for(-1)
+        self.assertEqual(sent[-1], "The log is shown once a game is over.")
+        testing.play_game(self.send, self.game, -1, users)
+        self.assertEqual(self.game(-1).game_status, "Ended")
+        reports = [t for t in self.dispatcher.bot.messages_for(-1)
+                   if "Round 1:" in t]
+        self.assertEqual(len(reports), 1)
+        self.assertIn("Roles:", reports[0])
+        self.send(-1, 2, "/log")
+        self.assertIn("Round 1:", self.dispatcher.bot.messages_for(-1)[-1])
+
+    def test_spectators_see_everything(self):
+        """
+        Spectators are DMed the same omniscient board after every move.
+        """
+        random.seed(2)
+        users = [1, 2, 3]
+        spectators = [10, 11, 12]
+        self.send(-1, users[0], "/newgame")
+        for user_id in spectators:
+            self.send(-1, user_id, "/spectate")
+        testing.play_game(self.send, self.game, -1, users)
+        feed = self.dispatcher.bot_data["spectator_feed"]
+        self.assertTrue(feed.flush(timeout=10))
+        boards = [self.dispatcher.bot.messages_for(user_id)
+                  for user_id in spectators]
+        self.assertTrue(boards[0])
+        self.assertEqual(boards[0], boards[1])
+        self.assertEqual(boards[0], boards[2])
+        self.assertIn("(Cultist)", boards[0][-1])
+        self.assertEqual(feed.sent, sum(len(b) for b in boards))
+        for text in self.dispatcher.bot.messages_for(-1):
+            self.assertNotIn("(Cultist)", text)
+
+    def start_timers(self):
+        """
+        Gives the bot turn timers on a wheel driven by a fake clock.
+        """
+        self.now = 0
+        self.wheel = cthulhu_timers.TimingWheel(clock=lambda: self.now)
+        self.dispatcher.bot_data["turn_timers"] = cthulhu_timers.TurnTimers(
+            self.wheel)
+
+    def wait(self, seconds):
+        """
+        Lets time pass and delivers any timers that went off.
+        """
+        self.now += seconds
+        self.wheel.advance(self.now)
+        queue = self.dispatcher.update_queue
+        while not queue.empty():
+            self.dispatcher.process_update(queue.get())
+
+    def test_turn_timeouts(self):
+        """
+        Idle players are nudged and then moved for, until the game ends.
+        """
+        random.seed(3)
+        self.start_timers()
+        users = [1, 2, 3]
+        testing.play_game(self.send, self.game, -1, users, max_moves=0)
+        game = self.game(-1)
+        self.assertEqual(len(self.wheel), 1)
+        # Moving in time re-arms the timer rather than adding one.
+        self.send(-1, *testing.next_move(game))
+        self.assertEqual(len(self.wheel), 1)
+        self.wait(60)
+        self.assertEqual(game.round_counter, 1)
+        key = game.get_turn_key()
+        waiting = game.get_current_player()
+        self.wait(60)
+        self.assertIn("[{}](tg://user?id={}) needs to claim.".format(
+            waiting, waiting.p_id), self.dispatcher.bot.messages_for(-1))
+        self.wait(120)
+        self.assertEqual(game.get_turn_key(), key)
+        self.wait(120)
+        self.assertNotEqual(game.get_turn_key(), key)
+        self.assertEqual(waiting.game_data.claim[0].title, "Blank")
+        for _ in range(200):
+            if game.game_status == "Ended":
+                break
+            self.wait(120)
+        self.assertEqual(game.game_status, "Ended")
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_forum_topics(self):
+        """
+        Each forum topic of a chat plays its own game, with its own turn
+        timer, and the bot answers in the topic it was asked in.
+        """
+        random.seed(4)
+        self.start_timers()
+        tables = {None: [1, 2, 3], 5: [4, 5, 6], 7: [7, 8, 9, 10]}
+        for thread_id, users in tables.items():
+            testing.play_game(
+                lambda c, u, t: self.send(c, u, t, thread_id=thread_id),
+                lambda c: self.game(c, thread_id), -1, users, max_moves=0)
+        games = {thread_id: self.game(-1, thread_id) for thread_id in tables}
+        self.assertEqual(len(set(map(id, games.values()))), 3)
+        self.assertEqual(len(self.wheel), 3)
+        for thread_id, game in games.items():
+            self.assertEqual([p.p_id for p in game.players], tables[thread_id])
+        # Moves in one topic leave the others alone.
+        while any(game.game_status != "Ended" for game in games.values()):
+            for thread_id, game in games.items():
+                move = testing.next_move(game)
+                if move is not None:
+                    self.send(-1, *move, thread_id=thread_id)
+        self.assertEqual(len(self.wheel), 0)
+        bot = self.dispatcher.bot
+        for thread_id, game in games.items():
+            self.assertIn(game.display_board(), bot.messages_for(-1, thread_id))
+        self.assertNotIn(games[7].display_board(), bot.messages_for(-1, 5))
+        # A timer for a topic's game moves in that topic.
+        testing.play_game(lambda c, u, t: self.send(c, u, t, thread_id=5),
+                          lambda c: self.game(c, 5), -1, tables[5],
+                          max_moves=0)
+        waiting = self.game(-1, 5).get_current_player()
+        for _ in range(5):
+            self.wait(120)
+        self.assertIn("{} took too long, so I'm moving for them.".format(
+            waiting), bot.messages_for(-1, 5))
+        self.assertEqual(self.game(-1, 7).game_status, "Ended")
+
+    def test_moves_from_dm(self):
+        """
+        Players can claim and see their hand from a DM; the hand never goes
+        to the group.
+        """
+        random.seed(5)
+        users = [1, 2, 3]
+        testing.play_game(self.send, self.game, -1, users, max_moves=0)
+        game = self.game(-1)
+        bot = self.dispatcher.bot
+        player = game.get_current_player()
+        waiting = next(p for p in game.get_active_players() if p is not player)
+        self.send(player.p_id, player.p_id, "/hand")
+        self.send(-1, waiting.p_id, "/hand")
+        for p in (player, waiting):
+            self.assertEqual(bot.messages_for(p.p_id)[-1], "{}\n{}".format(
+                p.role_summary(), p.hand_summary()))
+        self.assertNotIn(player.hand_summary(), bot.messages_for(-1))
+        # A bad claim's error comes back to the DM.
+        sent = len(bot.messages_for(-1))
+        self.send(waiting.p_id, waiting.p_id, "/claim cat")
+        with self.assertRaises(cg.GameError) as caught:
+            cg.parse_claim(["cat"], 5)
+        self.assertEqual(bot.messages_for(waiting.p_id)[-1],
+                         caught.exception.message)
+        self.assertEqual(len(bot.messages_for(-1)), sent)
+        turn = game.get_turn_key()
+        self.send(player.p_id, player.p_id, "/claim")
+        self.assertNotEqual(game.get_turn_key(), turn)
+        self.assertEqual(bot.messages_for(-1)[-1], game.display_board())
+        self.assertNotIn("game", self.dispatcher.chat_data[player.p_id])
+        self.send(50, 50, "/claim")
+        self.assertEqual(bot.messages_for(50)[-1],
+                         "You aren't playing in a game right now.")
+        while game.game_status != "Ended":
+            self.send(-1, *testing.next_move(game))
+        self.send(player.p_id, player.p_id, "/hand")
+        self.assertEqual(bot.messages_for(player.p_id)[-1],
+                         "You aren't playing in a game right now.")
+
+    def test_buttons(self):
+        """
+        A whole game can be played with the move buttons.
+        """
+        random.seed(5)
+        users = [1, 2, 3, 4]
+        testing.play_game(self.send, self.game, -1, users, max_moves=0)
+        bot = self.dispatcher.bot
+        while True:
+            move = testing.next_button(self.game(-1), bot.keyboards[-1])
+            if move is None:
+                break
+            self.press(-1, *move)
+        self.assertEqual(self.game(-1).game_status, "Ended")
+        self.assertIsNone(bot.keyboards[-1])
+        self.assertEqual([text for _, text in bot.answered],
+                         [None] * len(bot.answered))
+        for text in bot.messages_for(-1):
+            self.assertNotIn("Invalid", text)
+
+    def test_stale_buttons(self):
+        """
+        Old buttons and other players' presses are turned away quietly.
+        """
+        random.seed(6)
+        testing.play_game(self.send, self.game, -1, [1, 2, 3], max_moves=0)
+        bot = self.dispatcher.bot
+        game = self.game(-1)
+        user_id, data = testing.next_button(game, bot.keyboards[-1])
+        other = 1 if user_id != 1 else 2
+        sent = len(bot.sent)
+        self.press(-1, other, data)
+        self.assertEqual(bot.answered[-1][1], "It's not your turn.")
+        self.press(-1, user_id, data)
+        version = game.version
+        self.press(-1, user_id, data)
+        self.assertEqual(bot.answered[-1][1], "That button is out of date.")
+        self.press(-1, user_id, "mgarbage")
+        self.assertEqual(bot.answered[-1][1],
+                         "That button doesn't do anything.")
+        self.assertEqual(game.version, version)
+        # Only the one real move produced chat messages.
+        self.assertEqual(len(bot.sent), sent + 1)
+
+    def test_button_encoding(self):
+        """
+        Move buttons round-trip through seven characters of callback_data.
+        """
+        for version in (0, 1, 65535, 65536 + 7):
+            data = bot_module.encode_button(version, 2, 10)
+            self.assertEqual(len(data), 7)
+            self.assertEqual(bot_module.decode_button(data),
+                             (version & 0xFFFF, 2, 10))
+        for data in ("", "m", "x" * 7, "m!!!!!!"):
+            self.assertRaises(ValueError, bot_module.decode_button, data)
+
+    def test_expansions_need_pending_game(self):
+        """
+        /expansions doesn't create a game, and only works before it starts.
+        """
+        self.send(-1, 1, "/expansions power")
+        self.assertIsNone(self.game(-1))
+        self.send(-1, 1, "/newgame")
+        self.send(-1, 1, "/expansions power")
+        self.assertEqual(self.game(-1).game_settings.expansions,
+                         [cg.OBJECTS_OF_POWER])
+        self.assertNotIn("game_settings", self.dispatcher.chat_data[-1])
+
+    def test_flooding_dropped(self):
+        """
+        A flooding user is warned once and dropped, without holding up
+        anyone else.
+        """
+        now = [0]
+        self.dispatcher.bot_data["rate_limiter"] = (
+            cthulhu_ratelimit.RateLimiter(user_rate=1, user_burst=2,
+                                          clock=lambda: now[0]))
+        self.send(-1, 1, "/newgame")
+        for _ in range(10):
+            self.send(-1, 1, "/blame")
+        warnings = [text for text in self.dispatcher.bot.messages_for(-1)
+                    if "slow down" in text]
+        self.assertEqual(warnings, ["P1, slow down! I'll ignore your "
+                                    "commands for a few seconds."])
+        self.send(-1, 2, "/join")
+        self.assertEqual(len(self.game(-1).players), 1)
+        now[0] += 1
+        self.send(-1, 1, "/join")
+        self.assertEqual(len(self.game(-1).players), 2)
+
+    def test_history(self):
+        """
+        Finished games are archived and listed by /history.
+        """
+        directory = tempfile.TemporaryDirectory()
+        archive = cthulhu_archive.Archive(directory.name)
+        self.dispatcher.bot_data["archive"] = archive
+        try:
+            self.send(5, 5, "/history")
+            self.assertEqual(self.dispatcher.bot.messages_for(5)[-1],
+                             "You haven't finished any games yet.")
+            random.seed(1)
+            testing.play_game(self.send, self.game, -1, [1, 2, 3, 4])
+            self.send(-2, 1, "/newgame")
+            self.send(-2, 1, "/endgame")
+            self.assertEqual(archive.count, 1)
+            self.send(2, 2, "/history")
+            lines = self.dispatcher.bot.messages_for(2)[-1].split("\n")
+            self.assertEqual(len(lines), 2)
+            self.assertIn("4 players", lines[1])
+        finally:
+            archive.close()
+            directory.cleanup()
+
+    def test_broadcast(self):
+        """
+        Only admins can broadcast, and every chat with a game hears it.
+        """
+        self.dispatcher.bot_data["admins"] = {1}
+        for chat_id in (-1, -2, -3):
+            self.send(chat_id, 2, "/newgame")
+        self.send(2, 2, "/broadcast Restarting at noon")
+        self.assertNotIn("broadcast", self.dispatcher.bot_data)
+        self.send(1, 1, "/broadcast Restarting at noon")
+        self.dispatcher.bot_data["broadcast"].thread.join(timeout=10)
+        for chat_id in (-1, -2, -3):
+            self.assertEqual(self.dispatcher.bot.messages_for(chat_id)[-1],
+                             "Restarting at noon")
+        self.send(1, 1, "/broadcast")
+        self.assertTrue(self.dispatcher.bot.messages_for(1)[-1].startswith(
+            "Broadcast finished: 3 chats"))
+
+    def test_matchmaking(self):
+        """
+        Players who /queue in DMs are matched into a game in a free lobby,
+        and later players wait for the next free one.
+        """
+        random.seed(8)
+        self.start_timers()
+        self.dispatcher.bot_data["lobbies"] = {-500: "https://t.me/+lobby"}
+        self.dispatcher.bot_data["matchmaker"] = (
+            cthulhu_matchmaking.Matchmaker(clock=lambda: self.now))
+        self.send(-1, 1, "/queue")
+        self.assertEqual(self.dispatcher.bot.messages_for(-1)[-1],
+                         "Message me directly to join the queue.")
+        for user_id in [1, 2, 3]:
+            self.send(user_id, user_id, "/queue 3")
+        self.send(4, 4, "/queue 3")
+        self.send(5, 5, "/queue")
+        self.send(6, 6, "/queue")
+        self.send(6, 6, "/unqueue")
+        self.send(7, 7, "/queue 4")
+        self.wait(0)
+        game = self.game(-500)
+        self.assertEqual(game.game_status, "Ongoing")
+        self.assertEqual([p.p_id for p in game.players], [1, 2, 3])
+        self.assertIn("Your game is starting! Join it at "
+                      "https://t.me/+lobby",
+                      self.dispatcher.bot.messages_for(2))
+        self.wait(60)
+        self.assertEqual(len(self.dispatcher.bot_data["matchmaker"]), 3)
+        game.end_game()
+        self.wait(5)
+        self.assertEqual([p.p_id for p in self.game(-500).players],
+                         [4, 5, 7])
+        self.assertEqual(self.game(-500).game_status, "Ongoing")
+
+
+if __name__ == "__main__":
+    unittest.main()
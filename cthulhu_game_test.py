@@ -1,4 +1,10 @@
 from cthulhu_game import *
+from cthulhu_testing import play_random_game
+import os
+import pickle
+import random
+import tempfile
+import tracemalloc
 import unittest
 import emojis
 
@@ -47,7 +53,7 @@ class TestCardClass(unittest.TestCase):
         Test readins of the powercards.
         """
         for card in ["Paranoia", "Mirage", "Prescient Vision",
-                     "Evil Prescence", "Private Eye", "Insanity's Grasp"]:
+                     "Evil Presence", "Private Eye", "Insanity's Grasp"]:
             test_card = Card(ctype=card)
             self.assertEqual(test_card.title, card)
 
@@ -94,6 +100,50 @@ class TestPlayerClass(unittest.TestCase):
         self.assertTrue(test_player.hand_summary())
 
 
+    def test_memory(self):
+        """
+        Players and cards stay small, since every user is kept.
+        """
+        get_ruleset()
+
+        def bytes_each(make, n=5000):
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            made = [make(i) for i in range(n)]
+            after = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            return (after - before) / len(made)
+
+        def in_game(i):
+            player = Player(i, nickname="P")
+            player.start_playing(CULTIST)
+            player.set_hand([Card(ctype="Blank") for _ in range(5)])
+            return player
+        self.assertLess(bytes_each(lambda i: Player(i, nickname="P")), 200)
+        self.assertLess(bytes_each(lambda i: Card(ctype="Blank")), 64)
+        self.assertLess(bytes_each(in_game), 700)
+        self.assertFalse(hasattr(Player(1), "__dict__"))
+
+    def test_pickling(self):
+        """
+        Slotted players pickle, and so do players pickled with a __dict__.
+        """
+        player = Player(1)
+        self.assertEqual(str(player), "1")
+        player.start_playing(INVESTIGATOR)
+        player.set_hand([Card(ctype="Cthulhu")])
+        player.game_data.cards[0].flip_up()
+        copy = pickle.loads(pickle.dumps(player))
+        self.assertEqual(copy.game_data.role, INVESTIGATOR)
+        self.assertEqual(copy.game_data.cards[0].title, "Cthulhu")
+        self.assertTrue(copy.game_data.cards[0].is_flipped)
+        old = Card.__new__(Card)
+        old.__setstate__({"title": "Blank", "description": "", "symbol": "b",
+                          "is_flipped": True})
+        self.assertEqual((old.title, old.symbol, old.is_flipped),
+                         ("Blank", "b", True))
+
+
 class TestGameClass(unittest.TestCase):
     """
     Tests the game class.
@@ -111,6 +161,446 @@ class TestGameClass(unittest.TestCase):
             game.add_player(Player(random.randint(1, 1000)), is_playing=False)
         game.start_game()
 
+    def test_full_games(self):
+        """
+        Games with and without expansions play through to a winner.
+        """
+        for expansions in [[], [NECRONOMICON], [OBJECTS_OF_POWER],
+                           [NECRONOMICON, OBJECTS_OF_POWER]]:
+            for seed in range(20):
+                game = play_random_game(random.randint(3, 10), expansions,
+                                        seed=seed)
+                self.assertEqual(game.game_status, "Ended")
+                self.assertIn(game.winner, ["Investigator", "Cultist"])
+
+    def test_unused_effects_not_compiled(self):
+        """
+        Only cards in the deck get hooks.
+        """
+        game = make_game(5)
+        game.start_game()
+        self.assertEqual(sorted(game.reveal_hooks), ["Cthulhu", "Elder Sign"])
+        self.assertEqual(game.round_end_hooks, [])
+        self.assertEqual(game.win_checks, [])
+        settings = GameSettings()
+        settings.expansions = [NECRONOMICON, OBJECTS_OF_POWER]
+        game = make_game(5, settings)
+        game.start_game()
+        self.assertIn("Mirage", game.reveal_hooks)
+        self.assertEqual(len(game.round_end_hooks), 2)
+        self.assertEqual(len(game.win_checks), 1)
+        self.assertEqual(len(game.deck) + sum(
+            len(p.game_data.cards) for p in game.players), 25)
+
+    def test_necronomicon(self):
+        """
+        The Necronomicon wins for the Cultists if found before any sign.
+        """
+        settings = GameSettings()
+        settings.expansions = [NECRONOMICON]
+        game = make_game(4, settings)
+        game.start_game()
+        user, target = game.players[0], game.players[1]
+        target.set_hand([Card(ctype="Necronomicon"), Card(ctype="Blank")])
+        self.start_investigations(game, user)
+        game.investigate(user, target)
+        self.assertEqual(game.game_status, "Ended")
+        self.assertEqual(game.winner, "Cultist")
+
+    def test_mirage(self):
+        """
+        A Mirage returns a found Elder Sign to the deck.
+        """
+        settings = GameSettings()
+        settings.expansions = [OBJECTS_OF_POWER]
+        game = make_game(4, settings)
+        game.start_game()
+        a, b, c = game.players[0], game.players[1], game.players[2]
+        b.set_hand([Card(ctype="Elder Sign"), Card(ctype="Blank")])
+        c.set_hand([Card(ctype="Mirage"), Card(ctype="Blank")])
+        self.start_investigations(game, a)
+        game.investigate(a, b)
+        self.assertEqual(game.signs_found, 1)
+        deck_size = len(game.deck)
+        game.investigate(b, c)
+        self.assertEqual(game.signs_found, 0)
+        self.assertEqual(len(game.deck), deck_size + 1)
+        self.assertEqual(len(b.game_data.cards), 1)
+
+    def test_mirage_returns_necronomicon(self):
+        """
+        A Necronomicon counted as a sign can be taken back by a Mirage.
+        """
+        settings = GameSettings()
+        settings.expansions = [NECRONOMICON, OBJECTS_OF_POWER]
+        game = make_game(4, settings)
+        game.start_game()
+        a, b, c, d = game.players
+        b.set_hand([Card(ctype="Elder Sign"), Card(ctype="Blank")])
+        c.set_hand([Card(ctype="Necronomicon"), Card(ctype="Blank")])
+        d.set_hand([Card(ctype="Mirage"), Card(ctype="Blank")])
+        self.start_investigations(game, a)
+        game.investigate(a, b)
+        game.investigate(b, c)
+        self.assertEqual(game.signs_found, 2)
+        # Move the sign to the discard so the Necronomicon is the only one
+        # left on the table.
+        b.game_data.cards.remove(b.game_data.cards[0])
+        game.investigate(c, d)
+        self.assertEqual(game.signs_found, 1)
+        self.assertEqual(len(c.game_data.cards), 1)
+
+    def test_investigate_rules(self):
+        """
+        Investigations need the flashlight and another player.
+        """
+        game = make_game(3)
+        game.start_game()
+        user = game.players[0]
+        self.assertRaises(GameError, game.investigate, user, game.players[1])
+        self.start_investigations(game, user)
+        self.assertRaises(GameError, game.investigate, user, user)
+        self.assertRaises(GameError, game.investigate, game.players[1],
+                          game.players[2])
+
+    @staticmethod
+    def start_investigations(game, holder):
+        """
+        Skips the claims phase and hands the flashlight to a player.
+        """
+        for p in game.players:
+            p.game_data.has_flashlight = p is holder
+        game.new_phase()
+
+
+class TestNameIndex(unittest.TestCase):
+    """
+    Tests finding players by seat or name, and parsing command arguments.
+    """
+
+    def make_named_game(self, names, spectators=0):
+        game = Game()
+        for i, name in enumerate(names):
+            game.add_player(Player(i + 1, nickname=name))
+        for i in range(spectators):
+            game.add_player(Player(100 + i, nickname="Aspect{}".format(i)),
+                            is_playing=False)
+        return game
+
+    def test_seats_and_names(self):
+        """
+        Players are found by seat, exact name or unique prefix.
+        """
+        names = ["Alice", "Al", "Bob", "bobby", "Carol", "Dan", "Eve",
+                 "Frank", "Grace", "Heidi"]
+        game = self.make_named_game(names, spectators=20)
+        find = game.find_player
+        self.assertEqual(find(parse_target(["1"])).nickname, "Alice")
+        self.assertEqual(find(parse_target(["10"])).nickname, "Heidi")
+        self.assertEqual(find(parse_target(["#3"])).nickname, "Bob")
+        self.assertEqual(find(parse_target(["al"])).nickname, "Al")
+        self.assertEqual(find(parse_target(["ali"])).nickname, "Alice")
+        self.assertEqual(find(parse_target(["BOB"])).nickname, "Bob")
+        self.assertEqual(find(parse_target(["bobb"])).nickname, "bobby")
+        self.assertEqual(find(parse_target(["car"])).nickname, "Carol")
+        # Spectators and empty seats aren't targets.
+        self.assertRaises(GameError, find, parse_target(["Aspect1"]))
+        self.assertRaises(GameError, find, parse_target(["11"]))
+        self.assertRaises(GameError, find, parse_target(["0"]))
+        self.assertRaises(GameError, find, parse_target(["Zed"]))
+        self.assertRaises(GameError, parse_target, [])
+
+    def test_ambiguous_prefix(self):
+        """
+        A prefix shared by several players is rejected.
+        """
+        game = self.make_named_game(["Carol", "Carl", "Dan"])
+        self.assertRaises(GameError, game.find_player, parse_target(["car"]))
+        self.assertEqual(game.is_valid_name("carl"), 1)
+        self.assertEqual(game.is_valid_name("ca"), -1)
+
+    def test_rebuilt_on_roster_change(self):
+        """
+        The index follows players joining and leaving.
+        """
+        game = self.make_named_game(["Carol", "Dan"])
+        self.assertEqual(game.find_player(parse_target(["c"])).nickname,
+                         "Carol")
+        index = game.name_index
+        game.find_player(parse_target(["2"]))
+        self.assertIs(game.name_index, index)
+        game.add_player(Player(3, nickname="Cecil"))
+        self.assertRaises(GameError, game.find_player, parse_target(["c"]))
+        game.remove_player(game.players[0])
+        self.assertEqual(game.find_player(parse_target(["c"])).nickname,
+                         "Cecil")
+        self.assertEqual(game.find_player(parse_target(["1"])).nickname,
+                         "Dan")
+
+    def test_parse_claim(self):
+        """
+        Claims parse into (blank, elder, cthulhu) for the hand size.
+        """
+        self.assertEqual(parse_claim([], 5), (5, 0, 0))
+        self.assertEqual(parse_claim(["rock"], 5), (5, 0, 0))
+        self.assertEqual(parse_claim(["2"], 5), (3, 2, 0))
+        self.assertEqual(parse_claim(["C"], 5), (4, 0, 1))
+        self.assertEqual(parse_claim(["2", "c"], 5), (2, 2, 1))
+        self.assertEqual(parse_claim(["1", "1"], 4), (2, 1, 1))
+        self.assertEqual(parse_claim(["1", "cthulhu"], 4), (2, 1, 1))
+        for args in (["6"], ["cat"], ["2", "x"], ["-1"], ["3", "3"]):
+            self.assertRaises(GameError, parse_claim, args, 5)
+
+
+class TestSeatIndex(unittest.TestCase):
+    """
+    Tests finding the game a user is playing in.
+    """
+
+    def check(self, index, games):
+        """
+        Checks that every seat is at a live game the user is in, and that
+        every game in progress holds its players' seats.
+        """
+        for user_id, seat in index.seats.items():
+            if seat.game is None:
+                continue
+            self.assertEqual(seat.player.p_id, user_id)
+            self.assertIn(seat.player, seat.game.get_active_players())
+            self.assertNotEqual(seat.game.game_status, "Ended")
+            self.assertEqual(seat.table, seat.game.table)
+        for game in games:
+            if game.game_status == "Ongoing":
+                for player in game.get_active_players():
+                    self.assertIs(index.get(player.p_id).game, game)
+
+    def test_seats(self):
+        """
+        Joining, leaving and ending games move seats; a game in progress
+        keeps its players until it ends, even while evicted.
+        """
+        index = SeatIndex()
+        first, second = Game(), Game()
+        index.bind(first, -1)
+        index.bind(second, (-2, 5))
+        players = [Player(i + 1) for i in range(4)]
+        for player in players:
+            first.add_player(player)
+        second.add_player(players[0])
+        self.assertEqual(index.get(1).table, (-2, 5))
+        first.start_game()
+        self.assertEqual(index.get(1).table, -1)
+        self.assertEqual(index.get(3).number(), 3)
+        self.assertRaises(GameError, second.add_player, players[1])
+        index.release(first)
+        self.assertEqual(index.get(2), Seat(-1, None, None))
+        self.assertRaises(GameError, second.add_player, players[1])
+        index.bind(first, -1)
+        self.assertIs(index.get(2).game, first)
+        first.remove_player(players[3])
+        self.assertIsNone(index.get(4))
+        first.end_game()
+        self.assertEqual(len(index), 0)
+        second.add_player(players[1])
+        self.assertIs(index.get(2).game, second)
+
+    def test_stress(self):
+        """
+        The index stays consistent through thousands of random joins,
+        leaves, starts, ends and evictions.
+        """
+        rng = random.Random(6)
+        index = SeatIndex()
+        players = [Player(i + 1) for i in range(120)]
+        games = []
+        for table in range(20):
+            games.append(Game())
+            index.bind(games[-1], -table - 1)
+        for _ in range(5000):
+            i = rng.randrange(len(games))
+            game = games[i]
+            player = rng.choice(players)
+            action = rng.random()
+            try:
+                if action < 0.5:
+                    game.add_player(player)
+                elif action < 0.75:
+                    game.remove_player(player)
+                elif action < 0.85:
+                    game.start_game()
+                elif action < 0.95:
+                    if game.game_status == "Ongoing":
+                        game.end_game()
+                        games[i] = Game()
+                        index.bind(games[i], game.table)
+                else:
+                    index.release(game)
+                    index.bind(game, game.table)
+            except GameError:
+                pass
+            self.check(index, games)
+        self.assertTrue(any(g.game_status == "Ongoing" for g in games))
+
+
+class TestReport(unittest.TestCase):
+    """
+    Tests the end-of-game report.
+    """
+
+    def test_chunk_lines(self):
+        """
+        Lines are joined into messages under the limit, and overlong lines
+        are split.
+        """
+        lines = ["", "a" * 30, "b" * 30, "", "c" * 30, "d" * 150, "e" * 10]
+        chunks = list(chunk_lines(lines, 70))
+        self.assertEqual(chunks[0], "a" * 30 + "\n" + "b" * 30)
+        self.assertEqual(chunks[1], "c" * 30)
+        for chunk in chunks:
+            self.assertLessEqual(message_length(chunk), 70)
+            self.assertTrue(chunk.strip())
+        self.assertEqual("".join(chunks[2:]).replace("\n", ""),
+                         "d" * 150 + "e" * 10)
+        emoji = list(chunk_lines(["\U0001F419" * 100], 70))
+        self.assertTrue(all(message_length(c) <= 70 for c in emoji))
+        self.assertEqual(list(chunk_lines([])), [])
+
+    def test_report(self):
+        """
+        The report shows every round's hands, claims and reveals, in
+        messages under Telegram's limit.
+        """
+        random.seed(2)
+        game = Game()
+        for i in range(10):
+            game.add_player(Player(i + 1, nickname="Player{}".format(i) * 20))
+        game.start_game()
+        self.assertEqual(len(game.rounds), 1)
+        players = game.get_active_players()
+        first = game.get_current_player()
+        game.set_claim(first, len(first.game_data.cards), 0, 0)
+        target = game.get_next_player(first)
+        while game.phase == "Claims":
+            player = game.get_current_player()
+            game.set_claim(player, len(player.game_data.cards) - 1, 1, 0)
+        card = game.investigate(game.get_current_player(), target)
+        log = game.rounds[0]
+        self.assertEqual(log.claims[players.index(first)],
+                         (len(first.game_data.cards), 0, 0))
+        self.assertEqual(log.reveals[0][1], players.index(target))
+        game.end_game()
+        chunks = list(game.get_log(1000))
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(message_length(chunk), 1000)
+        report = "\n".join(chunks)
+        self.assertIn("Round 1:", report)
+        self.assertIn("{}: {}".format(players[3], players[3].game_data.role),
+                      report)
+        self.assertIn("{} investigated {}".format(
+            game.get_active_players()[log.reveals[0][0]], target), report)
+        self.assertEqual(list(Game().get_log()),
+                         ["This game never started."])
+
+
+class TestRuleset(unittest.TestCase):
+    """
+    Tests loading and validating the rules.
+    """
+
+    def write_file(self, text):
+        """
+        Writes a temporary data file and returns its path.
+        """
+        f = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False)
+        f.write(text)
+        f.close()
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def test_default_ruleset(self):
+        """
+        Every player count from 3 to 10 has roles and decks.
+        """
+        ruleset = get_ruleset()
+        self.assertIs(ruleset, get_ruleset())
+        for n_players in range(3, 11):
+            self.assertGreaterEqual(len(ruleset.roles[n_players]), n_players)
+            recipe = ruleset.deck_recipe(n_players, [NECRONOMICON])
+            self.assertEqual(len(recipe), n_players * 5)
+            self.assertIn("Necronomicon", recipe)
+        with self.assertRaises(TypeError):
+            ruleset.roles[3] = ()
+
+    def test_malformed_roles(self):
+        """
+        A role row that can't seat everyone is rejected.
+        """
+        rows = ["{},{},{}".format(n, n - 2, 2) for n in range(3, 11)]
+        rows[2] = "5,1,1"
+        path = self.write_file("\n".join(rows))
+        self.assertRaises(InvalidSettingsError, Ruleset, role_path=path)
+        path = self.write_file("3,2,1\n4,three,1")
+        self.assertRaises(ValueError, Ruleset, role_path=path)
+
+    def test_missing_card_data(self):
+        """
+        Every card with an effect needs card data.
+        """
+        path = self.write_file("Blank,Nothing.,white_circle")
+        self.assertRaises(InvalidSettingsError, Ruleset, card_path=path)
+
+    def test_settings_validation(self):
+        """
+        Settings are checked against the ruleset.
+        """
+        ruleset = get_ruleset()
+        settings = GameSettings()
+        settings.validate(ruleset)
+        settings.expansions = ["Expansion of Doom"]
+        self.assertRaises(InvalidSettingsError, settings.validate, ruleset)
+        settings = GameSettings()
+        settings.min_players = 6
+        settings.max_players = 5
+        self.assertRaises(InvalidSettingsError, settings.validate, ruleset)
+        settings = GameSettings()
+        settings.max_players = 12
+        self.assertRaises(InvalidSettingsError, settings.validate, ruleset)
+
+    def test_custom_ruleset_cards(self):
+        """
+        A game's cards come from its own ruleset.
+        """
+        text = open("card_information/card_data.txt").read()
+        path = self.write_file(text.replace("octopus", "squid"))
+        ruleset = Ruleset(card_path=path)
+        game = make_game(4)
+        game.ruleset = ruleset
+        game.start_game()
+        cthulhu = [c for p in game.players for c in p.game_data.cards
+                   if c.title == "Cthulhu"]
+        self.assertEqual(cthulhu[0].symbol, emojis.encode(":squid:"))
+        game = pickle.loads(pickle.dumps(game))
+        self.assertEqual(game.ruleset.cards["Cthulhu"][2],
+                         emojis.encode(":squid:"))
+
+    def test_too_few_players(self):
+        """
+        Games can't start below the minimum player count.
+        """
+        game = make_game(2)
+        self.assertRaises(GameError, game.start_game)
+
+
+def make_game(n_players, settings=None):
+    """
+    Returns an unstarted game with n players.
+    """
+    game = Game(settings)
+    for i in range(n_players):
+        game.add_player(Player(i + 1, nickname="P{}".format(i + 1)))
+    return game
+
 
 if __name__ == "__main__":
     unittest.main()
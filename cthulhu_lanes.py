@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+This module runs the bot's handlers in priority lanes.
+
+A plain Dispatcher handles one update at a time, so a burst of /rules in a
+big group holds up moves in every other chat. LaneDispatcher sorts each
+update into a lane by its command:
+  - moves: claims, investigations, button presses and the bot's own timers;
+  - setup: creating, joining, starting and ending games;
+  - info: /start, /help, /rules, /feedback, /display and anything else.
+Each lane has its own workers and bounded queues. When the setup or info
+lane is full, new updates for it are dropped ("shed") rather than queued;
+the moves lane never sheds, and makes polling wait instead.
+
+A chat's updates always go to the same worker of a lane, so its moves are
+handled in order, and a lock per chat keeps two lanes from running the
+same chat's handlers at once. Each forum topic of a chat counts as a chat of
+its own here, as each can hold its own game.
+"""
+import logging
+import queue
+import threading
+
+from telegram.ext import Dispatcher
+from telegram.ext import JobQueue
+
+MOVES, SETUP, INFO = 0, 1, 2
+LANE_NAMES = ("moves", "setup", "info")
+
+# The default workers and queue size per worker of each lane.
+WORKERS = (4, 2, 1)
+MAXSIZE = (1000, 200, 50)
+# Enough connections for every worker, polling, the timers and the main
+# thread.
+POOL_SIZE = sum(WORKERS) + 4
+
+
+def topic_of(update):
+    """
+    Returns the forum topic an update was sent in, or None if it wasn't
+    sent in one. The bot's own updates, such as turn timers, carry the
+    topic of the game they're for as thread_id.
+    """
+    thread_id = getattr(update, "thread_id", None)
+    if thread_id is not None:
+        return thread_id
+    message = getattr(update, "effective_message", None)
+    if message is not None and message.is_topic_message:
+        return message.message_thread_id
+    return None
+
+
+def table_key(update):
+    """
+    Returns the key of the game an update is for: the chat's id, or
+    (chat id, topic) in a forum topic.
+    """
+    chat = update.effective_chat
+    if chat is None:
+        return None
+    thread_id = topic_of(update)
+    return chat.id if thread_id is None else (chat.id, thread_id)
+
+
+class Lane:
+    """
+    A pool of workers, each with its own bounded queue.
+
+    Attributes:
+      name - the lane's name.
+      queues - one queue per worker.
+      shed - whether to drop updates when a queue is full, rather than wait.
+      dropped - the number of updates shed.
+      handled - the number of updates handled.
+    """
+
+    def __init__(self, name, workers, maxsize, shed):
+        self.name = name
+        self.queues = [queue.Queue(maxsize) for _ in range(workers)]
+        self.shed = shed
+        self.dropped = 0
+        self.handled = 0
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self, handle):
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(target=self.run, args=(q, handle),
+                                      daemon=True,
+                                      name="lane-{}-{}".format(self.name, i))
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self, q, handle):
+        while True:
+            update = q.get()
+            if update is None:
+                return
+            handle(update)
+            with self.lock:
+                self.handled += 1
+
+    def put(self, key, update):
+        """
+        Queues an update on the worker for its chat. Returns False if it
+        was shed.
+        """
+        q = self.queues[hash(key) % len(self.queues)]
+        if not self.shed:
+            q.put(update)
+            return True
+        try:
+            q.put_nowait(update)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class LaneDispatcher(Dispatcher):
+    """
+    A Dispatcher that hands updates to priority lanes instead of handling
+    them on its own thread.
+
+    Until start() is called, updates are handled straight away as usual.
+
+    Attributes:
+      command_lanes - maps a command, without the slash, to its lane.
+      lanes - the Lanes, indexed by MOVES, SETUP and INFO.
+      locks - locks shared out between chats and topics by hash.
+    """
+
+    def __init__(self, bot, update_queue, command_lanes, workers=WORKERS,
+                 maxsize=MAXSIZE, n_locks=256, **kwargs):
+        """
+        Arguments:
+          bot, update_queue - as for Dispatcher.
+          command_lanes - maps a command, without the slash, to its lane.
+            Other text goes in the info lane; updates without text, such as
+            button presses and timers, go in the moves lane.
+          workers - the number of workers in each lane.
+          maxsize - the queue size of each of a lane's workers.
+          n_locks - the number of chat locks.
+          Other keyword arguments are passed on to Dispatcher.
+        """
+        self.command_lanes = dict(command_lanes)
+        self.lanes = [Lane(name, n, size, shed=lane != MOVES)
+                      for lane, (name, n, size) in enumerate(
+                          zip(LANE_NAMES, workers, maxsize))]
+        self.locks = [threading.Lock() for _ in range(n_locks)]
+        self.lanes_running = False
+        kwargs.setdefault("use_context", True)
+        # Updater expects a dispatcher it's given to come with a JobQueue.
+        kwargs.setdefault("job_queue", JobQueue())
+        super().__init__(bot, update_queue, **kwargs)
+        self.job_queue.set_dispatcher(self)
+
+    def classify(self, update):
+        """
+        Returns the lane for an update.
+        """
+        message = getattr(update, "effective_message", None)
+        if message is None or not message.text:
+            return MOVES
+        if not message.text.startswith("/"):
+            return INFO
+        command = message.text.split()[0][1:].split("@")[0].lower()
+        return self.command_lanes.get(command, INFO)
+
+    def process_update(self, update):
+        if not self.lanes_running or not hasattr(update, "effective_chat"):
+            # Errors and other non-updates are handled where they are.
+            super().process_update(update)
+            return
+        key = self.lane_key(update)
+        lane = self.lanes[self.classify(update)]
+        if not lane.put(key, (key, update)):
+            logging.debug("Shed an update for chat %s from the %s lane.",
+                          key, lane.name)
+
+    def lane_key(self, update):
+        """
+        Returns the key an update is queued and locked by: its game's (see
+        table_key). A DM from someone playing a game goes with that game,
+        as it may be a move in it.
+        """
+        chat = update.effective_chat
+        if chat is not None and chat.type == chat.PRIVATE:
+            index = self.bot_data.get("seats")
+            seat = index.get(chat.id) if index is not None else None
+            if seat is not None:
+                return seat.table
+        return table_key(update)
+
+    def handle(self, item):
+        """
+        Handles an update on a lane's worker, holding its chat's lock.
+        """
+        key, update = item
+        with self.locks[hash(key) % len(self.locks)]:
+            super().process_update(update)
+
+    def start(self, ready=None):
+        for lane in self.lanes:
+            lane.start(self.handle)
+        self.lanes_running = True
+        super().start(ready)
+
+    def stop(self):
+        super().stop()
+        self.lanes_running = False
+        for lane in self.lanes:
+            lane.stop()
@@ -0,0 +1,143 @@
+from cthulhu_lanes import *
+import cthulhu_fakeapi as fakeapi
+import cthulhu_game as cg
+import cthulhu_game_bot as bot_module
+import cthulhu_testing as testing
+import queue
+import random
+import threading
+import unittest
+from telegram.ext import TypeHandler
+import telegram
+
+
+class TestLaneDispatcher(unittest.TestCase):
+    """
+    Tests sorting updates into lanes and handling them there.
+    """
+
+    def setUp(self):
+        self.bot = testing.FakeBot()
+        self.dispatcher = LaneDispatcher(self.bot, queue.Queue(),
+                                         bot_module.command_lanes,
+                                         workers=(2, 1, 1),
+                                         maxsize=(10, 10, 2))
+
+    def update(self, *args):
+        return telegram.Update.de_json(testing.make_update(*args), self.bot)
+
+    def tearDown(self):
+        if self.dispatcher.lanes_running:
+            self.dispatcher.stop()
+
+    def test_classify(self):
+        """
+        Moves, setup and everything else go in their own lanes.
+        """
+        def lane(text):
+            return self.dispatcher.classify(
+                self.update(0, -1, 1, text))
+        self.assertEqual(lane("/claim 1 1 0"), MOVES)
+        self.assertEqual(lane("/inv@cthulhu_bot Bob"), MOVES)
+        self.assertEqual(lane("/newgame"), SETUP)
+        self.assertEqual(lane("/hibitch"), SETUP)
+        self.assertEqual(lane("/rules"), INFO)
+        self.assertEqual(lane("/display"), INFO)
+        self.assertEqual(lane("hello"), INFO)
+        self.assertEqual(self.dispatcher.classify(
+            bot_module.QueueCheck()), MOVES)
+
+    def test_lane_key(self):
+        """
+        Topics are keyed apart from their chat, and a player's DMs go with
+        their game.
+        """
+        self.assertEqual(self.dispatcher.lane_key(self.update(0, -1, 1, "/c")),
+                         -1)
+        topic = telegram.Update.de_json(testing.make_update(
+            0, -1, 1, "/c", thread_id=4), self.bot)
+        self.assertEqual(self.dispatcher.lane_key(topic), (-1, 4))
+        self.assertEqual(self.dispatcher.lane_key(self.update(0, 7, 7, "/c")),
+                         7)
+        seats = self.dispatcher.bot_data["seats"] = cg.SeatIndex()
+        game = cg.Game()
+        seats.bind(game, (-1, 4))
+        game.add_player(cg.Player(7))
+        self.assertEqual(self.dispatcher.lane_key(self.update(0, 7, 7, "/c")),
+                         (-1, 4))
+
+    def test_shed(self):
+        """
+        A full info lane sheds new updates; the moves lane doesn't.
+        """
+        self.dispatcher.lanes_running = True
+        for _ in range(5):
+            self.dispatcher.process_update(
+                self.update(0, -1, 1, "/rules"))
+        info = self.dispatcher.lanes[INFO]
+        self.assertEqual(info.queues[0].qsize(), 2)
+        self.assertEqual(info.dropped, 3)
+        for _ in range(5):
+            self.dispatcher.process_update(
+                self.update(0, -1, 1, "/claim 1 1 0"))
+        self.assertEqual(self.dispatcher.lanes[MOVES].dropped, 0)
+        self.dispatcher.lanes_running = False
+
+    def test_order(self):
+        """
+        A chat's updates in one lane are handled in the order they came,
+        and never at the same time as its updates in another lane.
+        """
+        seen = {}
+        busy = set()
+        overlaps = []
+        lock = threading.Lock()
+
+        def record(update, context):
+            chat_id = update.effective_chat.id
+            with lock:
+                if chat_id in busy:
+                    overlaps.append(chat_id)
+                busy.add(chat_id)
+            lane = self.dispatcher.classify(update)
+            seen.setdefault((chat_id, lane), []).append(update.update_id)
+            with lock:
+                busy.discard(chat_id)
+
+        self.dispatcher.add_handler(TypeHandler(telegram.Update, record))
+        self.dispatcher.lanes_running = True
+        for lane in self.dispatcher.lanes:
+            lane.start(self.dispatcher.handle)
+        for i in range(200):
+            text = random.choice(["/claim 1 1 0", "/join"])
+            self.dispatcher.process_update(
+                self.update(i, -1 - i % 4, 1, text))
+        self.dispatcher.lanes_running = False
+        for lane in self.dispatcher.lanes:
+            lane.stop()
+        self.assertEqual(overlaps, [])
+        for update_ids in seen.values():
+            self.assertEqual(update_ids, sorted(update_ids))
+        self.assertEqual(sum(lane.handled + lane.dropped
+                             for lane in self.dispatcher.lanes), 200)
+
+    def test_load_generator(self):
+        """
+        Games play to the end through a bot handling updates in lanes.
+        """
+        random.seed(4)
+        api = fakeapi.FakeBotAPI(seed=0).start()
+        updater = fakeapi.start_bot(api, lanes=True)
+        try:
+            generator = fakeapi.LoadGenerator(api, updater.dispatcher, 3)
+            generator.run(timeout=60)
+        finally:
+            updater.stop()
+            api.stop()
+        for chat_id in generator.chat_ids:
+            game = updater.dispatcher.chat_data[chat_id]["game"]
+            self.assertEqual(game.game_status, "Ended")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains a matchmaking queue for players without a chat to play
+in.
+
+Players DM the bot /queue, optionally with the number of players they'd
+like, and the Matchmaker groups them into games. Waiting players sit in one
+heap per preferred size, plus one for players happy with any size, ordered
+by when they joined the queue, so joining, leaving and taking the longest
+waiting player are all O(log n).
+
+A game forms as soon as enough players want its size, filling up with the
+longest waiting flexible players. Flexible players on their own form a full
+game straight away, or a smaller one once the longest waiting of them has
+been queued for `patience` seconds. A player who has waited `patience`
+seconds for their preferred size stops insisting on it and becomes
+flexible, keeping their place in line.
+"""
+import heapq
+import itertools
+import time
+
+import cthulhu_game as cg
+
+# The heap of players happy with any number of players.
+ANY = 0
+
+
+class QueueEntry:
+    """
+    A player waiting in the queue.
+
+    Attributes:
+      since - when the player joined the queue.
+      seq - breaks ties between players who joined at the same time.
+      user_id - the player's Telegram id.
+      size - the number of players they want, or ANY.
+      live - False once the player has left this heap.
+    """
+    __slots__ = ("since", "seq", "user_id", "size", "live")
+
+    def __init__(self, since, seq, user_id, size):
+        self.since = since
+        self.seq = seq
+        self.user_id = user_id
+        self.size = size
+        self.live = True
+
+    def __lt__(self, other):
+        return (self.since, self.seq) < (other.since, other.seq)
+
+
+class Matchmaker:
+    """
+    Groups queued players into games.
+
+    Players who leave, or who are moved to the flexible heap, are marked
+    dead where they are and skipped when they reach the top of a heap.
+
+    Attributes:
+      min_players, max_players - the sizes of game that can form, from
+        GameSettings.
+      patience - seconds before a preference is dropped, and before
+        flexible players settle for a smaller game.
+      heaps - maps a size, or ANY, to the heap of players waiting for it.
+      counts - maps a size, or ANY, to the number of live players in its
+        heap.
+      entries - maps a queued player's id to their entry.
+      by_age - every entry with a preferred size, oldest first, so that
+        preferences can be dropped in order.
+    """
+
+    def __init__(self, settings=None, patience=60, clock=time.monotonic):
+        settings = settings or cg.GameSettings()
+        self.min_players = settings.min_players
+        self.max_players = settings.max_players
+        self.patience = patience
+        self.clock = clock
+        sizes = [ANY] + list(range(self.min_players, self.max_players + 1))
+        self.heaps = {size: [] for size in sizes}
+        self.counts = {size: 0 for size in sizes}
+        self.entries = {}
+        self.by_age = []
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, user_id):
+        return user_id in self.entries
+
+    def join(self, user_id, size=None):
+        """
+        Queues a player.
+
+        Arguments:
+          user_id - the player's Telegram id.
+          size - Optional. The number of players they'd like to play with.
+
+        Raises:
+          GameError - if the player is already queued or the size can't be
+            played.
+        """
+        if user_id in self.entries:
+            raise cg.GameError("You're already in the queue.")
+        if size is None:
+            size = ANY
+        elif not self.min_players <= size <= self.max_players:
+            raise cg.GameError("Games need between {} and {} players.".format(
+                self.min_players, self.max_players))
+        self.push(QueueEntry(self.clock(), next(self.seq), user_id, size))
+
+    def push(self, entry):
+        self.entries[entry.user_id] = entry
+        heapq.heappush(self.heaps[entry.size], entry)
+        self.counts[entry.size] += 1
+        if entry.size != ANY:
+            heapq.heappush(self.by_age, entry)
+
+    def leave(self, user_id):
+        """
+        Takes a player out of the queue.
+
+        Raises:
+          GameError - if the player wasn't queued.
+        """
+        entry = self.entries.pop(user_id, None)
+        if entry is None:
+            raise cg.GameError("You aren't in the queue.")
+        entry.live = False
+        self.counts[entry.size] -= 1
+
+    def peek(self, size):
+        """
+        Returns the longest waiting live entry in a heap, or None.
+        """
+        heap = self.heaps[size]
+        while heap and not heap[0].live:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def take(self, size, n):
+        """
+        Takes the n longest waiting players from a heap.
+
+        Returns:
+          user_ids - their ids, longest waiting first.
+        """
+        heap = self.heaps[size]
+        user_ids = []
+        while len(user_ids) < n:
+            entry = heapq.heappop(heap)
+            if entry.live:
+                entry.live = False
+                del self.entries[entry.user_id]
+                user_ids.append(entry.user_id)
+        self.counts[size] -= n
+        return user_ids
+
+    def relax(self, now):
+        """
+        Makes players who have waited `patience` seconds flexible.
+        """
+        while self.by_age:
+            entry = self.by_age[0]
+            if entry.live and now - entry.since < self.patience:
+                break
+            heapq.heappop(self.by_age)
+            if entry.live:
+                entry.live = False
+                self.counts[entry.size] -= 1
+                self.push(QueueEntry(entry.since, entry.seq, entry.user_id,
+                                     ANY))
+
+    def match(self):
+        """
+        Forms one game if the queue allows, preferring bigger games.
+
+        Returns:
+          user_ids - the players in the game, longest waiting first, or None
+            if no game can form yet.
+        """
+        now = self.clock()
+        self.relax(now)
+        flexible = self.counts[ANY]
+        for size in range(self.max_players, self.min_players - 1, -1):
+            wanting = self.counts[size]
+            if wanting and wanting + flexible >= size:
+                user_ids = self.take(size, min(wanting, size))
+                return user_ids + self.take(ANY, size - len(user_ids))
+        if flexible >= self.max_players:
+            return self.take(ANY, self.max_players)
+        oldest = self.peek(ANY)
+        if (flexible >= self.min_players and
+                now - oldest.since >= self.patience):
+            return self.take(ANY, flexible)
+        return None
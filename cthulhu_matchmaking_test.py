@@ -0,0 +1,77 @@
+from cthulhu_matchmaking import *
+import cthulhu_game as cg
+import unittest
+
+
+class TestMatchmaker(unittest.TestCase):
+    """
+    Tests forming games from the matchmaking queue.
+    """
+
+    def setUp(self):
+        self.now = 0
+        self.matchmaker = Matchmaker(patience=60, clock=lambda: self.now)
+
+    def join(self, user_ids, size=None):
+        for user_id in user_ids:
+            self.now += 1
+            self.matchmaker.join(user_id, size)
+
+    def test_preferred_size(self):
+        """
+        Players wanting a size are matched as soon as there are enough of
+        them, topped up with the longest waiting flexible players.
+        """
+        self.join([1, 2, 3, 4], size=5)
+        self.assertIsNone(self.matchmaker.match())
+        self.join([10, 11])
+        self.assertEqual(self.matchmaker.match(), [1, 2, 3, 4, 10])
+        self.assertIsNone(self.matchmaker.match())
+        self.assertEqual(list(self.matchmaker.entries), [11])
+
+    def test_flexible_players(self):
+        """
+        Flexible players form a full game at once, or a smaller one after
+        waiting.
+        """
+        self.join(range(1, 13))
+        self.assertEqual(self.matchmaker.match(), list(range(1, 11)))
+        self.assertIsNone(self.matchmaker.match())
+        self.join([13])
+        self.now = 61
+        self.assertIsNone(self.matchmaker.match())
+        self.now = 71
+        self.assertEqual(self.matchmaker.match(), [11, 12, 13])
+        self.assertEqual(len(self.matchmaker), 0)
+
+    def test_preferences_relax(self):
+        """
+        A player who has waited too long for their size keeps their place
+        among the flexible players.
+        """
+        self.join([1], size=10)
+        self.join([2, 3])
+        self.now = 60
+        self.assertIsNone(self.matchmaker.match())
+        self.now = 61
+        self.assertEqual(self.matchmaker.match(), [1, 2, 3])
+
+    def test_join_and_leave(self):
+        """
+        Players can't queue twice or for impossible sizes, and leaving takes
+        them out of any game that forms later.
+        """
+        self.join([1, 2, 3], size=3)
+        self.assertRaises(cg.GameError, self.matchmaker.join, 1)
+        self.assertRaises(cg.GameError, self.matchmaker.join, 9, 2)
+        self.assertRaises(cg.GameError, self.matchmaker.join, 9, 11)
+        self.matchmaker.leave(2)
+        self.assertRaises(cg.GameError, self.matchmaker.leave, 2)
+        self.assertIsNone(self.matchmaker.match())
+        self.join([4], size=3)
+        self.assertEqual(self.matchmaker.match(), [1, 3, 4])
+        self.assertEqual(self.matchmaker.counts[3], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the outbox, which every message the bot sends goes
+through.
+
+Telegram allows a bot about 30 messages a second overall and about one a
+second per chat, and answers anything faster with 429 Too Many Requests and
+a retry_after. Sending straight from a handler loses the message when that
+happens. The Outbox queues messages per chat instead and sends them from a
+few background threads, spending tokens from a global and a per-chat
+TokenBucket (see cthulhu_ratelimit), so it stays just under the limits.
+
+A chat has at most one message in flight, so its messages arrive in the
+order they were queued. A 429 puts the message back at the front of its
+chat's queue and holds the chat for retry_after seconds; other chats carry
+on. Other errors, such as a user who has blocked the bot, drop the message
+with a warning, as there's no point retrying them.
+"""
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from telegram.error import NetworkError
+from telegram.error import RetryAfter
+from telegram.error import TelegramError
+from telegram.error import TimedOut
+
+from cthulhu_ratelimit import TokenBucket
+
+
+class Outbox:
+    """
+    Sends queued messages as fast as Telegram's limits allow.
+
+    Attributes:
+      bot - the bot to send with.
+      rate, burst - the global budget, in messages a second.
+      chat_rate, chat_burst - each chat's budget.
+      queues - maps a chat's id to its queued (method, kwargs, on_done),
+        oldest first.
+      ready - a heap of (when, seq, chat_id) for chats with messages queued
+        and none in flight, by when they may next send.
+      held - maps a chat's id to when its last 429 lets it send again.
+      sent - the number of messages sent.
+      retried - the number of 429s, each followed by a retry.
+      failed - the number of messages dropped after other errors.
+    """
+    # Forget the budgets of idle chats every this many calls.
+    PRUNE_EVERY = 10000
+
+    def __init__(self, bot, rate=30, burst=30, chat_rate=1, chat_burst=3,
+                 workers=4, retries=3, clock=time.monotonic):
+        """
+        Arguments:
+          bot - the bot to send with.
+          rate, burst - the global budget, in messages a second.
+          chat_rate, chat_burst - each chat's budget.
+          workers - the number of threads sending at once. With API latency
+            L seconds, reaching `rate` needs about rate * L of them.
+          retries - how many times to resend after a network error.
+        """
+        self.bot = bot
+        self.rate = rate
+        self.burst = burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.clock = clock
+        self.budget = TokenBucket(burst, clock())
+        self.budgets = {}
+        self.queues = {}
+        self.ready = []
+        self.held = {}
+        self.seq = itertools.count()
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self.run, daemon=True,
+                                         name="outbox-{}".format(i))
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def send(self, chat_id, text, **kwargs):
+        """
+        Queues a message. Takes the arguments of bot.send_message.
+        """
+        self.call("send_message", chat_id, text=text, **kwargs)
+
+    def call(self, method, chat_id, on_done=None, **kwargs):
+        """
+        Queues a call to any of the bot's methods that sends to a chat.
+
+        Arguments:
+          on_done - Optional. Called from a sending thread as
+            on_done(chat_id, delivered) once the message has been sent or
+            dropped.
+        """
+        with self.condition:
+            queue = self.queues.get(chat_id)
+            if queue is None:
+                queue = self.queues[chat_id] = collections.deque()
+                self.schedule(chat_id, self.clock())
+            queue.append((method, kwargs, on_done))
+
+    def schedule(self, chat_id, now):
+        """
+        Puts a chat with queued messages on the ready heap. Call with the
+        condition held.
+        """
+        budget = self.budgets.get(chat_id)
+        when = now if budget is None else budget.ready_at(
+            self.chat_rate, self.chat_burst, now)
+        when = max(when, self.held.get(chat_id, 0))
+        heapq.heappush(self.ready, (when, next(self.seq), chat_id))
+        self.condition.notify()
+
+    def next_message(self):
+        """
+        Waits for a chat that may send and a global token, and takes the
+        chat's oldest message.
+
+        Returns:
+          (chat_id, method, kwargs, on_done), or None once stopped.
+        """
+        with self.condition:
+            while True:
+                if self.stopped:
+                    return None
+                if not self.ready:
+                    self.condition.wait()
+                    continue
+                now = self.clock()
+                when = max(self.ready[0][0],
+                           self.budget.ready_at(self.rate, self.burst, now))
+                if when > now:
+                    self.condition.wait(when - now)
+                    continue
+                _, _, chat_id = heapq.heappop(self.ready)
+                self.budget.take(self.rate, self.burst, now)
+                budget = self.budgets.get(chat_id)
+                if budget is None:
+                    budget = self.budgets[chat_id] = TokenBucket(
+                        self.chat_burst, now)
+                budget.take(self.chat_rate, self.chat_burst, now)
+                self.held.pop(chat_id, None)
+                self.in_flight += 1
+                return (chat_id,) + self.queues[chat_id].popleft()
+
+    def run(self):
+        """
+        Sends messages until the outbox is stopped.
+        """
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            chat_id, method, kwargs, on_done = message
+            hold, delivered = self.deliver(chat_id, method, kwargs)
+            if hold is None and on_done is not None:
+                on_done(chat_id, delivered)
+            with self.condition:
+                self.in_flight -= 1
+                now = self.clock()
+                if hold is not None:
+                    # Back to the front, so the chat's order is kept.
+                    self.queues[chat_id].appendleft(message[1:])
+                    self.held[chat_id] = now + hold
+                if self.queues[chat_id]:
+                    self.schedule(chat_id, now)
+                else:
+                    del self.queues[chat_id]
+                self.calls += 1
+                if self.calls % self.PRUNE_EVERY == 0:
+                    self.prune(now)
+                self.condition.notify_all()
+
+    def deliver(self, chat_id, method, kwargs):
+        """
+        Makes one call, retrying network errors.
+
+        Returns:
+          (hold, delivered) - seconds to hold the chat for before retrying,
+            or None if the message is done with, and whether it was sent.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                getattr(self.bot, method)(chat_id=chat_id, **kwargs)
+                with self.condition:
+                    self.sent += 1
+                return None, True
+            except RetryAfter as err:
+                with self.condition:
+                    self.retried += 1
+                return err.retry_after, False
+            except (TimedOut, NetworkError) as err:
+                if attempt == self.retries:
+                    error = err
+            except TelegramError as err:
+                error = err
+                break
+        with self.condition:
+            self.failed += 1
+        logging.warning("Dropped a message to %s: %s", chat_id, error)
+        return None, False
+
+    def prune(self, now):
+        """
+        Forgets the budgets of chats with nothing queued that have had time
+        to refill. Call with the condition held.
+        """
+        full = [chat_id for chat_id, budget in self.budgets.items()
+                if chat_id not in self.queues and
+                budget.tokens + (now - budget.last) * self.chat_rate >=
+                self.chat_burst]
+        for chat_id in full:
+            del self.budgets[chat_id]
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued message has been sent or dropped.
+
+        Returns:
+          done - False if the timeout ran out first.
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not self.queues and not self.in_flight, timeout)
+
+    def stop(self):
+        """
+        Stops the sending threads, dropping anything still queued.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
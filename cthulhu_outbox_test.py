@@ -0,0 +1,109 @@
+from cthulhu_outbox import *
+import cthulhu_fakeapi as fakeapi
+import cthulhu_testing as testing
+import telegram
+import time
+import unittest
+
+
+class BlockedBot(testing.FakeBot):
+    """
+    A FakeBot that some users have blocked.
+    """
+
+    def __init__(self, blocked):
+        super().__init__()
+        self.blocked = blocked
+
+    def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.blocked:
+            raise telegram.error.Unauthorized("Forbidden: bot was blocked")
+        return super().send_message(chat_id, text, **kwargs)
+
+
+class TestOutbox(unittest.TestCase):
+    """
+    Tests the outbox against the fake Bot API and FakeBot.
+    """
+
+    def test_retry_after(self):
+        """
+        Messages refused with 429 are retried after retry_after, and every
+        chat's messages arrive once each, in order.
+        """
+        api = fakeapi.FakeBotAPI(flood_rate=0.3, retry_after=0.05,
+                                 seed=0).start()
+        bot = telegram.Bot(api.token, base_url=api.base_url)
+        outbox = Outbox(bot, rate=1000, burst=1000, chat_rate=1000,
+                        chat_burst=1000)
+        try:
+            for i in range(30):
+                for chat_id in range(1, 6):
+                    outbox.send(chat_id, "{}".format(i))
+            self.assertTrue(outbox.flush(timeout=30))
+        finally:
+            outbox.stop()
+            api.stop()
+        for chat_id in range(1, 6):
+            self.assertEqual([text for _, c, text in api.sent if c == chat_id],
+                             [str(i) for i in range(30)])
+        self.assertGreater(api.floods, 0)
+        self.assertEqual(outbox.retried, api.floods)
+        self.assertEqual(outbox.sent, 150)
+        self.assertEqual(outbox.failed, 0)
+
+    def test_budgets(self):
+        """
+        A chat is held to its own rate, while other chats go ahead.
+        """
+        bot = testing.FakeBot()
+        outbox = Outbox(bot, chat_rate=20, chat_burst=1, workers=2)
+        start = time.monotonic()
+        try:
+            for i in range(10):
+                outbox.send(-1, str(i))
+            outbox.send(-2, "quick")
+            while bot.messages_for(-2) != ["quick"]:
+                time.sleep(0.01)
+            quick = time.monotonic() - start
+            self.assertTrue(outbox.flush(timeout=10))
+        finally:
+            outbox.stop()
+        self.assertLess(quick, 0.2)
+        self.assertGreaterEqual(time.monotonic() - start, 9 / 20)
+        self.assertEqual(bot.messages_for(-1), [str(i) for i in range(10)])
+
+    def test_dropped(self):
+        """
+        Messages to users who blocked the bot are dropped, not retried.
+        """
+        bot = BlockedBot({2})
+        outbox = Outbox(bot)
+        try:
+            outbox.send(1, "hand")
+            outbox.send(2, "hand")
+            self.assertTrue(outbox.flush(timeout=10))
+        finally:
+            outbox.stop()
+        self.assertEqual(bot.sent, [(1, "hand")])
+        self.assertEqual((outbox.sent, outbox.failed), (1, 1))
+
+    def test_bot(self):
+        """
+        The bot's replies go through the outbox when it has one.
+        """
+        dispatcher = testing.make_dispatcher()
+        outbox = Outbox(dispatcher.bot)
+        dispatcher.bot_data["outbox"] = outbox
+        try:
+            testing.process(dispatcher, testing.make_update(1, -1, 1,
+                                                            "/newgame"))
+            self.assertTrue(outbox.flush(timeout=10))
+        finally:
+            outbox.stop()
+        self.assertEqual(outbox.sent, len(dispatcher.bot.sent))
+        self.assertGreater(outbox.sent, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
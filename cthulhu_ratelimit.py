@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains token-bucket rate limits for users and chats.
+
+Every command costs a token from the sender's bucket and from the chat's
+bucket, and buckets refill at a steady rate up to a burst size. A command
+that finds either bucket empty is dropped before any game logic runs. Only
+the first drop of a flood gets a warning, so a flooding user costs the bot
+one message rather than one per command.
+"""
+import time
+
+
+class TokenBucket:
+    """
+    Allows `rate` events a second on average, and bursts of up to `burst`.
+
+    Attributes:
+      tokens - the events allowed right now.
+      last - when tokens was last brought up to date.
+      warned - whether the current flood has been warned about.
+    """
+    __slots__ = ("tokens", "last", "warned")
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.last = now
+        self.warned = False
+
+    def take(self, rate, burst, now):
+        """
+        Refills the bucket for the time passed and takes a token if there is
+        one. Returns whether there was.
+
+        A flood is over once the bucket has refilled completely, not as soon
+        as a token trickles back, so a steady flood is only warned once.
+        """
+        self.tokens = min(burst, self.tokens + (now - self.last) * rate)
+        self.last = now
+        if self.tokens >= burst:
+            self.warned = False
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def ready_at(self, rate, burst, now):
+        """
+        Returns when the bucket will next have a token, which may be now.
+        """
+        tokens = min(burst, self.tokens + (now - self.last) * rate)
+        if tokens >= 1:
+            return now
+        return now + (1 - tokens) / rate
+
+
+class RateLimiter:
+    """
+    Token buckets for every user and every chat.
+
+    Attributes:
+      user_rate, user_burst - how fast one user may send commands.
+      chat_rate, chat_burst - how fast one chat may send commands.
+      users - maps a user's id to their bucket.
+      chats - maps a chat's id to its bucket.
+      dropped - the number of commands dropped.
+    """
+    # Drop buckets that have refilled every this many checks, since a full
+    # bucket is the same as a new one.
+    PRUNE_EVERY = 10000
+
+    def __init__(self, user_rate=1, user_burst=5, chat_rate=5, chat_burst=20,
+                 clock=time.monotonic):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.clock = clock
+        self.users = {}
+        self.chats = {}
+        self.dropped = 0
+        self.checks = 0
+
+    def check(self, chat_id, user_id):
+        """
+        Takes a token for a command from the user's and the chat's buckets.
+
+        Returns:
+          (allowed, warning) - whether to handle the command, and what to
+            warn about if it's the first command dropped in a flood:
+            "user", "chat" or None.
+        """
+        now = self.clock()
+        self.checks += 1
+        if self.checks % self.PRUNE_EVERY == 0:
+            self.prune(now)
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = TokenBucket(self.user_burst, now)
+        if not user.take(self.user_rate, self.user_burst, now):
+            return self.drop(user, "user")
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = TokenBucket(self.chat_burst, now)
+        if not chat.take(self.chat_rate, self.chat_burst, now):
+            # The user's token is spent anyway; a flood is a flood.
+            return self.drop(chat, "chat")
+        return True, None
+
+    def drop(self, bucket, kind):
+        self.dropped += 1
+        if bucket.warned:
+            return False, None
+        bucket.warned = True
+        return False, kind
+
+    def prune(self, now):
+        """
+        Forgets buckets that have had time to refill completely.
+        """
+        for buckets, rate, burst in ((self.users, self.user_rate,
+                                      self.user_burst),
+                                     (self.chats, self.chat_rate,
+                                      self.chat_burst)):
+            full = [key for key, bucket in buckets.items()
+                    if bucket.tokens + (now - bucket.last) * rate >= burst]
+            for key in full:
+                del buckets[key]
@@ -0,0 +1,67 @@
+from cthulhu_ratelimit import *
+import unittest
+
+
+class TestRateLimiter(unittest.TestCase):
+    """
+    Tests the per-user and per-chat token buckets.
+    """
+
+    def setUp(self):
+        self.now = 0
+        self.limiter = RateLimiter(user_rate=1, user_burst=3, chat_rate=2,
+                                   chat_burst=5, clock=lambda: self.now)
+
+    def test_user_burst_and_refill(self):
+        """
+        A user gets a burst, one warning per flood, and tokens back over
+        time.
+        """
+        for _ in range(3):
+            self.assertEqual(self.limiter.check(-1, 1), (True, None))
+        self.assertEqual(self.limiter.check(-1, 1), (False, "user"))
+        self.assertEqual(self.limiter.check(-1, 1), (False, None))
+        self.assertEqual(self.limiter.check(-1, 1), (False, None))
+        self.assertEqual(self.limiter.dropped, 3)
+        self.now += 1
+        self.assertEqual(self.limiter.check(-1, 1), (True, None))
+        self.assertEqual(self.limiter.check(-1, 1), (False, None))
+        self.now += 3
+        for _ in range(3):
+            self.assertEqual(self.limiter.check(-1, 1), (True, None))
+        self.assertEqual(self.limiter.check(-1, 1), (False, "user"))
+
+    def test_chat_limit(self):
+        """
+        Many users in one chat share the chat's bucket, and other chats are
+        unaffected.
+        """
+        for user_id in range(1, 6):
+            self.assertEqual(self.limiter.check(-1, user_id), (True, None))
+        self.assertEqual(self.limiter.check(-1, 6), (False, "chat"))
+        self.assertEqual(self.limiter.check(-1, 7), (False, None))
+        self.assertEqual(self.limiter.check(-2, 8), (True, None))
+        self.now += 0.5
+        self.assertEqual(self.limiter.check(-1, 9), (True, None))
+
+    def test_prune(self):
+        """
+        Buckets that have refilled are forgotten.
+        """
+        self.limiter.check(-1, 1)
+        self.limiter.check(-2, 2)
+        self.now += 1
+        for _ in range(3):
+            self.limiter.check(-2, 2)
+        self.now += 1
+        self.limiter.prune(self.now)
+        self.assertEqual(list(self.limiter.users), [2])
+        self.assertEqual(list(self.limiter.chats), [-2])
+        self.now += 10
+        self.limiter.prune(self.now)
+        self.assertEqual(self.limiter.users, {})
+        self.assertEqual(self.limiter.chats, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+This module records the bot's incoming traffic and replays it offline.
+
+Synthetic load doesn't look like real chats, which burst /display and spam
+synonyms like /nom and /dog. UpdateRecorder is an opt-in dispatcher handler
+that writes every incoming message to a gzipped log, one JSON list per
+line: [milliseconds since the last update, chat, user, text].
+
+The log is anonymized as it's written:
+  - Chat and user ids are replaced by small numbers in order of appearance.
+    Private chats keep their user's number.
+  - First names become "P<number>".
+  - Command arguments are kept only when they are seats, claims, expansion
+    names or players' names, and names are swapped for the pseudonym.
+
+replay() feeds a log into the real handlers with a FakeBot, either at the
+recorded pace (sped up if wanted) or as fast as possible. It reports
+handler latency and how many API calls the bot made, so two versions of the
+bot can be compared on the same traffic:
+    python cthulhu_replay.py ignore/updates.log.gz 10
+"""
+import gzip
+import json
+import random
+import re
+import sys
+import threading
+import time
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import cthulhu_testing as testing
+
+# Arguments that say nothing about who sent them.
+SAFE_ARGUMENT = re.compile(
+    r"^(#?\d+|c|cthulhu|rock|necronomicon|power|objects)$", re.IGNORECASE)
+
+# Commands whose arguments are free text.
+FREE_TEXT_COMMANDS = ("/feedback",)
+
+
+class UpdateRecorder:
+    """
+    Writes anonymized incoming messages to a gzipped log.
+
+    Attributes:
+      path - the log file.
+      chats - maps real chat ids to pseudonymous ones.
+      users - maps real user ids to pseudonymous ones.
+      names - maps case-folded first names to pseudonyms.
+      recorded - the number of updates written.
+    """
+    # The handler group the recorder runs in, ahead of the bot's handlers.
+    GROUP = -1
+
+    def __init__(self, path, clock=time.monotonic):
+        self.path = path
+        self.file = gzip.open(path, "at", encoding="utf-8")
+        self.clock = clock
+        self.last = None
+        self.chats = {}
+        self.users = {}
+        self.names = {}
+        self.recorded = 0
+        self.lock = threading.Lock()
+
+    def attach(self, dispatcher):
+        """
+        Starts recording a dispatcher's updates.
+        """
+        dispatcher.add_handler(TypeHandler(Update, self.record),
+                               group=self.GROUP)
+
+    def pseudonym(self, user):
+        """
+        Returns a user's pseudonymous id, noting their first name.
+        """
+        if user.id not in self.users:
+            self.users[user.id] = len(self.users) + 1
+        user_id = self.users[user.id]
+        if user.first_name:
+            self.names[user.first_name.casefold()] = "P{}".format(user_id)
+        return user_id
+
+    def anonymize_text(self, text):
+        """
+        Keeps a command and its harmless arguments, dropping the rest.
+        """
+        if not text.startswith("/"):
+            return "."
+        command, *args = text.split()
+        command = command.split("@")[0]
+        if command in FREE_TEXT_COMMANDS:
+            return command
+        kept = [command]
+        for arg in args:
+            if SAFE_ARGUMENT.match(arg):
+                kept.append(arg)
+            else:
+                kept.append(self.names.get(arg.casefold(), "x"))
+        return " ".join(kept)
+
+    def record(self, update, context):
+        """
+        Writes one update to the log. Used as a TypeHandler callback.
+        """
+        message = update.effective_message
+        if message is None or update.effective_user is None:
+            return
+        with self.lock:
+            now = self.clock()
+            delay = 0 if self.last is None else now - self.last
+            self.last = now
+            user_id = self.pseudonym(update.effective_user)
+            chat = update.effective_chat
+            if chat.id > 0:
+                chat_id = self.users.get(chat.id, user_id)
+            else:
+                if chat.id not in self.chats:
+                    self.chats[chat.id] = -(len(self.chats) + 1)
+                chat_id = self.chats[chat.id]
+            text = self.anonymize_text(message.text or "")
+            self.file.write(json.dumps([round(delay * 1000), chat_id,
+                                        user_id, text],
+                                       separators=(",", ":")) + "\n")
+            self.recorded += 1
+            if self.recorded % 100 == 0:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_log(path):
+    """
+    Yields (delay in seconds, chat_id, user_id, text) from a log.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            delay, chat_id, user_id, text = json.loads(line)
+            yield delay / 1000, chat_id, user_id, text
+
+
+class ReplayResult:
+    """
+    What happened when a log was replayed.
+
+    Attributes:
+      latencies - seconds each update spent in the handlers, sorted.
+      api_calls - the number of messages the bot sent.
+      elapsed - seconds the replay took.
+      lag - the most seconds an update was handled behind schedule.
+    """
+
+    def __init__(self, latencies, api_calls, elapsed, lag):
+        self.latencies = sorted(latencies)
+        self.api_calls = api_calls
+        self.elapsed = elapsed
+        self.lag = lag
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0
+        return self.latencies[min(len(self.latencies) - 1,
+                                  len(self.latencies) * p // 100)]
+
+    def summary(self):
+        """
+        Returns the results as a dict, ready to print or diff.
+        """
+        return {
+            "updates": len(self.latencies),
+            "api_calls": self.api_calls,
+            "elapsed_s": round(self.elapsed, 3),
+            "max_lag_ms": round(self.lag * 1000, 1),
+            "p50_ms": round(self.percentile(50) * 1000, 3),
+            "p99_ms": round(self.percentile(99) * 1000, 3),
+        }
+
+
+def replay(path, speed=0, seed=0, dispatcher=None):
+    """
+    Feeds a log into the bot's handlers.
+
+    Arguments:
+      path - the log to replay.
+      speed - how many times faster than recorded to go, or 0 to go as fast
+        as possible.
+      seed - seeds the random module, so games deal the same way each time.
+      dispatcher - Optional. The dispatcher to feed. Defaults to a new one
+        with a FakeBot.
+
+    Returns:
+      result - a ReplayResult.
+    """
+    random.seed(seed)
+    dispatcher = dispatcher or testing.make_dispatcher()
+    latencies = []
+    lag = 0
+    start = time.perf_counter()
+    due = start
+    for update_id, (delay, chat_id, user_id, text) in enumerate(
+            read_log(path), 1):
+        if speed:
+            due += delay / speed
+            now = time.perf_counter()
+            if now < due:
+                time.sleep(due - now)
+            else:
+                lag = max(lag, now - due)
+        data = testing.make_update(update_id, chat_id, user_id, text)
+        handled = time.perf_counter()
+        testing.process(dispatcher, data)
+        latencies.append(time.perf_counter() - handled)
+    elapsed = time.perf_counter() - start
+    feed = dispatcher.bot_data.get("spectator_feed")
+    if feed is not None:
+        feed.flush()
+        feed.stop()
+    return ReplayResult(latencies, len(dispatcher.bot.sent), elapsed, lag)
+
+
+def main():
+    """
+    Replays the log named on the command line, at the speed given (or as
+    fast as possible), and prints the results.
+    """
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    print(json.dumps(replay(sys.argv[1], speed).summary(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+from cthulhu_replay import *
+import cthulhu_testing as testing
+import os
+import random
+import tempfile
+import unittest
+
+
+class TestRecordReplay(unittest.TestCase):
+    """
+    Tests recording traffic and replaying it.
+    """
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "updates.log.gz")
+        self.now = 0
+
+    def record_game(self, seed):
+        """
+        Plays a game in a real-looking chat with a recorder attached.
+
+        Returns:
+          dispatcher - the dispatcher the game was played on.
+        """
+        random.seed(seed)
+        dispatcher = testing.make_dispatcher()
+        recorder = UpdateRecorder(self.path, clock=lambda: self.now)
+        recorder.attach(dispatcher)
+        names = {101: "Alice", 202: "Bob", 303: "Carol"}
+        counter = iter(range(10 ** 6))
+
+        def send(chat_id, user_id, text):
+            self.now += 0.5
+            testing.process(dispatcher, testing.make_update(
+                next(counter), chat_id, user_id, text, names[user_id]))
+        send(-100777, 101, "/display")
+        send(-100777, 202, "/dog alice")
+        testing.play_game(send, lambda c: dispatcher.chat_data[c]["game"],
+                          -100777, list(names))
+        recorder.close()
+        return dispatcher
+
+    def test_anonymized(self):
+        """
+        The log holds no ids, names or free text.
+        """
+        self.record_game(seed=1)
+        records = list(read_log(self.path))
+        self.assertEqual(records[0], (0, -1, 1, "/display"))
+        self.assertEqual(records[1], (0.5, -1, 2, "/dog P1"))
+        self.assertEqual({r[1] for r in records}, {-1})
+        self.assertEqual({r[2] for r in records}, {1, 2, 3})
+        with gzip.open(self.path, "rt") as f:
+            log = f.read()
+        for secret in ["Alice", "Bob", "Carol", "100777", "101"]:
+            self.assertNotIn(secret, log)
+
+    def test_free_text_dropped(self):
+        """
+        Free text and unknown arguments are never written.
+        """
+        recorder = UpdateRecorder(self.path)
+        recorder.names["alice"] = "P1"
+        self.assertEqual(recorder.anonymize_text("/feedback Alice says hi"),
+                         "/feedback")
+        self.assertEqual(recorder.anonymize_text("/claim 2 C"), "/claim 2 C")
+        self.assertEqual(recorder.anonymize_text("/inv@cthulhu_bot ALICE"),
+                         "/inv P1")
+        self.assertEqual(recorder.anonymize_text("/inv Mallory"), "/inv x")
+        self.assertEqual(recorder.anonymize_text("good game all"), ".")
+        recorder.close()
+
+    def test_replay_matches_recording(self):
+        """
+        Replaying a log makes the same API calls as the original traffic.
+        """
+        original = self.record_game(seed=2)
+        result = replay(self.path, seed=2)
+        self.assertEqual(result.api_calls, len(original.bot.sent))
+        self.assertEqual(len(result.latencies), len(list(read_log(self.path))))
+
+    def test_paced_replay(self):
+        """
+        Replays keep the recorded gaps, divided by the speed.
+        """
+        self.record_game(seed=3)
+        recorded = sum(r[0] for r in read_log(self.path))
+        result = replay(self.path, speed=recorded / 0.2, seed=3)
+        self.assertGreaterEqual(result.elapsed, 0.2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+"""
+This module runs the bot as several worker processes, sharded by chat.
+
+A supervisor fetches updates and routes each one to a worker by consistent
+hashing on the update's chat id. Every worker owns the chat_data (and so the
+Game) of the chats that hash to it, along with the Player objects seated in
+those games; in-game state never leaves the owning worker. Only a user's
+profile (nickname and win record) is kept in a store shared by all workers,
+since one user can play in chats owned by different workers. The store is
+read the first time a worker sees a user and written only when the profile
+changes, so it is off the path of ordinary moves.
+
+When a worker is added, only the chats that now hash to the new worker are
+handed over to it; everyone else stays where they are.
+
+Usage:
+    python cthulhu_shard.py [number of workers]
+"""
+import bisect
+import functools
+import hashlib
+import logging
+import multiprocessing
+import queue
+import sys
+import time
+
+import telegram
+from telegram.ext import Dispatcher
+
+import cthulhu_codec
+import cthulhu_game as cg
+import cthulhu_game_bot as bot_module
+
+
+class ShardError(Exception):
+    """
+    Raised when the supervisor loses track of its workers.
+    """
+    pass
+
+
+def update_chat_id(data):
+    """
+    Returns the chat id of an update's JSON without parsing it.
+    """
+    for key in ("message", "edited_message", "channel_post"):
+        if key in data:
+            return data[key]["chat"]["id"]
+    if "callback_query" in data and "message" in data["callback_query"]:
+        return data["callback_query"]["message"]["chat"]["id"]
+    return None
+
+
+def update_user_id(data):
+    """
+    Returns the sender's user id of an update's JSON without parsing it.
+    """
+    for key in ("message", "edited_message", "callback_query"):
+        if key in data and "from" in data[key]:
+            return data[key]["from"]["id"]
+    return None
+
+
+class HashRing:
+    """
+    A consistent hash ring mapping keys (chat ids) to nodes (workers).
+
+    Each node is placed on the ring several times so that keys spread evenly
+    and adding a node only moves about 1/n of the keys.
+
+    Attributes:
+      replicas - how many points each node gets on the ring.
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._points = []
+        self._owners = []
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def _hash(key):
+        """
+        Hashes a key to a point on the ring.
+        """
+        digest = hashlib.md5(str(key).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def add_node(self, node):
+        """
+        Places a node on the ring.
+        """
+        for i in range(self.replicas):
+            point = self._hash("{}#{}".format(node, i))
+            pos = bisect.bisect(self._points, point)
+            self._points.insert(pos, point)
+            self._owners.insert(pos, node)
+
+    def remove_node(self, node):
+        """
+        Takes a node off the ring.
+        """
+        kept = [(p, o) for p, o in zip(self._points, self._owners)
+                if o != node]
+        self._points = [p for p, o in kept]
+        self._owners = [o for p, o in kept]
+
+    def nodes(self):
+        """
+        Returns the nodes on the ring.
+        """
+        return sorted(set(self._owners))
+
+    def get_node(self, key):
+        """
+        Returns the node that owns a key.
+        """
+        if not self._points:
+            raise KeyError("The hash ring has no nodes.")
+        pos = bisect.bisect(self._points, self._hash(key))
+        if pos == len(self._points):
+            pos = 0
+        return self._owners[pos]
+
+
+class SharedUserStore:
+    """
+    User profiles that every worker can see.
+
+    A profile is (nickname, stats), where stats is the tuple
+    (ngcw, ngcl, ngiw, ngil) from PlayerStats. Stats are merged as deltas,
+    so two workers finishing games for the same user don't overwrite each
+    other's results.
+    """
+
+    def __init__(self, mapping, lock):
+        """
+        Arguments:
+          mapping - a dictionary shared between processes.
+          lock - a lock shared between processes, guarding merges.
+        """
+        self._data = mapping
+        self._lock = lock
+
+    def load(self, user_id):
+        """
+        Returns a user's profile, or None.
+        """
+        return self._data.get(user_id)
+
+    def merge(self, user_id, nickname, stats_delta):
+        """
+        Stores a user's nickname and adds to their stats.
+
+        Returns:
+          profile - the stored profile after merging.
+        """
+        with self._lock:
+            old = self._data.get(user_id)
+            stats = old[1] if old else (0, 0, 0, 0)
+            stats = tuple(a + b for a, b in zip(stats, stats_delta))
+            self._data[user_id] = (nickname, stats)
+        return (nickname, stats)
+
+    def __len__(self):
+        return len(self._data)
+
+
+def player_stats(player):
+    """
+    Returns a player's stats as a tuple.
+    """
+    s = player.stats
+    return (s.ngcw, s.ngcl, s.ngiw, s.ngil)
+
+
+def player_profile(player):
+    """
+    Returns the part of a Player that is shared between workers.
+    """
+    return (getattr(player, "nickname", None), player_stats(player))
+
+
+class ShardWorker:
+    """
+    Processes the updates of the chats that hash to it.
+
+    Attributes:
+      name - the worker's name on the hash ring.
+      dispatcher - a dispatcher with the bot's handlers, holding chat_data.
+      players - the Player objects of users this worker has seen. These are
+        authoritative for in-game state, and are the same objects the
+        worker's games hold.
+      synced - the profile last read from or written to the store, per user.
+      handled - the number of updates processed.
+      errors - the number of updates whose handler raised unexpectedly.
+    """
+
+    def __init__(self, name, inbox, outbox, store, bot):
+        self.name = name
+        self.inbox = inbox
+        self.outbox = outbox
+        self.store = store
+        self.dispatcher = Dispatcher(bot, queue.Queue(), workers=1,
+                                     use_context=True,
+                                     context_types=bot_module.CONTEXT_TYPES)
+        bot_module.add_handlers(self.dispatcher)
+        self.dispatcher.add_error_handler(self.count_error)
+        self.players = {}
+        self.synced = {}
+        self.handled = 0
+        self.errors = 0
+
+    def run(self):
+        """
+        Processes messages from the supervisor until told to stop.
+        """
+        while True:
+            message = self.inbox.get()
+            kind = message[0]
+            if kind == "update":
+                self.handle(message[1])
+            elif kind == "handoff":
+                self.hand_off(message[1])
+            elif kind == "adopt":
+                self.adopt(message[1], message[2])
+            elif kind == "flush":
+                self.outbox.put(("flushed", self.name, self.handled,
+                                 self.errors,
+                                 sorted(self.dispatcher.chat_data)))
+            elif kind == "stop":
+                break
+
+    def count_error(self, update, context):
+        """
+        Error handler counting (and logging) handlers that crashed.
+        """
+        self.errors += 1
+        logging.getLogger(__name__).error("Update failed on %s", self.name,
+                                          exc_info=context.error)
+
+    def handle(self, data):
+        """
+        Runs one update through the handlers.
+        """
+        user_id = update_user_id(data)
+        if user_id is not None:
+            self.check_out(user_id)
+        update = telegram.Update.de_json(data, self.dispatcher.bot)
+        self.dispatcher.process_update(update)
+        if user_id is not None:
+            self.check_in(user_id)
+        self.handled += 1
+
+    def check_out(self, user_id):
+        """
+        Puts a user's Player into user_data, loading their profile from the
+        shared store the first time this worker sees them.
+        """
+        player = self.players.get(user_id)
+        if player is None:
+            profile = self.store.load(user_id)
+            if profile is None:
+                return
+            nickname, stats = profile
+            player = cg.Player(user_id, nickname=nickname)
+            (player.stats.ngcw, player.stats.ngcl,
+             player.stats.ngiw, player.stats.ngil) = stats
+            self.players[user_id] = player
+            self.synced[user_id] = profile
+        self.dispatcher.user_data[user_id]["player"] = player
+
+    def check_in(self, user_id):
+        """
+        Writes a user's profile back to the shared store if it changed.
+        """
+        player = self.dispatcher.user_data[user_id].get("player")
+        if player is None:
+            return
+        self.players[user_id] = player
+        profile = player_profile(player)
+        synced = self.synced.get(user_id)
+        if profile == synced:
+            return
+        old_stats = synced[1] if synced else (0, 0, 0, 0)
+        delta = tuple(a - b for a, b in zip(profile[1], old_stats))
+        merged = self.store.merge(user_id, profile[0], delta)
+        (player.stats.ngcw, player.stats.ngcl,
+         player.stats.ngiw, player.stats.ngil) = merged[1]
+        self.synced[user_id] = merged
+
+    def hand_off(self, nodes):
+        """
+        Sends away the chats that no longer hash to this worker.
+
+        Arguments:
+          nodes - the workers on the new ring.
+        """
+        ring = HashRing(nodes)
+        for chat_id in list(self.dispatcher.chat_data):
+            owner = ring.get_node(chat_id)
+            if owner != self.name:
+                chat_data = self.dispatcher.chat_data.pop(chat_id)
+                seats = self.dispatcher.bot_data.get("seats")
+                if seats is not None:
+                    for game in cthulhu_codec.chat_games(chat_data):
+                        seats.release(game)
+                blob = cthulhu_codec.dumps(chat_data)
+                self.outbox.put(("moved", chat_id, owner, blob))
+        self.outbox.put(("handed_off", self.name))
+
+    def adopt(self, chat_id, blob):
+        """
+        Takes ownership of a chat handed over by another worker.
+
+        The decoded game brings its own copies of its players. Where this
+        worker already has a Player for a user, that object takes over the
+        game's state and every reference to the copy is rebound to it.
+        """
+        chat_data = cthulhu_codec.loads(blob)
+        for game in cthulhu_codec.chat_games(chat_data):
+            for p in list(game.players):
+                local = self.players.get(p.p_id)
+                if local is None:
+                    self.players[p.p_id] = p
+                elif local is not p:
+                    local.status = p.status
+                    local.game_data = p.game_data
+                    game.replace_player(p, local)
+                self.synced.setdefault(p.p_id, player_profile(p))
+        self.dispatcher.chat_data[chat_id] = chat_data
+
+
+def run_worker(name, inbox, outbox, store, bot_factory):
+    """
+    The entry point of a worker process.
+    """
+    ShardWorker(name, inbox, outbox, store, bot_factory()).run()
+
+
+class ShardSupervisor:
+    """
+    Routes updates to worker processes by chat id.
+
+    Attributes:
+      ring - the hash ring of worker names.
+      workers - a dictionary from worker name to (process, inbox).
+      store - the profile store shared by all workers.
+      timeout - seconds to wait for workers to answer before giving up.
+    """
+
+    def __init__(self, n_workers, bot_factory, replicas=64, timeout=60):
+        """
+        Starts the workers.
+
+        Arguments:
+          n_workers - the number of worker processes to start with.
+          bot_factory - a picklable callable returning the bot to send with.
+          replicas - points per worker on the hash ring.
+          timeout - seconds to wait for workers to answer.
+        """
+        self.bot_factory = bot_factory
+        self.timeout = timeout
+        self.manager = multiprocessing.Manager()
+        self.store = SharedUserStore(self.manager.dict(),
+                                     self.manager.Lock())
+        self.outbox = multiprocessing.Queue()
+        self.ring = HashRing(replicas=replicas)
+        self.workers = {}
+        self._next_id = 0
+        for i in range(n_workers):
+            self.add_worker()
+
+    def _start_worker(self):
+        """
+        Starts a worker process and returns its name.
+        """
+        name = "worker-{}".format(self._next_id)
+        self._next_id += 1
+        inbox = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=run_worker, name=name, daemon=True,
+            args=(name, inbox, self.outbox, self.store, self.bot_factory))
+        process.start()
+        self.workers[name] = (process, inbox)
+        return name
+
+    def _receive(self):
+        """
+        Returns the next message from the workers.
+
+        Raises:
+          ShardError - if a worker died or nothing arrived in time.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                return self.outbox.get(timeout=1)
+            except queue.Empty:
+                dead = [name for name, (process, inbox)
+                        in self.workers.items() if not process.is_alive()]
+                if dead:
+                    raise ShardError("Worker(s) died: {}".format(
+                        ", ".join(dead)))
+                if time.monotonic() > deadline:
+                    raise ShardError("Timed out waiting for the workers.")
+
+    def add_worker(self):
+        """
+        Adds a worker and moves over the chats that now hash to it.
+
+        Routing is paused while chats move, and every update routed before
+        the handoff is processed by the old owner first, so no chat sees its
+        updates out of order.
+
+        Returns:
+          moved - the number of chats handed to the new worker.
+        """
+        old_names = self.ring.nodes()
+        name = self._start_worker()
+        self.ring.add_node(name)
+        if not old_names:
+            return 0
+        nodes = self.ring.nodes()
+        for old in old_names:
+            self.workers[old][1].put(("handoff", nodes))
+        moved = 0
+        pending = set(old_names)
+        while pending:
+            message = self._receive()
+            if message[0] == "moved":
+                chat_id, owner, blob = message[1:]
+                self.workers[owner][1].put(("adopt", chat_id, blob))
+                moved += 1
+            elif message[0] == "handed_off":
+                pending.discard(message[1])
+        return moved
+
+    def route(self, data):
+        """
+        Sends an update's JSON to the worker owning its chat.
+        """
+        key = update_chat_id(data)
+        if key is None:
+            key = update_user_id(data)
+        self.workers[self.ring.get_node(key)][1].put(("update", data))
+
+    def route_update(self, update):
+        """
+        Sends a telegram.Update to the worker owning its chat.
+        """
+        self.route(update.to_dict())
+
+    def flush(self):
+        """
+        Waits until every worker has processed everything routed to it.
+
+        Returns:
+          A dictionary from worker name to (updates handled, updates that
+          failed, chat ids owned).
+        """
+        for process, inbox in self.workers.values():
+            inbox.put(("flush",))
+        results = {}
+        while len(results) < len(self.workers):
+            message = self._receive()
+            if message[0] == "flushed":
+                results[message[1]] = tuple(message[2:])
+        return results
+
+    def poll(self, bot, timeout=10):
+        """
+        Fetches updates from Telegram forever, routing each one.
+
+        Network trouble is logged and retried, as the Updater would.
+        """
+        logger = logging.getLogger(__name__)
+        offset = None
+        while True:
+            try:
+                updates = bot.get_updates(offset=offset, timeout=timeout)
+            except telegram.error.RetryAfter as err:
+                time.sleep(err.retry_after)
+                continue
+            except telegram.error.NetworkError as err:
+                logger.warning("Error while getting updates: %s", err)
+                time.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                self.route_update(update)
+
+    def stop(self):
+        """
+        Stops every worker.
+        """
+        for process, inbox in self.workers.values():
+            inbox.put(("stop",))
+        for process, inbox in self.workers.values():
+            process.join(timeout=self.timeout)
+        self.manager.shutdown()
+
+
+def main():
+    """
+    Runs the bot with a number of worker processes.
+    """
+    n_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    token = open('ignore/token.txt', 'r').read().strip()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s -'
+                        '%(message)s', level=logging.INFO,
+                        filename='ignore/logging.txt', filemode='a')
+    supervisor = ShardSupervisor(n_workers,
+                                 functools.partial(telegram.Bot, token=token))
+    try:
+        supervisor.poll(telegram.Bot(token=token))
+    finally:
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+from cthulhu_shard import *
+import cthulhu_codec
+import cthulhu_testing as testing
+import pickle
+import queue
+import random
+import threading
+import unittest
+
+
+class TestHashRing(unittest.TestCase):
+    """
+    Tests the consistent hash ring.
+    """
+
+    def test_stable_owner(self):
+        """
+        The same key always maps to the same node.
+        """
+        ring = HashRing(["a", "b", "c"])
+        for chat_id in range(-500, 0):
+            self.assertEqual(ring.get_node(chat_id), ring.get_node(chat_id))
+            self.assertIn(ring.get_node(chat_id), ["a", "b", "c"])
+
+    def test_adding_node_moves_few_keys(self):
+        """
+        Adding a node only moves keys onto the new node.
+        """
+        ring = HashRing(["a", "b", "c"])
+        before = {k: ring.get_node(k) for k in range(-2000, 0)}
+        ring.add_node("d")
+        moved = 0
+        for k, node in before.items():
+            if ring.get_node(k) != node:
+                self.assertEqual(ring.get_node(k), "d")
+                moved += 1
+        # Roughly a quarter of the keys should move.
+        self.assertGreater(moved, 200)
+        self.assertLess(moved, 900)
+
+    def test_remove_node(self):
+        """
+        Removing a node hands its keys to the others.
+        """
+        ring = HashRing(["a", "b"])
+        ring.remove_node("a")
+        self.assertEqual(ring.nodes(), ["b"])
+        self.assertEqual(ring.get_node(12), "b")
+
+
+class TestShardSupervisor(unittest.TestCase):
+    """
+    Tests routing and rebalancing across worker processes.
+    """
+
+    def test_rebalance(self):
+        """
+        Every chat ends up on exactly the worker the ring says owns it.
+        """
+        supervisor = ShardSupervisor(2, testing.FakeBot)
+        try:
+            for i, move in enumerate(testing.game_script(-1, [1, 2, 3])):
+                supervisor.route(testing.make_update(i, *move))
+            for c in range(2, 30):
+                supervisor.route(testing.make_update(100 + c, -c, c, "/join"))
+            supervisor.add_worker()
+            results = supervisor.flush()
+            owned = []
+            for name, (handled, errors, chats) in results.items():
+                self.assertEqual(errors, 0)
+                for chat_id in chats:
+                    self.assertEqual(supervisor.ring.get_node(chat_id), name)
+                owned += chats
+            self.assertEqual(sorted(owned), list(range(-29, 0)))
+            self.assertEqual(len(supervisor.store), 29)
+        finally:
+            supervisor.stop()
+
+
+class TestShardWorker(unittest.TestCase):
+    """
+    Plays games through in-process workers and compares them with the plain
+    single-dispatcher bot.
+    """
+    USERS = [1, 2, 3, 4, 5]
+
+    def single_dispatcher_run(self, seed):
+        """
+        Plays a game on one dispatcher and returns what the bot sent.
+        """
+        random.seed(seed)
+        dispatcher = testing.make_dispatcher()
+        counter = iter(range(10 ** 6))
+
+        def send(chat_id, user_id, text):
+            testing.process(dispatcher, testing.make_update(
+                next(counter), chat_id, user_id, text))
+        testing.play_game(send, lambda c: dispatcher.chat_data[c]["game"],
+                          -1, self.USERS)
+        return dispatcher.bot.sent, dispatcher.chat_data[-1]["game"]
+
+    @staticmethod
+    def make_worker(name, store):
+        return ShardWorker(name, queue.Queue(), queue.Queue(), store,
+                           testing.FakeBot())
+
+    def test_game_matches_single_dispatcher(self):
+        """
+        A sharded game plays to the same winner with the same messages.
+        """
+        expected, expected_game = self.single_dispatcher_run(seed=3)
+        random.seed(3)
+        store = SharedUserStore({}, threading.Lock())
+        worker = self.make_worker("a", store)
+        counter = iter(range(10 ** 6))
+
+        def send(chat_id, user_id, text):
+            worker.handle(testing.make_update(next(counter), chat_id,
+                                              user_id, text))
+        testing.play_game(send,
+                          lambda c: worker.dispatcher.chat_data[c]["game"],
+                          -1, self.USERS)
+        game = worker.dispatcher.chat_data[-1]["game"]
+        self.assertEqual(worker.errors, 0)
+        self.assertEqual(game.game_status, "Ended")
+        self.assertEqual(game.winner, expected_game.winner)
+        self.assertEqual(worker.dispatcher.bot.sent, expected)
+        for p in game.players:
+            self.assertIs(worker.players[p.p_id], p)
+            self.assertIsNotNone(p.game_data)
+        self.assertEqual(len(store), len(self.USERS))
+
+    def test_handoff_mid_game(self):
+        """
+        A game handed to another worker mid-round carries on unchanged.
+        """
+        expected, expected_game = self.single_dispatcher_run(seed=5)
+        random.seed(5)
+        store = SharedUserStore({}, threading.Lock())
+        workers = {"a": self.make_worker("a", store),
+                   "b": self.make_worker("b", store)}
+        owner = ["a"]
+        sent = []
+        counter = iter(range(10 ** 6))
+
+        def send(chat_id, user_id, text):
+            worker = workers[owner[0]]
+            worker.handle(testing.make_update(next(counter), chat_id,
+                                              user_id, text))
+            self.assertEqual(worker.errors, 0)
+
+        def get_game(chat_id):
+            return workers[owner[0]].dispatcher.chat_data[chat_id]["game"]
+        testing.play_game(send, get_game, -1, self.USERS, max_moves=8)
+        # Move the chat from a to b, the way hand_off and adopt do.
+        blob = cthulhu_codec.dumps(workers["a"].dispatcher.chat_data.pop(-1))
+        workers["b"].adopt(-1, blob)
+        owner[0] = "b"
+        while True:
+            move = testing.next_move(get_game(-1))
+            if move is None:
+                break
+            send(-1, *move)
+        game = get_game(-1)
+        self.assertEqual(game.winner, expected_game.winner)
+        self.assertEqual(workers["a"].dispatcher.bot.sent +
+                         workers["b"].dispatcher.bot.sent, expected)
+        for p in game.players:
+            self.assertIs(workers["b"].players[p.p_id], p)
+
+    def test_adopt_rebinds_references(self):
+        """
+        Adopting a game rebinds every Player reference to local objects.
+        """
+        store = SharedUserStore({}, threading.Lock())
+        worker = self.make_worker("a", store)
+        local = cg.Player(1, nickname="P1")
+        worker.players[1] = local
+        game = cg.Game()
+        for i in range(1, 4):
+            game.add_player(cg.Player(i, nickname="P{}".format(i)))
+        game.start_game()
+        game.flashlight_lock = game.players[0]
+        game.silenced = [game.players[0]]
+        worker.adopt(-1, pickle.dumps({"game": game}))
+        adopted = worker.dispatcher.chat_data[-1]["game"]
+        self.assertIs(adopted.players[0], local)
+        self.assertIs(adopted.flashlight_lock, local)
+        self.assertIs(adopted.silenced[0], local)
+        self.assertIsNotNone(local.game_data)
+
+
+if __name__ == "__main__":
+    unittest.main()
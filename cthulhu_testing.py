@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains helpers for driving the bot's handlers offline.
+
+Nothing here talks to Telegram: a FakeBot records what would have been sent,
+and make_update builds the same JSON Telegram would deliver for a command.
+"""
+import random
+import time
+from queue import Queue
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+import cthulhu_game as cg
+import cthulhu_game_bot as bot_module
+
+
+class FakeBot:
+    """
+    A stand-in for telegram.Bot that records outgoing messages.
+
+    Attributes:
+      username - the bot's username, checked by CommandHandler.
+      sent - a list of (chat_id, text) pairs, in the order they were sent.
+      threads - the forum topic each message in sent went to, or None.
+      keyboards - maps a chat's id to the buttons on its latest message.
+      answered - (callback query id, text) for every button press answered.
+      delay - seconds to sleep per call, to imitate network latency.
+    """
+
+    def __init__(self, username="cthulhu_test_bot", delay=0):
+        self.username = username
+        self.defaults = None
+        self.sent = []
+        self.threads = []
+        self.keyboards = {}
+        self.answered = []
+        self.delay = delay
+
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        """
+        Records a message instead of sending it.
+        """
+        if self.delay:
+            time.sleep(self.delay)
+        self.sent.append((chat_id, text))
+        self.threads.append(kwargs.get("message_thread_id"))
+        self.keyboards[chat_id] = reply_markup
+        return len(self.sent)
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        """
+        Records the answer to a button press.
+        """
+        self.answered.append((callback_query_id, text))
+        return True
+
+    def messages_for(self, chat_id, thread_id=None):
+        """
+        Returns the texts sent to a given chat, or only to one of its forum
+        topics.
+        """
+        return [text for (c_id, text), thread in zip(self.sent, self.threads)
+                if c_id == chat_id and thread_id in (None, thread)]
+
+
+def make_update(update_id, chat_id, user_id, text, first_name=None,
+                thread_id=None):
+    """
+    Builds the JSON for a text message, as returned by getUpdates.
+
+    Arguments:
+      update_id - the update's id.
+      chat_id - the chat the message was sent in. Positive ids are DMs.
+      user_id - the sender's id.
+      text - the message text. A leading "/" makes it a command.
+      first_name - Optional. The sender's first name.
+      thread_id - Optional. The forum topic the message was sent in.
+    """
+    entities = []
+    if text.startswith("/"):
+        entities.append({"type": "bot_command", "offset": 0,
+                         "length": len(text.split()[0])})
+    data = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id,
+                     "type": "private" if chat_id > 0 else "group"},
+            "from": {"id": user_id, "is_bot": False,
+                     "first_name": first_name or "P{}".format(user_id)},
+            "text": text,
+            "entities": entities,
+        },
+    }
+    if thread_id is not None:
+        data["message"]["chat"].update(type="supergroup", is_forum=True)
+        data["message"].update(message_thread_id=thread_id,
+                               is_topic_message=True)
+    return data
+
+
+def make_callback(update_id, chat_id, user_id, data, first_name=None):
+    """
+    Builds the JSON for a button press, as returned by getUpdates.
+
+    Arguments:
+      update_id - the update's id.
+      chat_id - the chat the button's message is in.
+      user_id - who pressed it.
+      data - the button's callback_data.
+      first_name - Optional. The presser's first name.
+    """
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False,
+                     "first_name": first_name or "P{}".format(user_id)},
+            "message": {"message_id": update_id, "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "group"},
+                        "text": ""},
+            "chat_instance": str(chat_id),
+            "data": data,
+        },
+    }
+
+
+def make_dispatcher(bot=None):
+    """
+    Returns a dispatcher with every bot handler registered.
+
+    Arguments:
+      bot - Optional. The bot to send with. Defaults to a new FakeBot.
+    """
+    dispatcher = Dispatcher(bot or FakeBot(), Queue(), workers=1,
+                            use_context=True,
+                            context_types=bot_module.CONTEXT_TYPES)
+    bot_module.add_handlers(dispatcher)
+    return dispatcher
+
+
+def process(dispatcher, data):
+    """
+    Parses an update's JSON and runs it through the dispatcher.
+    """
+    dispatcher.process_update(Update.de_json(data, dispatcher.bot))
+
+
+def game_script(chat_id, user_ids, rounds=1):
+    """
+    Yields (chat_id, user_id, text) for a scripted game in one chat.
+
+    The script doesn't peek at the game, so some moves (such as investigating
+    without the flashlight) are rejected; that still exercises the handlers
+    the way a real, chatty group does.
+
+    Arguments:
+      chat_id - the chat to play in.
+      user_ids - the players, in seating order.
+      rounds - how many claim/investigate cycles to script.
+    """
+    yield chat_id, user_ids[0], "/newgame"
+    for user_id in user_ids:
+        yield chat_id, user_id, "/join"
+    yield chat_id, user_ids[0], "/startgame"
+    for _ in range(rounds):
+        for user_id in user_ids:
+            yield chat_id, user_id, "/claim 1"
+        yield chat_id, user_ids[0], "/display"
+        for seat, user_id in enumerate(user_ids):
+            target = (seat + 1) % len(user_ids) + 1
+            yield chat_id, user_id, "/investigate {}".format(target)
+
+
+def play_random_game(n_players, expansions=(), seed=None):
+    """
+    Plays a game through the engine with honest claims and random targets.
+
+    Arguments:
+      n_players - the number of players.
+      expansions - Optional. The expansions to play with.
+      seed - Optional. Seeds the random module first.
+
+    Returns:
+      game - the finished game.
+    """
+    if seed is not None:
+        random.seed(seed)
+    settings = cg.GameSettings()
+    settings.expansions = list(expansions)
+    game = cg.Game(settings)
+    for i in range(n_players):
+        game.add_player(cg.Player(i + 1, nickname="P{}".format(i + 1)))
+    game.start_game()
+    while game.game_status == "Ongoing":
+        player = game.get_current_player()
+        if game.phase == "Claims":
+            titles = [card.title for card in player.game_data.cards]
+            elder = titles.count("Elder Sign")
+            cthulhu = titles.count("Cthulhu")
+            game.set_claim(player, len(titles) - elder - cthulhu, elder,
+                           cthulhu)
+        else:
+            targets = [p for p in game.get_active_players()
+                       if p is not player and
+                       any(not c.is_flipped for c in p.game_data.cards)]
+            if not targets:
+                break
+            game.investigate(player, random.choice(targets))
+    return game
+
+
+def next_move(game):
+    """
+    Returns (user_id, text) for a legal next move in a game, or None once the
+    game is over. Claims are honest and investigations go to the next seat
+    with a face-down card.
+    """
+    if game is None or game.game_status != "Ongoing":
+        return None
+    player = game.get_current_player()
+    if game.phase == "Claims":
+        titles = [card.title for card in player.game_data.cards]
+        elder = titles.count("Elder Sign")
+        if titles.count("Cthulhu"):
+            return player.p_id, "/claim {} c".format(elder)
+        return player.p_id, "/claim {}".format(elder)
+    seats = game.get_active_players()
+    start = seats.index(player)
+    for step in range(1, len(seats)):
+        target = seats[(start + step) % len(seats)]
+        if any(not c.is_flipped for c in target.game_data.cards):
+            return player.p_id, "/investigate {}".format(
+                seats.index(target) + 1)
+    return None
+
+
+def next_button(game, keyboard):
+    """
+    Returns (user_id, callback_data) for the button making the same move as
+    next_move, or None once the game is over.
+
+    Raises:
+      LookupError - if the keyboard doesn't offer that move.
+    """
+    move = next_move(game)
+    if move is None:
+        return None
+    user_id, text = move
+    command, *args = text.split()
+    if command == "/claim":
+        wanted = (bot_module.CLAIM_BUTTON,
+                  int(args[0]) | (len(args) > 1) << 4)
+    else:
+        wanted = (bot_module.INVESTIGATE_BUTTON, int(args[0]))
+    for row in keyboard.inline_keyboard:
+        for button in row:
+            if bot_module.decode_button(button.callback_data)[1:] == wanted:
+                return user_id, button.callback_data
+    raise LookupError("No button for {}".format(text))
+
+
+def play_game(send, get_game, chat_id, user_ids, max_moves=None):
+    """
+    Plays a whole game through the bot's handlers.
+
+    Arguments:
+      send - called as send(chat_id, user_id, text) to deliver a command.
+      get_game - called as get_game(chat_id) to peek at the chat's game.
+      chat_id - the chat to play in.
+      user_ids - the players.
+      max_moves - Optional. Stop after this many moves.
+
+    Returns:
+      moves - the number of moves made after the game started.
+    """
+    send(chat_id, user_ids[0], "/newgame")
+    for user_id in user_ids:
+        send(chat_id, user_id, "/join")
+    send(chat_id, user_ids[0], "/startgame")
+    moves = 0
+    while max_moves is None or moves < max_moves:
+        move = next_move(get_game(chat_id))
+        if move is None:
+            break
+        send(chat_id, *move)
+        moves += 1
+    return moves
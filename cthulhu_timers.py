@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains a hierarchical timing wheel for turn timeouts.
+
+Every ongoing game has a timer that is re-armed on each move, so arming and
+cancelling must be cheap even with hundreds of thousands of games. A timing
+wheel makes both O(1): a timer goes into a bucket chosen by its deadline,
+and cancelling it just removes it from that bucket. Level 0 has one bucket
+per tick. Each higher level's buckets cover a whole turn of the level below.
+When a lower wheel wraps around, the timers in the next higher bucket are
+poured down ("cascaded") into finer buckets. One background thread ticks the
+wheel.
+"""
+import threading
+import time
+
+
+class Timer:
+    """
+    A callback scheduled on a TimingWheel.
+
+    Attributes:
+      deadline - the tick the timer fires on.
+      callback - called as callback(*args) when the timer fires.
+      args - the arguments for the callback.
+      bucket - the set holding the timer, or None once it fired or was
+        cancelled.
+    """
+    __slots__ = ("deadline", "callback", "args", "bucket", "wheel")
+
+    def __init__(self, wheel, deadline, callback, args):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.bucket = None
+
+    def cancel(self):
+        """
+        Stops the timer from firing. Does nothing if it already has.
+        """
+        self.wheel.cancel(self)
+
+
+class TimingWheel:
+    """
+    Schedules callbacks to the nearest tick.
+
+    Attributes:
+      tick - the length of a tick in seconds.
+      bits - each level has 2 ** bits buckets.
+      levels - the buckets, one list per level, finest first.
+      overflow - timers too far away for the top level.
+      current - the number of the last tick processed.
+    """
+
+    def __init__(self, tick=1.0, bits=6, n_levels=4, clock=time.monotonic):
+        """
+        Arguments:
+          tick - the length of a tick in seconds.
+          bits - each level has 2 ** bits buckets. With the defaults the
+            wheel covers 64 ** 4 seconds, about half a year.
+          n_levels - the number of levels.
+          clock - returns the current time in seconds.
+        """
+        self.tick = tick
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = [[set() for _ in range(1 << bits)]
+                       for _ in range(n_levels)]
+        self.overflow = set()
+        self.clock = clock
+        self.current = int(clock() / tick)
+        self.count = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        """
+        Calls callback(*args) after at least `delay` seconds.
+
+        Returns:
+          timer - a Timer, which can be cancelled.
+        """
+        ticks = max(1, -int(-delay // self.tick))
+        with self.lock:
+            timer = Timer(self, self.current + ticks, callback, args)
+            self.place(timer)
+            self.count += 1
+        return timer
+
+    def place(self, timer):
+        """
+        Puts a timer in the finest bucket that won't have passed before the
+        timer is due.
+        """
+        for level, buckets in enumerate(self.levels):
+            shift = self.bits * (level + 1)
+            if timer.deadline >> shift == self.current >> shift:
+                bucket = buckets[(timer.deadline >> (shift - self.bits)) &
+                                 self.mask]
+                break
+        else:
+            bucket = self.overflow
+        bucket.add(timer)
+        timer.bucket = bucket
+
+    def cancel(self, timer):
+        """
+        Stops a timer from firing.
+        """
+        with self.lock:
+            if timer.bucket is not None:
+                timer.bucket.discard(timer)
+                timer.bucket = None
+                self.count -= 1
+
+    def cascade(self):
+        """
+        Pours down the buckets of every level whose lower level just
+        wrapped around, highest level first.
+        """
+        level = 1
+        while (level < len(self.levels) and
+               not self.current & ((1 << (self.bits * level)) - 1)):
+            level += 1
+        if level == len(self.levels):
+            timers, self.overflow = self.overflow, set()
+            for timer in timers:
+                self.place(timer)
+        for level in range(level - 1, 0, -1):
+            buckets = self.levels[level]
+            index = (self.current >> (self.bits * level)) & self.mask
+            timers, buckets[index] = buckets[index], set()
+            for timer in timers:
+                self.place(timer)
+
+    def advance(self, now=None):
+        """
+        Processes every tick up to now and fires the timers that are due.
+
+        Returns:
+          fired - the number of timers fired.
+        """
+        if now is None:
+            now = self.clock()
+        target = int(now / self.tick)
+        fired = 0
+        while True:
+            with self.lock:
+                if self.current >= target:
+                    break
+                self.current += 1
+                if not self.current & self.mask:
+                    self.cascade()
+                buckets = self.levels[0]
+                index = self.current & self.mask
+                due, buckets[index] = buckets[index], set()
+                for timer in due:
+                    timer.bucket = None
+                self.count -= len(due)
+            for timer in due:
+                timer.callback(*timer.args)
+            fired += len(due)
+        return fired
+
+    def start(self):
+        """
+        Ticks the wheel on a background thread until stop() is called.
+        """
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name="timing-wheel")
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.tick):
+            self.advance()
+
+    def stop(self):
+        """
+        Stops the background thread.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class TurnTimers:
+    """
+    Keeps at most one timer per chat on a TimingWheel.
+
+    Attributes:
+      wheel - the wheel the timers are on.
+      timers - maps a chat's id, or (chat id, topic) for a game in a forum
+        topic, to its timer.
+    """
+
+    def __init__(self, wheel):
+        self.wheel = wheel
+        self.timers = {}
+
+    def arm(self, chat_id, delay, callback, *args):
+        """
+        Replaces a chat's timer with a new one.
+        """
+        self.cancel(chat_id)
+        self.timers[chat_id] = self.wheel.schedule(delay, callback, *args)
+
+    def cancel(self, chat_id):
+        """
+        Cancels a chat's timer, if it has one.
+        """
+        timer = self.timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
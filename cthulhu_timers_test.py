@@ -0,0 +1,67 @@
+from cthulhu_timers import *
+import random
+import unittest
+
+
+class TestTimingWheel(unittest.TestCase):
+    """
+    Tests the hierarchical timing wheel.
+    """
+
+    def run_wheel(self, wheel, delays, cancel=()):
+        """
+        Schedules timers with the given delays, cancels some, then ticks one
+        second at a time and records the second each timer fired on.
+        """
+        fired = {}
+        now = [0]
+        timers = [wheel.schedule(delay, lambda i: fired.setdefault(i, now[0]),
+                                 i)
+                  for i, delay in enumerate(delays)]
+        for i in cancel:
+            timers[i].cancel()
+        for now[0] in range(1, max(delays) + 2):
+            wheel.advance(now[0])
+        return fired
+
+    def test_fires_on_time(self):
+        """
+        Timers fire on their deadline across every level.
+        """
+        random.seed(0)
+        wheel = TimingWheel(tick=1, bits=3, n_levels=3, clock=lambda: 0)
+        delays = [random.randint(1, 2000) for _ in range(2000)]
+        fired = self.run_wheel(wheel, delays)
+        self.assertEqual(fired, dict(enumerate(delays)))
+        self.assertEqual(len(wheel), 0)
+
+    def test_cancel(self):
+        """
+        Cancelled timers never fire, and cancelling twice is harmless.
+        """
+        wheel = TimingWheel(tick=1, bits=2, n_levels=2, clock=lambda: 0)
+        delays = [5, 30, 30, 100]
+        timer = wheel.schedule(3, lambda: None)
+        timer.cancel()
+        timer.cancel()
+        fired = self.run_wheel(wheel, delays, cancel=[1, 3])
+        self.assertEqual(fired, {0: 5, 2: 30})
+
+    def test_turn_timers(self):
+        """
+        Re-arming a chat's timer cancels the old one.
+        """
+        wheel = TimingWheel(tick=1, clock=lambda: 0)
+        timers = TurnTimers(wheel)
+        fired = []
+        timers.arm(-1, 10, fired.append, "first")
+        timers.arm(-1, 20, fired.append, "second")
+        timers.arm(-2, 5, fired.append, "other")
+        timers.cancel(-2)
+        self.assertEqual(len(wheel), 1)
+        wheel.advance(30)
+        self.assertEqual(fired, ["second"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains the HTTP transport the bot talks to the Bot API with.
+
+python-telegram-bot's Request keeps con_pool_size connections alive, but
+when more threads than that send at once, the extra requests open a fresh
+connection each and throw it away afterwards. PooledRequest caps the calls
+in flight at the pool size instead, so every call reuses a kept-alive
+connection, and a call that finds the pool busy waits for one.
+
+Each call's time is split into the wait for a connection and the request
+itself, and totalled per API method in PooledRequest.stats. Point the bot at
+a FakeBotAPI with telegram.Bot(..., base_url=api.base_url) to test it
+locally.
+"""
+import logging
+import threading
+import time
+
+from telegram.utils.request import Request
+
+
+class CallStats:
+    """
+    Timings of the calls to one API method.
+
+    Attributes:
+      calls - the number of calls.
+      wait - total seconds spent waiting for a connection.
+      request - total seconds spent on the requests themselves.
+      max_wait - the longest wait for a connection.
+    """
+    __slots__ = ("calls", "wait", "request", "max_wait")
+
+    def __init__(self):
+        self.calls = 0
+        self.wait = 0.0
+        self.request = 0.0
+        self.max_wait = 0.0
+
+    def add(self, wait, request):
+        self.calls += 1
+        self.wait += wait
+        self.request += request
+        self.max_wait = max(self.max_wait, wait)
+
+    def __repr__(self):
+        return ("CallStats(calls={}, mean wait {:.1f} ms, mean request "
+                "{:.1f} ms)".format(self.calls,
+                                    self.wait / max(self.calls, 1) * 1000,
+                                    self.request / max(self.calls, 1) * 1000))
+
+
+class PooledRequest(Request):
+    """
+    A Request that never opens more than `size` connections and times each
+    call.
+
+    Attributes:
+      stats - maps an API method's name to its CallStats.
+      on_call - Optional. Called as on_call(method, wait, request) after
+        every call, with both times in seconds.
+    """
+    # Request warns about attributes that aren't in a slot.
+    __slots__ = ("slots", "stats", "stats_lock", "on_call")
+
+    def __init__(self, size=8, on_call=None, **kwargs):
+        """
+        Arguments:
+          size - the number of connections to keep alive, and so of calls
+            in flight at once.
+          on_call - Optional. See the class docstring.
+          Other keyword arguments are passed on to Request.
+        """
+        super().__init__(con_pool_size=size, **kwargs)
+        self.slots = threading.BoundedSemaphore(size)
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.on_call = on_call
+
+    def _request_wrapper(self, *args, **kwargs):
+        method = args[1].rsplit("/", 1)[-1] if len(args) > 1 else ""
+        start = time.perf_counter()
+        with self.slots:
+            sent = time.perf_counter()
+            try:
+                return super()._request_wrapper(*args, **kwargs)
+            finally:
+                done = time.perf_counter()
+                self.record(method, sent - start, done - sent)
+
+    def record(self, method, wait, request):
+        with self.stats_lock:
+            stats = self.stats.get(method)
+            if stats is None:
+                stats = self.stats[method] = CallStats()
+            stats.add(wait, request)
+        if wait > request:
+            logging.debug("%s waited %.0f ms for a connection.", method,
+                          wait * 1000)
+        if self.on_call is not None:
+            self.on_call(method, wait, request)
+
+    def total(self):
+        """
+        Returns the CallStats of every method together.
+        """
+        total = CallStats()
+        with self.stats_lock:
+            for stats in self.stats.values():
+                total.calls += stats.calls
+                total.wait += stats.wait
+                total.request += stats.request
+                total.max_wait = max(total.max_wait, stats.max_wait)
+        return total
@@ -0,0 +1,65 @@
+from cthulhu_transport import *
+import cthulhu_fakeapi as fakeapi
+import telegram
+import threading
+import unittest
+
+
+class TestPooledRequest(unittest.TestCase):
+    """
+    Tests the pooled transport against the fake Bot API.
+    """
+
+    def setUp(self):
+        self.api = fakeapi.FakeBotAPI(latency={"sendMessage": 0.02}).start()
+
+    def tearDown(self):
+        self.api.stop()
+
+    def send_all(self, bot, n_threads, per_thread):
+        def send(t):
+            for i in range(per_thread):
+                bot.send_message(chat_id=t + 1, text=str(i))
+        threads = [threading.Thread(target=send, args=(t,))
+                   for t in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_pool(self):
+        """
+        However many threads send at once, only `size` connections are
+        opened, and the rest of the calls wait for one.
+        """
+        calls = []
+        request = PooledRequest(2, on_call=lambda *call: calls.append(call))
+        bot = telegram.Bot(self.api.token, base_url=self.api.base_url,
+                           request=request)
+        self.send_all(bot, 8, 3)
+        self.assertEqual(len(self.api.sent), 24)
+        self.assertLessEqual(self.api.connections, 2)
+        stats = request.stats["sendMessage"]
+        self.assertEqual(stats.calls, 24)
+        self.assertGreaterEqual(stats.request, 24 * 0.02)
+        self.assertGreater(stats.wait, 0)
+        self.assertEqual(len(calls), 24)
+        self.assertEqual({method for method, _, _ in calls}, {"sendMessage"})
+        self.assertEqual(request.total().calls, 24)
+
+    def test_errors_timed(self):
+        """
+        Failed calls are timed too, and give their connection back.
+        """
+        self.api.flood_rate = 1
+        request = PooledRequest(1)
+        bot = telegram.Bot(self.api.token, base_url=self.api.base_url,
+                           request=request)
+        for _ in range(2):
+            with self.assertRaises(telegram.error.RetryAfter):
+                bot.send_message(chat_id=1, text="board")
+        self.assertEqual(request.stats["sendMessage"].calls, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
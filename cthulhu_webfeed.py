@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+This module contains a local web feed for watching games without joining
+their chats.
+
+WebFeed is an HTTP server that streams each game as Server-Sent Events from
+/games/<chat_id>, or /games/<chat_id>/<topic> for a game in a forum topic.
+A new viewer gets the whole state once, as a "state" event. After that, each move sends a "delta" event carrying only the seats
+whose hand, claim or flashlight changed, and only those fields, plus any of
+round, phase, turn, status or winner that changed. A delta is serialized once per move and the
+same bytes go to every viewer of that game.
+
+Viewers are anonymous, so they only see what the chat sees: revealed cards,
+claims and the flashlight. Roles are shown once the game has ended.
+"""
+import http.server
+import json
+import re
+import threading
+
+# The top-level fields of a game's state, besides its seats.
+FIELDS = ("round", "phase", "turn", "status", "winner")
+
+GAME_PATH = re.compile(r"^/games/(-?\d+)(?:/(\d+))?$")
+
+
+def game_state(game):
+    """
+    Returns the public state of a game as a JSON-ready dict.
+    """
+    ended = game.game_status == "Ended"
+    seats = []
+    for player in game.get_active_players():
+        seat = {"name": str(player),
+                "hand": player.display_hand(),
+                "claim": player.display_claim(),
+                "flashlight": player.game_data.has_flashlight}
+        if ended:
+            seat["role"] = player.game_data.role
+        seats.append(seat)
+    return {"round": getattr(game, "round_counter", 0),
+            "phase": getattr(game, "phase", None),
+            "turn": getattr(game, "turn", None),
+            "status": game.game_status,
+            "winner": getattr(game, "winner", None),
+            "seats": seats}
+
+
+def state_delta(old, new):
+    """
+    Returns what changed between two states, or an empty dict.
+
+    Changed seats are keyed by their index as a string, as JSON objects
+    need string keys, and hold only the fields that changed.
+    """
+    delta = {field: new[field] for field in FIELDS
+             if old.get(field) != new[field]}
+    old_seats = old.get("seats", [])
+    seats = {}
+    for i, seat in enumerate(new["seats"]):
+        if i < len(old_seats):
+            seat = {key: value for key, value in seat.items()
+                    if old_seats[i].get(key) != value}
+        if seat:
+            seats[str(i)] = seat
+    if seats:
+        delta["seats"] = seats
+    if len(new["seats"]) != len(old_seats):
+        delta["n_seats"] = len(new["seats"])
+    return delta
+
+
+def encode_event(event, data):
+    """
+    Returns one Server-Sent Event as bytes.
+    """
+    return "event: {}\ndata: {}\n\n".format(
+        event, json.dumps(data, separators=(",", ":"))).encode()
+
+
+class Channel:
+    """
+    One game's stream.
+
+    Attributes:
+      state - the game's latest state.
+      events - the latest encoded events, oldest first.
+      first - the sequence number of events[0].
+      condition - notified when an event is added.
+    """
+
+    def __init__(self):
+        self.state = {"seats": []}
+        self.events = []
+        self.first = 0
+        self.condition = threading.Condition()
+
+    @property
+    def next_seq(self):
+        return self.first + len(self.events)
+
+
+class FeedServer(http.server.ThreadingHTTPServer):
+    """
+    An HTTP server that keeps a thread per viewer and lets many viewers
+    connect at once.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class WebFeed:
+    """
+    Streams games to web viewers over Server-Sent Events.
+
+    Attributes:
+      full - if True, every event is the whole state rather than a delta,
+        for comparison.
+      history - how many events to keep per game for viewers who fall
+        behind; a viewer further behind is sent the whole state again.
+      channels - maps a chat's id to its Channel.
+      viewers - the number of connected viewers.
+      bytes_sent - the bytes of events written to viewers.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, history=64, full=False):
+        self.full = full
+        self.history = history
+        self.channels = {}
+        self.viewers = 0
+        self.bytes_sent = 0
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.server = FeedServer((host, port), self.make_handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server.server_address[:2])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True, name="web-feed")
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        with self.lock:
+            channels = list(self.channels.values())
+        for channel in channels:
+            with channel.condition:
+                channel.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def channel(self, chat_id):
+        with self.lock:
+            if chat_id not in self.channels:
+                self.channels[chat_id] = Channel()
+            return self.channels[chat_id]
+
+    def publish(self, chat_id, game):
+        """
+        Sends a game's changes to its viewers. Does nothing if nothing they
+        can see has changed.
+        """
+        new = game_state(game)
+        channel = self.channel(chat_id)
+        with channel.condition:
+            if self.full:
+                if new == channel.state:
+                    return
+                event = encode_event("state", new)
+            else:
+                delta = state_delta(channel.state, new)
+                if not delta:
+                    return
+                event = encode_event("delta", delta)
+            channel.state = new
+            channel.events.append(event)
+            if len(channel.events) > self.history:
+                del channel.events[0]
+                channel.first += 1
+            channel.condition.notify_all()
+
+    def stream(self, chat_id, write):
+        """
+        Writes a game's events to one viewer until they disconnect or the
+        feed stops.
+
+        Arguments:
+          chat_id - the game's chat, or (chat id, topic).
+          write - writes bytes to the viewer, raising OSError once they've
+            gone.
+        """
+        channel = self.channel(chat_id)
+        with self.lock:
+            self.viewers += 1
+        try:
+            seq = None
+            while not self.stopped:
+                with channel.condition:
+                    channel.condition.wait_for(
+                        lambda: self.stopped or seq != channel.next_seq)
+                    if self.stopped:
+                        return
+                    if seq is None or seq < channel.first:
+                        # New, or too far behind to catch up on deltas.
+                        data = encode_event("state", channel.state)
+                    else:
+                        data = b"".join(
+                            channel.events[seq - channel.first:])
+                    seq = channel.next_seq
+                write(data)
+                with self.lock:
+                    self.bytes_sent += len(data)
+        finally:
+            with self.lock:
+                self.viewers -= 1
+
+    def make_handler(self):
+        feed = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                match = GAME_PATH.match(self.path)
+                if match is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                self.close_connection = True
+
+                def write(data):
+                    self.wfile.write(data)
+                    self.wfile.flush()
+                chat_id = int(match.group(1))
+                key = (chat_id if match.group(2) is None else
+                       (chat_id, int(match.group(2))))
+                try:
+                    feed.stream(key, write)
+                except OSError:
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
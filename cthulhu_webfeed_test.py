@@ -0,0 +1,119 @@
+from cthulhu_webfeed import *
+import cthulhu_game as cg
+import cthulhu_testing as testing
+import http.client
+import json
+import random
+import unittest
+
+
+def make_game(n_players=4):
+    game = cg.Game()
+    for i in range(n_players):
+        game.add_player(cg.Player(i + 1, nickname="P{}".format(i + 1)))
+    game.start_game()
+    return game
+
+
+def claim_honestly(game):
+    player = game.get_current_player()
+    titles = [card.title for card in player.game_data.cards]
+    elder = titles.count("Elder Sign")
+    cthulhu = titles.count("Cthulhu")
+    game.set_claim(player, len(titles) - elder - cthulhu, elder, cthulhu)
+    return player
+
+
+class TestStates(unittest.TestCase):
+    """
+    Tests game states and deltas.
+    """
+
+    def test_delta_only_changed_seats(self):
+        """
+        A claim changes its claimant's seat and the turn, and nothing else.
+        """
+        random.seed(1)
+        game = make_game()
+        before = game_state(game)
+        player = claim_honestly(game)
+        after = game_state(game)
+        seat = game.get_active_players().index(player)
+        delta = state_delta(before, after)
+        self.assertEqual(list(delta.get("seats", {})), [str(seat)])
+        self.assertEqual(delta["seats"][str(seat)],
+                         {"claim": player.display_claim()})
+        self.assertEqual(state_delta(after, after), {})
+
+    def test_public_only(self):
+        """
+        Roles stay hidden until the game ends.
+        """
+        random.seed(2)
+        game = make_game()
+        self.assertNotIn("role", json.dumps(game_state(game)))
+        game = testing.play_random_game(4, seed=2)
+        roles = [seat["role"] for seat in game_state(game)["seats"]]
+        self.assertEqual(roles, [p.game_data.role
+                                 for p in game.get_active_players()])
+
+
+class TestWebFeed(unittest.TestCase):
+    """
+    Tests streaming games to viewers over HTTP.
+    """
+
+    def setUp(self):
+        self.feed = WebFeed().start()
+
+    def tearDown(self):
+        self.feed.stop()
+
+    def connect(self, chat_id):
+        connection = http.client.HTTPConnection(
+            *self.feed.server.server_address[:2], timeout=5)
+        connection.request("GET", "/games/{}".format(chat_id))
+        response = connection.getresponse()
+        self.assertEqual(response.getheader("Content-Type"),
+                         "text/event-stream")
+        return response
+
+    def read_event(self, response):
+        event = response.fp.readline().decode().strip()
+        data = response.fp.readline().decode().strip()
+        self.assertEqual(response.fp.readline(), b"\n")
+        return event[len("event: "):], json.loads(data[len("data: "):])
+
+    def test_stream(self):
+        """
+        Viewers get the whole state once and then the same deltas.
+        """
+        random.seed(3)
+        game = make_game()
+        self.feed.publish(-1, game)
+        viewers = [self.connect(-1), self.connect(-1)]
+        for viewer in viewers:
+            self.assertEqual(self.read_event(viewer),
+                             ("state", game_state(game)))
+        before = game_state(game)
+        claim_honestly(game)
+        self.feed.publish(-1, game)
+        events = [self.read_event(viewer) for viewer in viewers]
+        self.assertEqual(events[0], events[1])
+        self.assertEqual(events[0],
+                         ("delta", state_delta(before, game_state(game))))
+        for viewer in viewers:
+            viewer.close()
+
+    def test_not_found(self):
+        """
+        Only game paths are served.
+        """
+        connection = http.client.HTTPConnection(
+            *self.feed.server.server_address[:2], timeout=5)
+        connection.request("GET", "/games/chat")
+        self.assertEqual(connection.getresponse().status, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()